@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+'''
+Throughput and latency of the BBR message handlers: CoAP resources, multicast
+routing upcalls, ND Proxy solicitations and KiNOS syslog messages.
+
+The handlers run in process with synthetic messages. Sockets, kernel routes
+and ip6tables calls are replaced by no-ops, so no root or dongle is needed.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import kibra.coapserver as coapserver  # noqa: E402
+import kibra.database as db  # noqa: E402
+import kibra.iptables as iptables  # noqa: E402
+import kibra.ndproxy as ndproxy  # noqa: E402
+import kibra.network as network  # noqa: E402
+import kibra.syslog as syslog  # noqa: E402
+from kibra.mcrouter import EXT_MIF, MCRouter  # noqa: E402
+from kibra.sim import peers  # noqa: E402
+from kibra.sim.syslog import format_message  # noqa: E402
+from kibra.syslog import SYSLOG_MSG_ID_CACHE_ADD, SYSLOG_MSG_ID_CACHE_DEL  # noqa: E402
+
+DUA_PREFIX = 'fd00:7d03::/64'
+MESH_PREFIX = 'fd00:db8::/64'
+NET_NAME = 'KiBRA bench'
+# Relative change in ops/s or p99 accepted by the regression compare
+DEF_TOLERANCE = 10
+
+SETTINGS = {
+    'all_domain_bbrs': 'ff32:40:fd00:7d03::1',
+    'bbr_status': 'primary',
+    'exterior_addrs': [],
+    'exterior_ifname': 'eth0',
+    'exterior_ifnumber': 2,
+    'interior_ifname': 'wpan0',
+    'maddrs_perm': [],
+    'mcast_admin_fwd': 1,
+    'mcast_out_fwd': 1,
+    'mlr_cache': {},
+    'mlr_timeout': 3600,
+    'ncp_eid_cache': [],
+    'ncp_ll': 'fe80::1',
+    'ncp_netname': NET_NAME,
+    'ncp_prefix': MESH_PREFIX,
+    'ncp_rloc': 'fd00:db8::ff:fe00:400',
+    'prefix': DUA_PREFIX,
+}
+
+
+class NullSocket:
+    def setsockopt(self, *args):
+        pass
+
+    def sendto(self, data, addr):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class NullCoapClient:
+    async def con_request(self, addr, port, path, payload=''):
+        return None
+
+    async def non_request(self, addr, port, path, payload=''):
+        return None
+
+    async def request(self, addr, port, path, mtype, payload=''):
+        return None
+
+    def stop(self):
+        pass
+
+
+def _no_op(*args, **kwargs):
+    pass
+
+
+def _offline():
+    '''Handlers with the kernel and network access replaced by no-ops'''
+    network.ncp_route_enable = _no_op
+    network.ncp_route_disable = _no_op
+    iptables.block_local_multicast = _no_op
+    ndproxy.EXT_IFNUMBER = 2
+    ndproxy.EXT_EUI48 = bytes.fromhex('020000000001')
+
+    proxy = ndproxy.NDProxy.__new__(ndproxy.NDProxy)
+    proxy.duas = {}
+    proxy.icmp6_sock = NullSocket()
+    proxy.ndp_on = False
+
+    dua_handler = coapserver.DUAHandler.__new__(coapserver.DUAHandler)
+    dua_handler.entries = []
+    dua_handler.ndproxy = proxy
+    dua_handler.coap_client = NullCoapClient()
+
+    router = MCRouter.__new__(MCRouter)
+    router.mc6r_sock = NullSocket()
+    router.mc6g_sock = NullSocket()
+    router.mcroutes = []
+    router.mcr_on = False
+
+    mcast_handler = coapserver.MulticastHandler.__new__(coapserver.MulticastHandler)
+    mcast_handler.maddrs = {}
+    mcast_handler.mcrouter = router
+    mcast_handler.coap_client = NullCoapClient()
+
+    coapserver.DUA_HNDLR = dua_handler
+    coapserver.MCAST_HNDLR = mcast_handler
+    return dua_handler, mcast_handler
+
+
+def _reset_db():
+    for key, value in SETTINGS.items():
+        db.set(key, value)
+
+
+def _request(payload, src):
+    return types.SimpleNamespace(
+        payload=bytes(payload), remote=types.SimpleNamespace(sockaddr=(src, 61631))
+    )
+
+
+def _population(count):
+    return [peers.Peer(i, DUA_PREFIX, 0x0400 + i) for i in range(count)]
+
+
+def _rloc(peer):
+    return 'fd00:db8::ff:fe00:%x' % peer.rloc16
+
+
+async def _drain():
+    '''Let the tasks scheduled by the handlers run'''
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def _cancel_pending():
+    # asyncio.current_task and all_tasks are new in Python 3.7, the Task
+    # methods were removed in 3.9
+    current_task = getattr(asyncio, 'current_task', None)
+    all_tasks = getattr(asyncio, 'all_tasks', None)
+    current = (current_task or asyncio.Task.current_task)()
+    tasks = [
+        task
+        for task in (all_tasks or asyncio.Task.all_tasks)()
+        if task is not current and not task.done()
+    ]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _measure(ops):
+    '''Run the (function, argument) operations, return ops/s and latencies in us'''
+    latencies = []
+    start = time.perf_counter()
+    for func, arg in ops:
+        op_start = time.perf_counter()
+        result = func(arg)
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(1e6 * (time.perf_counter() - op_start))
+        await _drain()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'ops_per_s': len(latencies) / elapsed,
+        'p50_us': latencies[len(latencies) // 2],
+        'p99_us': latencies[int(0.99 * len(latencies))],
+    }
+
+
+def _cycle(func, args, count):
+    return [(func, args[i % len(args)]) for i in range(count)]
+
+
+async def bench_n_dr(nodes, count):
+    res = coapserver.Res_N_DR()
+    reqs = [
+        _request(peers.n_dr_payload(p.dua.compressed, p.eid, 0), _rloc(p))
+        for p in nodes
+    ]
+    register = await _measure([(res.render_post, req) for req in reqs])
+    renew = await _measure(_cycle(res.render_post, reqs, count))
+    return {'n_dr_register': register, 'n_dr_renew': renew}
+
+
+async def bench_n_mr(nodes, count):
+    res = coapserver.Res_N_MR()
+    reqs = [_request(peers.n_mr_payload([p.mcast.compressed]), _rloc(p)) for p in nodes]
+    register = await _measure([(res.render_post, req) for req in reqs])
+    renew = await _measure(_cycle(res.render_post, reqs, count))
+    return {'n_mr_register': register, 'n_mr_renew': renew}
+
+
+def _register_duas(dua_handler, nodes):
+    '''DUAs with a finished DAD, as after a while of normal operation'''
+    for peer in nodes:
+        entry = coapserver.DUAEntry(_rloc(peer), peer.eid, peer.dua.compressed)
+        entry.dad = False
+        dua_handler.entries.append(entry)
+        dua_handler.ndproxy.duas[entry.dua] = entry.reg_time
+
+
+async def bench_backbone(nodes, count):
+    results = {}
+    src = 'fe80::2%eth0'
+
+    res = coapserver.Res_B_BQ()
+    reqs = [
+        _request(peers.bb_qry_payload(p.dua.compressed, p.rloc16), src) for p in nodes
+    ]
+    results['b_bq'] = await _measure(_cycle(res.render_post, reqs, count))
+
+    res = coapserver.Res_B_BA_uni()
+    reqs = [
+        _request(
+            peers.bb_ans_payload(p.dua.compressed, p.eid, 10, NET_NAME, p.rloc16),
+            src,
+        )
+        for p in nodes
+    ]
+    results['b_ba_uni'] = await _measure(_cycle(res.render_post, reqs, count))
+
+    res = coapserver.Res_B_BA_multi()
+    # Older registrations than ours, answered with PRO_BB.ntf
+    reqs = [
+        _request(peers.bb_ans_payload(p.dua.compressed, p.eid, 3600, NET_NAME), src)
+        for p in nodes
+    ]
+    results['b_ba_multi'] = await _measure(_cycle(res.render_post, reqs, count))
+
+    res = coapserver.Res_A_AQ()
+    reqs = [_request(peers.bb_qry_payload(p.dua.compressed), _rloc(p)) for p in nodes]
+    results['a_aq'] = await _measure(_cycle(res.render_post, reqs, count))
+
+    res = coapserver.Res_A_AE()
+    reqs = [
+        _request(peers.addr_err_payload(p.dua.compressed, p.eid), _rloc(p))
+        for p in nodes
+    ]
+    results['a_ae'] = await _measure(_cycle(res.render_post, reqs, count))
+    return results
+
+
+async def bench_mcrouter(nodes, count):
+    router = coapserver.MCAST_HNDLR.mcrouter
+    # Traffic from the backbone towards the registered groups
+    upcalls = [
+        struct.pack(
+            'BBHI16s16s',
+            0,
+            1,
+            EXT_MIF,
+            0,
+            bytes.fromhex('20010db8000000000000000000000001'),
+            p.mcast.packed,
+        )
+        for p in nodes
+    ]
+    return {
+        'mcrouter_upcall': await _measure(_cycle(router.handle_upcall, upcalls, count))
+    }
+
+
+async def bench_ndproxy(nodes, count):
+    proxy = coapserver.DUA_HNDLR.ndproxy
+    # Cached EIDs are answered without delay
+    db.set('ncp_eid_cache', [p.dua.compressed for p in nodes])
+    solicits = [
+        struct.pack('!BBHI16s', ndproxy.ND_NEIGHBOR_SOLICIT, 0, 0, 0, p.dua.packed)
+        for p in nodes
+    ]
+
+    def solicit(data):
+        proxy.handle_ns(data, ('fe80::2', 0, 0, 2))
+
+    return {'ndproxy_ns': await _measure(_cycle(solicit, solicits, count))}
+
+
+async def bench_syslog(nodes, count):
+    messages = []
+    for peer in nodes:
+        messages.append(format_message(SYSLOG_MSG_ID_CACHE_ADD, peer.dua.compressed))
+        messages.append(format_message(SYSLOG_MSG_ID_CACHE_DEL, peer.dua.compressed))
+    return {
+        'syslog_cache': await _measure(_cycle(syslog.handle_message, messages, count))
+    }
+
+
+async def _memory(nodes):
+    '''Bytes allocated per registered DUA and multicast address'''
+    result = {}
+    for name, res, payload in (
+        (
+            'n_dr_register',
+            coapserver.Res_N_DR(),
+            lambda p: peers.n_dr_payload(p.dua.compressed, p.eid, 0),
+        ),
+        (
+            'n_mr_register',
+            coapserver.Res_N_MR(),
+            lambda p: peers.n_mr_payload([p.mcast.compressed]),
+        ),
+    ):
+        _reset_db()
+        _offline()
+        reqs = [_request(payload(p), _rloc(p)) for p in nodes]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for req in reqs:
+            await res.render_post(req)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        await _cancel_pending()
+        result[name] = (after - before) / len(nodes)
+    return result
+
+
+async def _run(args):
+    nodes = _population(args.entries)
+    results = {}
+
+    _reset_db()
+    _offline()
+    results.update(await bench_n_dr(nodes, args.ops))
+    results.update(await bench_n_mr(nodes, args.ops))
+    await _cancel_pending()
+
+    _reset_db()
+    dua_handler, mcast_handler = _offline()
+    _register_duas(dua_handler, nodes)
+    mcast_handler.reg_update([p.mcast.compressed for p in nodes], 3600)
+    results.update(await bench_backbone(nodes, args.ops))
+    results.update(await bench_mcrouter(nodes, args.ops))
+    results.update(await bench_ndproxy(nodes, args.ops))
+    results.update(await bench_syslog(nodes, args.ops))
+    await _cancel_pending()
+
+    for name, value in (await _memory(nodes)).items():
+        results[name]['mem_per_entry_b'] = value
+    return results
+
+
+def _print(results):
+    for name, result in results.items():
+        line = '%-16s %10.1f ops/s  p50 %8.1f us  p99 %8.1f us' % (
+            name,
+            result['ops_per_s'],
+            result['p50_us'],
+            result['p99_us'],
+        )
+        if 'mem_per_entry_b' in result:
+            line += '  %6.0f B/entry' % result['mem_per_entry_b']
+        print(line)
+
+
+def _compare(results, baseline, tolerance):
+    '''Print the changes against a previous run, return the regressions'''
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        speed = 100 * (result['ops_per_s'] / old['ops_per_s'] - 1)
+        tail = 100 * (result['p99_us'] / old['p99_us'] - 1)
+        flag = ''
+        if speed < -tolerance or tail > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-16s ops/s %+6.1f%%  p99 %+6.1f%%%s' % (name, speed, tail, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA BBR handlers benchmark')
+    parser.add_argument(
+        '--entries', type=int, default=coapserver.DUA_LIMIT, help='registered nodes'
+    )
+    parser.add_argument('--ops', type=int, default=5000, help='operations per test')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file of a previous run')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DEF_TOLERANCE,
+        help='accepted %% change before reporting a regression',
+    )
+    parser.add_argument(
+        '--log', action='store_true', help='include logging to a file in the cost'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # Keep the real configuration untouched
+        db.CFG_PATH = folder + '/'
+        db.CFG_FILE = os.path.join(folder, 'kibra.cfg')
+        if args.log:
+            logging.basicConfig(
+                level=logging.INFO, filename=os.path.join(folder, 'kibra.log')
+            )
+        results = asyncio.get_event_loop().run_until_complete(_run(args))
+
+    _print(results)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'entries': args.entries,
+            'ops': args.ops,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as file_:
+            json.dump(report, file_, indent=2)
+    if args.compare:
+        with open(args.compare) as file_:
+            baseline = json.load(file_)['results']
+        if _compare(results, baseline, args.tolerance):
+            sys.exit(1)
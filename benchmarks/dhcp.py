@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+'''
+Transactions per second of the embedded DHCPv6 server: Solicit with Rapid
+Commit, Solicit/Request exchanges and Renews, and the lease log replay time.
+
+Messages are handled in process, without sockets, so no root is needed.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kibra.dhcpd import (  # noqa: E402
+    ADVERTISE,
+    OPT_CLIENTID,
+    OPT_DNS_SERVERS,
+    OPT_IA_NA,
+    OPT_NTP_SERVER,
+    OPT_ORO,
+    OPT_RAPID_COMMIT,
+    OPT_SERVERID,
+    RENEW,
+    REPLY,
+    REQUEST,
+    SOLICIT,
+    DhcpServer,
+    LeaseLog,
+    duid_ll,
+    option,
+)
+
+PREFIX = 'fd00:7d03::/64'
+SERVER_MAC = '02:04:d2:00:00:01'
+ORO = option(OPT_ORO, struct.pack('!HH', OPT_DNS_SERVERS, OPT_NTP_SERVER))
+
+
+def _message(msg_type, duid, server_duid=None, rapid=False, iaid=1):
+    data = bytes([msg_type]) + os.urandom(3) + option(OPT_CLIENTID, duid)
+    if server_duid:
+        data += option(OPT_SERVERID, server_duid)
+    if rapid:
+        data += option(OPT_RAPID_COMMIT)
+    data += option(OPT_IA_NA, struct.pack('!III', iaid, 0, 0)) + ORO
+    return data
+
+
+def _server(folder):
+    server = DhcpServer(0, duid_ll(SERVER_MAC), LeaseLog(folder + '/leases.log'))
+    server.configure(
+        PREFIX,
+        86400,
+        86400,
+        options={
+            OPT_DNS_SERVERS: bytes(15) + b'\x01',
+            OPT_NTP_SERVER: bytes(20),
+        },
+        unicast='fd00:db8::ff:fe00:400',
+    )
+    return server
+
+
+def _measure(server, messages, expected):
+    '''Handle the messages, return transactions/s and latencies in us'''
+    latencies = []
+    start = time.perf_counter()
+    for data in messages:
+        op_start = time.perf_counter()
+        reply = server.handle(data)
+        latencies.append(1e6 * (time.perf_counter() - op_start))
+        if reply is None or reply[0] != expected:
+            raise RuntimeError('Unexpected reply to message type %d' % data[0])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'tx_per_s': len(latencies) / elapsed,
+        'p50_us': latencies[len(latencies) // 2],
+        'p99_us': latencies[int(0.99 * len(latencies))],
+    }
+
+
+def _run(args, folder):
+    clients = [duid_ll('02:00:%08x' % i) for i in range(args.clients)]
+    server = _server(folder)
+    server_duid = server.duid
+    results = {}
+
+    half = args.clients // 2
+    results['solicit_rapid'] = _measure(
+        server, [_message(SOLICIT, duid, rapid=True) for duid in clients[:half]], REPLY
+    )
+    # Four message exchange, timed as the Solicit and Request transactions
+    results['solicit'] = _measure(
+        server, [_message(SOLICIT, duid) for duid in clients[half:]], ADVERTISE
+    )
+    results['request'] = _measure(
+        server, [_message(REQUEST, duid, server_duid) for duid in clients[half:]], REPLY
+    )
+    renews = [
+        _message(RENEW, random.choice(clients), server_duid) for _ in range(args.ops)
+    ]
+    results['renew'] = _measure(server, renews, REPLY)
+
+    # Every client got its own address
+    leases = len(server.leases.by_duid)
+    if leases != args.clients or len(server.leases.by_addr) != args.clients:
+        raise RuntimeError('%d leases for %d clients' % (leases, args.clients))
+    records = server.leases.records
+    server.stop()
+
+    start = time.perf_counter()
+    replayed = LeaseLog(folder + '/leases.log')
+    results['replay'] = {
+        'records': records,
+        'log_bytes': os.path.getsize(folder + '/leases.log'),
+        'seconds': time.perf_counter() - start,
+        'leases': len(replayed.by_duid),
+    }
+    replayed.close()
+    return results
+
+
+def _print(results):
+    for name, result in results.items():
+        if 'tx_per_s' in result:
+            print(
+                '%-14s %10.1f tx/s  p50 %7.1f us  p99 %7.1f us'
+                % (name, result['tx_per_s'], result['p50_us'], result['p99_us'])
+            )
+    replay = results['replay']
+    print(
+        '%-14s %10d records  %d bytes  %.3f s  %d leases'
+        % (
+            'replay',
+            replay['records'],
+            replay['log_bytes'],
+            replay['seconds'],
+            replay['leases'],
+        )
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA DHCPv6 server benchmark')
+    parser.add_argument('--clients', type=int, default=2000, help='DHCPv6 clients')
+    parser.add_argument('--ops', type=int, default=20000, help='renews to send')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        results = _run(args, folder)
+
+    _print(results)
+    if args.json:
+        report = {
+            'meta': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'clients': args.clients,
+                'ops': args.ops,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'results': results,
+        }
+        with open(args.json, 'w') as file_:
+            json.dump(report, file_, indent=2)
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+'''
+Queries per second of the built-in DNS64 forwarder, against a local stub
+upstream server that answers every A query with one address.
+
+Cold queries are forwarded and synthesized, warm queries come from the
+cache. Everything runs on the loopback interface, so no root is needed.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import kibra.dnsd as dnsd  # noqa: E402
+from kibra.mdnsd import pack_name  # noqa: E402
+
+NAT64_PREFIX = '64:ff9b::/96'
+UPSTREAM_TTL = 300
+
+
+class StubUpstream(asyncio.DatagramProtocol):
+    '''Answer A queries with 192.0.2.1, any other type with no data'''
+
+    def __init__(self):
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        msg = dnsd.parse(data)
+        question = data[12 : msg.question.end]
+        flags = dnsd.FLAG_QR | dnsd.FLAG_RA | (msg.flags & dnsd.FLAG_RD)
+        if msg.question.qtype == dnsd.T_A:
+            rdata = socket.inet_aton('192.0.2.1')
+            answer = b'\xc0\x0c' + struct.pack(
+                '!HHIH', dnsd.T_A, dnsd.C_IN, UPSTREAM_TTL, len(rdata)
+            )
+            response = struct.pack('!HHHHHH', msg.id, flags, 1, 1, 0, 0)
+            response += question + answer + rdata
+        else:
+            soa = pack_name(('ns', 'example')) + pack_name(('admin', 'example'))
+            soa += struct.pack('!IIIII', 1, 3600, 600, 86400, 60)
+            authority = b'\xc0\x0c' + struct.pack(
+                '!HHIH', dnsd.T_SOA, dnsd.C_IN, UPSTREAM_TTL, len(soa)
+            )
+            response = struct.pack('!HHHHHH', msg.id, flags, 1, 0, 1, 0)
+            response += question + authority + soa
+        self.transport.sendto(response, addr)
+
+
+class Client(asyncio.DatagramProtocol):
+    '''Queries with a window of outstanding requests'''
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(data[:2], None)
+        if future and not future.done():
+            future.set_result(data)
+
+    async def query(self, id_, name, qtype):
+        data = struct.pack('!HHHHHH', id_, dnsd.FLAG_RD, 1, 0, 0, 0)
+        data += pack_name(name) + struct.pack('!HH', qtype, dnsd.C_IN)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[data[:2]] = future
+        self.transport.sendto(data)
+        return await asyncio.wait_for(future, 5)
+
+
+async def _phase(client, names, qtype, concurrency):
+    '''Queries per second and latencies in us of resolving the names'''
+    latencies = []
+    queue = list(enumerate(names))
+    queue.reverse()
+
+    async def worker():
+        while queue:
+            index, name = queue.pop()
+            start = time.perf_counter()
+            response = await client.query(index & 0xFFFF, name, qtype)
+            latencies.append(1e6 * (time.perf_counter() - start))
+            if struct.unpack_from('!H', response, 2)[0] & dnsd.RCODE_MASK:
+                raise RuntimeError('Query for %s failed' % '.'.join(name))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'queries': len(latencies),
+        'qps': len(latencies) / elapsed,
+        'p50_us': latencies[len(latencies) // 2],
+        'p99_us': latencies[int(0.99 * len(latencies))],
+    }
+
+
+async def _run(args):
+    loop = asyncio.get_event_loop()
+    upstream_transport, upstream = await loop.create_datagram_endpoint(
+        StubUpstream, local_addr=('127.0.0.1', 0)
+    )
+    upstream_addr = upstream_transport.get_extra_info('sockname')
+    server = dnsd.Dns64Server(NAT64_PREFIX, upstreams=[upstream_addr])
+    port = server.start('127.0.0.1', 0)
+    client_transport, client = await loop.create_datagram_endpoint(
+        Client, remote_addr=('127.0.0.1', port)
+    )
+
+    names = [('host%d' % i, 'example') for i in range(args.names)]
+    warm = [names[i % args.names] for i in range(args.queries)]
+    results = {}
+    results['aaaa_cold'] = await _phase(client, names, dnsd.T_AAAA, args.concurrency)
+    results['aaaa_cached'] = await _phase(client, warm, dnsd.T_AAAA, args.concurrency)
+    results['a_cold'] = await _phase(client, names, dnsd.T_A, args.concurrency)
+    results['mx_negative'] = await _phase(client, names, 15, args.concurrency)
+    results['mx_cached'] = await _phase(client, warm, 15, args.concurrency)
+    results['upstream_queries'] = upstream.queries
+
+    client_transport.close()
+    server.stop()
+    upstream_transport.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA DNS64 forwarder benchmark')
+    parser.add_argument('--names', type=int, default=2000, help='distinct names')
+    parser.add_argument('--queries', type=int, default=20000, help='cached queries')
+    parser.add_argument('--concurrency', type=int, default=32, help='queries in flight')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(_run(args))
+
+    for name, result in results.items():
+        if isinstance(result, dict):
+            print(
+                '%-12s %10.1f q/s  p50 %7.1f us  p99 %7.1f us'
+                % (name, result['qps'], result['p50_us'], result['p99_us'])
+            )
+    print('%-12s %10d' % ('upstream', results['upstream_queries']))
+    if args.json:
+        report = {
+            'meta': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'names': args.names,
+                'queries': args.queries,
+                'concurrency': args.concurrency,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'results': results,
+        }
+        with open(args.json, 'w') as file_:
+            json.dump(report, file_, indent=2)
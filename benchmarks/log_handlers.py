@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+'''Latency of a logging call with a plain file handler and with the queue pipeline'''
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import kibra.database as db  # noqa: E402
+from kibra import klog  # noqa: E402
+
+
+def _measure(records):
+    '''Per call latencies in microseconds'''
+    latencies = []
+    for i in range(records):
+        start = time.perf_counter()
+        logging.info('Benchmark record %d with some payload %s', i, 'x' * 64)
+        latencies.append(1e6 * (time.perf_counter() - start))
+    latencies.sort()
+    return latencies
+
+
+def _report(name, latencies):
+    print(
+        '%-8s p50 %6.2f us  p99 %7.2f us  max %8.2f us  mean %6.2f us'
+        % (
+            name,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)],
+            latencies[-1],
+            statistics.mean(latencies),
+        )
+    )
+
+
+def _reset():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA logging latency benchmark')
+    parser.add_argument('--records', type=int, default=100000, help='calls to time')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        db.LOG_FILE = os.path.join(folder, 'kibra.log')
+
+        logging.basicConfig(
+            level=logging.INFO,
+            format=klog.LOG_FORMAT,
+            filename=db.LOG_FILE,
+            filemode='w',
+        )
+        _report('file', _measure(args.records))
+        _reset()
+
+        klog.setup()
+        _report('queue', _measure(args.records))
+        klog.stop()
+        print('dropped %d records' % klog.dropped())
+        _reset()
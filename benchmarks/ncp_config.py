@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+'''NCP configuration cost against a fake serial device with a fixed latency'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import kibra.database as db  # noqa: E402
+from kibra import ksh  # noqa: E402
+
+SETTINGS = {
+    'ncp_channel': 15,
+    'ncp_commcred': 'KIRALE',
+    'ncp_netkey': '00112233445566778899aabbccddeeff',
+    'ncp_netname': 'Test Network',
+    'ncp_panid': '0xface',
+    'ncp_prefix': 'fd00:db8::/64',
+    'ncp_role': 'leader',
+    'ncp_xpanid': '0x0123456789abcdef',
+}
+
+
+class FakeSerial:
+    '''Answers show/config commands, each one taking the same time'''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.settings = {}
+        self.commands = 0
+
+    def ksh_cmd(self, cmd, debug_level=None):
+        time.sleep(self.latency)
+        self.commands += 1
+        words = cmd.split(' ', 2)
+        if words[0] == 'show':
+            return [self.settings.get(words[1], '')]
+        if words[0] == 'config' and len(words) == 3:
+            self.settings[words[1]] = words[2].strip('"')
+        return []
+
+
+async def _scenario(name, device):
+    commands = device.commands
+    start = time.perf_counter()
+    await ksh._ncp_apply_config()
+    print(
+        '%-14s %3d commands %8.1f ms'
+        % (name, device.commands - commands, 1000 * (time.perf_counter() - start))
+    )
+
+
+async def _main(args):
+    device = FakeSerial(args.latency / 1000)
+    ksh.SERIAL_DEV = device
+    channel = asyncio.ensure_future(ksh.SERIAL_CHANNEL.run())
+    await asyncio.sleep(0)
+    for key, value in SETTINGS.items():
+        db.set(key, value)
+
+    await _scenario('cold device', device)
+    await _scenario('no changes', device)
+    db.set('ncp_channel', 20)
+    await _scenario('one change', device)
+    # The device was cleared
+    ksh.NCP_STATE.clear()
+    device.settings = {}
+    await _scenario('cleared', device)
+    ksh.NCP_STATE.clear()
+    await _scenario('reread', device)
+    print(
+        'Sending every setting always costs %d commands, %.1f ms'
+        % (len(SETTINGS), len(SETTINGS) * args.latency)
+    )
+    channel.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA NCP configuration benchmark')
+    parser.add_argument(
+        '--latency', type=float, default=20, help='ms per serial command'
+    )
+    asyncio.get_event_loop().run_until_complete(_main(parser.parse_args()))
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+'''Load test for the KiBRA web server, reports requests per second per path'''
+
+import argparse
+import asyncio
+import time
+
+DEF_PATHS = ['/db/cfg', '/db/nodes']
+
+
+async def _client(host, port, path, deadline, counters):
+    '''Send requests over one persistent connection until the deadline'''
+    reader, writer = await asyncio.open_connection(host, port)
+    request = ('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, host)).encode()
+    try:
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            writer.write(request)
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            if b' 200 ' in status:
+                counters['ok'] += 1
+            else:
+                counters['errors'] += 1
+            counters['latency'] += time.monotonic() - start
+    finally:
+        writer.close()
+
+
+async def _run_path(host, port, path, clients, duration):
+    counters = {'ok': 0, 'errors': 0, 'latency': 0.0}
+    deadline = time.monotonic() + duration
+    start = time.monotonic()
+    await asyncio.gather(
+        *[_client(host, port, path, deadline, counters) for _ in range(clients)]
+    )
+    elapsed = time.monotonic() - start
+    done = counters['ok'] + counters['errors']
+    print(
+        '%-12s %8.1f req/s  %6.2f ms avg  %d errors'
+        % (
+            path,
+            counters['ok'] / elapsed,
+            1000 * counters['latency'] / done if done else 0,
+            counters['errors'],
+        )
+    )
+
+
+async def _main(args):
+    for path in args.paths:
+        await _run_path(args.host, args.port, path, args.clients, args.duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KiBRA web server load test')
+    parser.add_argument('--host', default='::1', help='web server address')
+    parser.add_argument('--port', type=int, default=80, help='web server port')
+    parser.add_argument(
+        '--clients', type=int, default=16, help='concurrent keep-alive connections'
+    )
+    parser.add_argument('--duration', type=float, default=10, help='seconds per path')
+    parser.add_argument('paths', nargs='*', default=DEF_PATHS, help='paths to request')
+    asyncio.get_event_loop().run_until_complete(_main(parser.parse_args()))
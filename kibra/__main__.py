@@ -8,14 +8,16 @@ import logging
 import daemonize
 import kibra
 from kibra import database as db
+from kibra import klog as klog
+from kibra import loopmon as loopmon
 from kibra import topology as topology
 from kibra import webserver as webserver
 from kibra.coapserver import COAPSERVER
 from kibra.dhcp import DHCP
 from kibra.diags import DIAGS
 from kibra.dns import DNS
-from kibra.ksh import SERIAL, enable_ncp
-from kibra.ktask import status
+from kibra.ksh import SERIAL, SERIAL_CHANNEL, enable_ncp
+from kibra.ktask import Scheduler, status
 from kibra.mdns import MDNS
 from kibra.nat import NAT
 from kibra.network import NETWORK, global_netconfig
@@ -27,7 +29,7 @@ TASKS = []
 SERVER = None
 
 
-async def _master():
+async def _master(scheduler):
     # TODO: Have a way to completely stop the daemon
     while True:
         # Start over
@@ -37,38 +39,26 @@ async def _master():
         while db.get('action_kibra') != 'start':
             await asyncio.sleep(0.2)
 
-        # Start all tasks
+        # Start all tasks, in parallel when they do not depend on each other
         db.set('status_kibra', 'starting')
-        for thread in TASKS:
-            if db.get('status_' + thread.name) is not status.RUNNING:
-                asyncio.ensure_future(thread.run())
-
-        # Wait until all tasks have started
-        for thread in TASKS:
-            while db.get('status_' + thread.name) is not status.RUNNING:
-                await asyncio.sleep(1)
+        await scheduler.start()
         db.set('action_kibra', 'none')
         db.set('status_kibra', 'running')
         db.save()
         logging.info('All tasks have now started.')
 
-        # Run forever
-        tasks_alive = True
-        while tasks_alive:
-            tasks_alive = False
-            for thread in TASKS:
-                if db.get('status_' + thread.name) is status.RUNNING:
-                    tasks_alive = True
-                    break
+        # Run while some task is alive
+        while any(
+            db.get('status_' + name) is status.RUNNING for name in scheduler.tasks
+        ):
             await asyncio.sleep(0.2)
 
-            # Kill all tasks if stop command is received
+            # Stop all tasks if stop command is received
             if db.get('action_kibra') == 'stop':
                 db.set('status_kibra', 'stopping')
-                for thread in TASKS:
-                    db.set('action_' + thread.name, 'kill')
                 db.set('action_kibra', 'none')
                 logging.info('Killing all tasks...')
+                await scheduler.stop()
 
         db.set('status_kibra', 'stopped')
         logging.info('All tasks have now stopped.')
@@ -77,10 +67,13 @@ async def _master():
 def main():
     global SERVER
 
+    # Restarts the log writer thread after daemonizing
+    klog.setup()
     logging.info('Launching KiBRA v%s' % kibra.__version__)
 
     # Load database
     db.load()
+    klog.refresh_levels()
 
     # Exterior network configuration
     global_netconfig()
@@ -104,13 +97,24 @@ def main():
     if db.get('bbr_enable'):
         TASKS.append(COAPSERVER())
 
+    # Fails here, before running the loop, if the tasks dependencies have a
+    # cycle or an unknown task
+    scheduler = Scheduler(TASKS)
+    mdns_scheduler = Scheduler([mdns])
+
     # Launch mDNS already
-    asyncio.ensure_future(mdns.run())
+    asyncio.ensure_future(mdns_scheduler.start())
+
+    # All the NCP commands go through this channel from now on
+    asyncio.ensure_future(SERIAL_CHANNEL.run())
+
+    # Watch for code blocking the event loop
+    loopmon.start()
 
     if db.get('autostart') == 1:
         db.set('action_kibra', 'start')
 
-    asyncio.ensure_future(_master())
+    asyncio.ensure_future(_master(scheduler))
 
     asyncio.get_event_loop().run_forever()
 
@@ -128,19 +132,11 @@ if __name__ == '__main__':
     parser.add_argument(
         '--clear', required=False, action='store_true', help='clear topology'
     )
-    parser.add_argument(
-        '--version', action='version', version='%s' % kibra.__version__
-    )
+    parser.add_argument('--version', action='version', version='%s' % kibra.__version__)
     args = parser.parse_args()
 
     # Configure logging
-    # TODO: log file folder might not exist
-    logging.basicConfig(
-        level=logging.INFO,
-        format='\r%(asctime)s - %(levelname)s [%(module)s]: %(message)s',
-        filename=db.LOG_FILE,
-        filemode='w',
-    )
+    klog.setup()
 
     if args.form:
         topology.form_topology()
@@ -3,6 +3,7 @@ import datetime
 import ipaddress
 import json
 import logging
+import math
 import os
 import socket
 import struct
@@ -12,6 +13,7 @@ import aiocoap
 import aiocoap.resource as resource
 import kibra
 import kibra.database as db
+import kibra.metrics as metrics
 import kibra.thread as THREAD
 from aiocoap.numbers.codes import Code
 from aiocoap.numbers.types import Type
@@ -37,6 +39,32 @@ INFINITE_TIMESTAMP = 0
 DUA_LIMIT = 768
 MULTICAST_LIMIT = 768
 
+# Status is the DMStatus of the response, none for notifications and error
+# for requests that failed before a response
+REQUESTS = metrics.Counter(
+    'kibra_coap_requests_total', 'CoAP requests received', ('uri', 'status')
+)
+metrics.Gauge(
+    'kibra_dua_entries',
+    'Registered DUAs',
+    lambda: len(DUA_HNDLR.entries) if DUA_HNDLR else 0,
+)
+metrics.Gauge(
+    'kibra_dua_dad_in_progress',
+    'DUAs with an ongoing duplicate address detection',
+    lambda: sum(entry.dad for entry in DUA_HNDLR.entries) if DUA_HNDLR else 0,
+)
+metrics.Gauge(
+    'kibra_mlr_entries',
+    'Registered multicast addresses',
+    lambda: len(MCAST_HNDLR.maddrs) if MCAST_HNDLR else 0,
+)
+metrics.Gauge(
+    'kibra_mfc_routes',
+    'Multicast routes installed in the kernel',
+    lambda: len(MCAST_HNDLR.mcrouter.mcroutes) if MCAST_HNDLR else 0,
+)
+
 
 class CoapServer:
     '''CoAP Server'''
@@ -198,6 +226,7 @@ class MulticastHandler:
             db.set('maddrs_perm', maddrs_perm)
 
     def reg_periodic(self):
+        '''Remove the expired addresses, return the seconds until the next expiry'''
         now = datetime.datetime.now().timestamp()
         rem_list = [
             addr
@@ -206,6 +235,8 @@ class MulticastHandler:
         ]
         for addr in rem_list:
             self.addr_remove(addr)
+        expiries = [tout for tout in self.maddrs.values() if tout != INFINITE_TIMESTAMP]
+        return min(expiries) - now if expiries else None
 
 
 class Res_N_MR(resource.Resource):
@@ -239,6 +270,14 @@ class Res_N_MR(resource.Resource):
         return status, good_addrs, bad_addrs
 
     async def render_post(self, request):
+        status = 'error'
+        try:
+            status, response = await self._register(request)
+            return response
+        finally:
+            REQUESTS.inc(URI.N_MR, status)
+
+    async def _register(self, request):
         status = DMStatus.ST_UNSPEC
         good_addrs = []
         bad_addrs = []
@@ -328,7 +367,7 @@ class Res_N_MR(resource.Resource):
                 t=TLV.A_IPV6_ADDRESSES, l=16 * len(bad_addrs), v=bytes(addrs_payload)
             ).array()
         logging.info('out %s rsp: %s' % (URI.N_MR, ThreadTLV.sub_tlvs_str(out_pload)))
-        return aiocoap.Message(code=Code.CHANGED, payload=out_pload)
+        return status, aiocoap.Message(code=Code.CHANGED, payload=out_pload)
 
 
 class DUAHandler:
@@ -530,6 +569,14 @@ class Res_N_DR(resource.Resource):
     '''DUA registration, Thread 1.2 5.23'''
 
     async def render_post(self, request):
+        status = 'error'
+        try:
+            status, response = await self._register(request)
+            return response
+        finally:
+            REQUESTS.inc(URI.N_DR, status)
+
+    async def _register(self, request):
         req_dua = None
         status = DMStatus.ST_UNSPEC
 
@@ -579,7 +626,7 @@ class Res_N_DR(resource.Resource):
                     db.set('dua_next_status', '')
                     # DUA-TC-17 step 48
                     if status == 500:
-                        return aiocoap.Message(code=Code.INTERNAL_SERVER_ERROR)
+                        return status, aiocoap.Message(code=Code.INTERNAL_SERVER_ERROR)
                 elif DUA_HNDLR.reg_update(src_rloc, eid, dua, elapsed):
                     status = DMStatus.ST_SUCESS
                 else:
@@ -591,7 +638,7 @@ class Res_N_DR(resource.Resource):
         if req_dua:
             payload += ThreadTLV(t=TLV.A_TARGET_EID, l=16, v=req_dua).array()
         logging.info('out %s rsp: %s' % (URI.N_DR, ThreadTLV.sub_tlvs_str(payload)))
-        return aiocoap.Message(code=Code.CHANGED, payload=payload)
+        return status, aiocoap.Message(code=Code.CHANGED, payload=payload)
 
 
 class Res_B_BMR(resource.Resource):
@@ -602,6 +649,7 @@ class Res_B_BMR(resource.Resource):
         logging.info(
             'in %s ntf: %s' % (URI.B_BMR, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.B_BMR, 'none')
 
         # Primary BBR shouldn't receive this message
         if not 'secondary' in db.get('bbr_status'):
@@ -634,6 +682,7 @@ class Res_B_BQ(resource.Resource):
         logging.info(
             'in %s qry: %s' % (URI.B_BQ, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.B_BQ, 'none')
 
         # Message not handled by Secondary BBR
         if not 'primary' in db.get('bbr_status'):
@@ -690,6 +739,7 @@ class Res_B_BA_uni(resource.Resource):
         logging.info(
             'in %s ans: %s' % (URI.B_BA, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.B_BA, 'none')
 
         # Message not handled by Secondary BBR
         if not 'primary' in db.get('bbr_status'):
@@ -755,6 +805,7 @@ class Res_B_BA_multi(resource.Resource):
         logging.info(
             'in %s ans: %s' % (URI.B_BA, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.B_BA, 'none')
 
         # Message not handled by Secondary BBR
         if not 'primary' in db.get('bbr_status'):
@@ -808,6 +859,7 @@ class Res_A_AQ(resource.Resource):
         logging.info(
             'in %s qry: %s' % (URI.A_AQ, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.A_AQ, 'none')
 
         # Message not handled by Secondary BBR
         if not 'primary' in db.get('bbr_status'):
@@ -844,6 +896,7 @@ class Res_A_AE(resource.Resource):
         logging.info(
             'in %s ntf: %s' % (URI.A_AE, ThreadTLV.sub_tlvs_str(request.payload))
         )
+        REQUESTS.inc(URI.A_AE, 'none')
 
         # Message not handled by Secondary BBR
         if not 'primary' in db.get('bbr_status'):
@@ -890,6 +943,7 @@ class COAPSERVER(Ktask):
             start_tasks=['serial', 'network', 'syslog'],
             stop_tasks=[],
             period=1,
+            watch_keys=['ncp_rloc', 'bbr_status', 'mlr_cache'],
         )
 
     def kstart(self):
@@ -995,7 +1049,7 @@ class COAPSERVER(Ktask):
 
     async def periodic(self):
 
-        MCAST_HNDLR.reg_periodic()
+        next_expiry = MCAST_HNDLR.reg_periodic()
 
         # Keept track of RLOC changes
         current_ncp_rloc = db.get('ncp_rloc')
@@ -1010,6 +1064,9 @@ class COAPSERVER(Ktask):
                 self._launch_servers()
             self.last_bbr_status = current_bbr_status
 
+        # Nothing else to do until a registration expires or a key changes
+        return math.inf if next_expiry is None else next_expiry
+
     def _launch_servers(self):
         # Find running servers
         running_addrs = []
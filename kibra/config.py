@@ -0,0 +1,100 @@
+'''
+Daemon configuration files, compared by hash with the installed ones so that
+they are only written, and their daemons restarted, when something changed
+'''
+import hashlib
+import logging
+import os
+import re
+import shutil
+
+import kibra.metrics as metrics
+from kibra.shell import bash
+
+CHANGES = metrics.Counter(
+    'kibra_config_changes_total', 'Configuration files changed', ('daemon',)
+)
+AVOIDED = metrics.Counter(
+    'kibra_config_restarts_avoided_total',
+    'Daemon restarts or reloads not needed, the configuration was the same',
+    ('daemon',),
+)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def read(file_path):
+    '''Installed text of a file, None if it does not exist'''
+    try:
+        with open(file_path) as file_:
+            return file_.read()
+    except FileNotFoundError:
+        return None
+
+
+def write(file_path, text):
+    '''Replace the file at once, a daemon never reads half of it'''
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file_:
+        file_.write(text)
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def remove_block(file_path, start_patt, end_patt):
+    '''
+    Remove the text between two patterns, including the patterns, and return
+    True if the file had to be written
+    '''
+    text = read(file_path)
+    if text is None:
+        return False
+    new_text = re.sub(r'%s(.*?)%s' % (start_patt, end_patt), '', text, flags=re.DOTALL)
+    if new_text == text:
+        return False
+    write(file_path, new_text)
+    return True
+
+
+class ConfigFile:
+    '''A configuration file and the commands that make its daemon use it'''
+
+    def __init__(self, daemon, file_path, commands):
+        self.daemon = daemon
+        self.file_path = file_path
+        self.commands = commands
+
+    def _apply(self, changed, apply):
+        if not changed:
+            AVOIDED.inc(self.daemon)
+            return False
+        CHANGES.inc(self.daemon)
+        if apply:
+            logging.info('Applying the new %s configuration.', self.daemon)
+            for command in self.commands:
+                bash(command)
+        return True
+
+    def update(self, text, apply=True):
+        '''Install the text, and apply it if it changed. True if it did'''
+        installed = read(self.file_path)
+        changed = installed is None or text_hash(installed) != text_hash(text)
+        if changed:
+            write(self.file_path, text)
+        return self._apply(changed, apply)
+
+    def remove_block(self, start_patt, end_patt, apply=True):
+        '''Remove a block of the file, and apply it if it was there'''
+        changed = remove_block(self.file_path, start_patt, end_patt)
+        return self._apply(changed, apply)
+
+    def delete(self, apply=True):
+        '''Remove the file, and apply it if it existed'''
+        changed = os.path.exists(self.file_path)
+        if changed:
+            os.remove(self.file_path)
+        return self._apply(changed, apply)
@@ -6,6 +6,8 @@ from collections import OrderedDict
 from threading import RLock
 
 import kibra
+import kibra.metrics as metrics
+from kibra.config import remove_block
 from kibra.thread import DEFS
 
 DEF_COMMCRED = 'KIRALE'
@@ -19,6 +21,12 @@ CFG = {}
 # User configuration read from file
 CFG_USER = {}
 
+# Key: functions called with the key when its value changes
+LISTENERS = {}
+
+SETS = metrics.Counter('kibra_db_sets_total', 'Database values set')
+SAVES = metrics.Counter('kibra_db_saves_total', 'Configuration file writes')
+
 MUTEX = RLock()
 
 DB_ITEMS_TYPE = 0
@@ -51,6 +59,8 @@ DB_ITEMS = {
     'bridging_mark': [int, None, lambda x: True, False, False],
     'bridging_table': [str, None, lambda x: True, False, False],
     'dhcp_aloc': [str, None, lambda x: True, False, False],
+    'dhcp_embedded': [int, 0, lambda x: x in (0, 1), True, True],
+    'dns_embedded': [int, 0, lambda x: x in (0, 1), True, True],
     'dua_next_status': [str, '', lambda x: True, False, False],  # Thread Harness
     'dua_next_status_eid': [str, '', lambda x: True, False, False],  # Thread Harness
     'exterior_ifname': [str, None, lambda x: True, False, False],
@@ -72,9 +82,18 @@ DB_ITEMS = {
         False,
         False,
     ],
+    'log_level': [
+        str,
+        'INFO',
+        lambda x: x in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+        True,
+        True,
+    ],
+    'log_levels': [dict, '{}', lambda x: True, True, True],  # Per module
     'maddrs_perm': [list, '[]', lambda x: True, True, True],
     'mcast_admin_fwd': [int, 1, lambda x: x in (0, 1), True, True],
     'mcast_out_fwd': [int, 1, lambda x: x in (0, 1), True, True],
+    'mdns_responder': [int, 0, lambda x: x in (0, 1), True, True],
     'mlr_cache': [dict, '{}', lambda x: True, False, False],
     'mlr_next_status': [str, '', lambda x: True, False, False],  # Thread Harness
     'mlr_timeout': [
@@ -156,14 +175,32 @@ def get(key):
 
 def set(key, value):
     value = str(value)
+    changed = False
     with MUTEX:
         # Only save if value has changed
         if key not in CFG or CFG[key] is not value:
+            changed = CFG.get(key) != value
             CFG[key] = value
+            SETS.inc()
             logging.debug('Saving %s as %s.', key, value)
             # If the item is flagged as persistent, save to disk
             if DB_ITEMS[key][DB_ITEMS_PERS]:
                 save()
+    if changed:
+        for callback in LISTENERS.get(key, []):
+            callback(key)
+
+
+def subscribe(key, callback):
+    '''Call callback(key), from the setting thread, when the key value changes'''
+    LISTENERS.setdefault(key, []).append(callback)
+
+
+def unsubscribe(key, callback):
+    try:
+        LISTENERS[key].remove(callback)
+    except (KeyError, ValueError):
+        pass
 
 
 def delete(key):
@@ -229,6 +266,7 @@ def save():
                     config[key] = CFG[key]
         if os.path.isfile(CFG_FILE):
             logging.debug('Saving configuration file %s', CFG_FILE)
+            SAVES.inc()
             config = json.dumps(OrderedDict(sorted(config.items())), indent=2)
             with open(CFG_FILE, 'w') as file_:
                 file_.write(config + '\n')
@@ -247,12 +285,4 @@ def find_in_file(file, prev_patt, follow_patt):
 def del_from_file(file, start_patt, end_patt):
     ''' For a given file, remove a text between two patterns,
     including the patterns'''
-    if os.path.isfile(file):
-        with open(file, 'r+') as file_:
-            data = file_.read()
-            data = re.sub(
-                r'%s(.*?)%s' % (start_patt, end_patt), '', data, flags=re.DOTALL
-            )
-            file_.seek(0)
-            file_.truncate()
-            file_.write(data)
+    return remove_block(file, start_patt, end_patt)
@@ -1,13 +1,52 @@
+import asyncio
+import heapq
+import ipaddress
+import json
+import logging
+import math
+import os
+import threading
 import time
+import xml.etree.ElementTree
 from struct import pack
 
 import kibra.database as db
+import kibra.metrics as metrics
 import kitools
+from kibra.config import ConfigFile
+from kibra.dhcpd import (
+    OPT_DNS_SERVERS,
+    OPT_NTP_SERVER,
+    DhcpServer,
+    LeaseLog,
+    duid_ll,
+)
 from kibra.ktask import Ktask
 from kibra.shell import bash
 
 DHCP_CONFIG = '/etc/dibbler/server.conf'
 DHCP_DAEMON = 'dibbler-server'
+DHCP_LEASES = '/var/lib/dibbler/server-AddrMgr.xml'
+# Seconds to wait for more address changes before reconfiguring the server
+DHCP_DEBOUNCE = 0.5
+
+# Lease log of the embedded server, in the configuration directory
+DHCP_LEASE_LOG = 'dhcp_leases.log'
+# Preferred and valid lifetime of the leases in seconds
+DHCP_LIFETIME = 86400
+
+# dibbler-server has no reload signal, a new configuration needs a restart
+DHCP_FILE = ConfigFile(
+    'dibbler', DHCP_CONFIG, [DHCP_DAEMON + ' stop', DHCP_DAEMON + ' start']
+)
+# Embedded server, when used instead of dibbler
+SERVER = None
+
+metrics.Gauge(
+    'kibra_dhcp_leases',
+    'Valid leases of the embedded DHCPv6 server',
+    lambda: len(SERVER.leases.by_duid) if SERVER else 0,
+)
 
 
 def ntp_server_opt(addr):
@@ -19,53 +58,186 @@ def ntp_server_opt(addr):
     return ':'.join([hex(byte).replace('0x', '').zfill(2) for byte in b_pload])
 
 
+def render_config():
+    '''Server configuration for this NCP, the same text for the same inputs'''
+    lines = []
+    lines.append('')
+    lines.append('iface ' + db.get('interior_ifname') + ' {')
+    if db.get('dhcp_aloc'):
+        # The server has to be restarted to listen on a new ALOC
+        lines.append('\t# DHCPv6 Agent ALOC ' + db.get('dhcp_aloc'))
+    lines.append('\tclient-max-lease 1')
+    lines.append('\tunicast ' + db.get('ncp_rloc'))
+    lines.append('\trapid-commit yes')
+    lines.append('\toption ntp-server ' + db.get('ncp_mleid'))
+    lines.append('\toption dns-server ' + db.get('ncp_mleid'))
+    lines.append('\tpreference 255')
+    lines.append('\tclass {')
+    lines.append('\t\tT1 0')
+    lines.append('\t\tT2 0')
+    lines.append('\t\tpreferred-lifetime 86400')
+    lines.append('\t\tvalid-lifetime 86400')
+    lines.append('\t\tpool ' + db.get('prefix'))
+    lines.append('\t}')
+    lines.append('}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
 def dhcp_server_start():
+    '''(Re)start the server if its configuration changed, True if it did'''
     # Don't start if DHCP is not to be used
     if not db.get('prefix_dhcp'):
-        return
+        return False
 
-    # Stop DHCP daemon
-    bash(DHCP_DAEMON + ' stop')
-    # Remove previous configuration for this NCP
-    db.del_from_file(DHCP_CONFIG, '\niface %s' % db.get('interior_ifname'), '\n}\n')
-    # Add new configuration
-    with open(DHCP_CONFIG, 'w') as file_:
-        file_.write('\n')
-        file_.write('iface ' + db.get('interior_ifname') + ' {\n')
-        file_.write('\tclient-max-lease 1\n')
-        file_.write('\tunicast ' + db.get('ncp_rloc') + '\n')
-        file_.write('\trapid-commit yes\n')
-        file_.write('\toption ntp-server ' + db.get('ncp_mleid') + '\n')
-        file_.write('\toption dns-server ' + db.get('ncp_mleid') + '\n')
-        file_.write('\tpreference 255\n')
-        file_.write('\tclass {\n')
-        file_.write('\t\tT1 0\n')
-        file_.write('\t\tT2 0\n')
-        file_.write('\t\tpreferred-lifetime 86400\n')
-        file_.write('\t\tvalid-lifetime 86400\n')
-        file_.write('\t\tpool ' + db.get('prefix') + '\n')
-        file_.write('\t}\n')
-        file_.write('}\n')
-    # Allow for the file to be stored
-    time.sleep(0.2)
-    # Start DHCP daemon
-    bash(DHCP_DAEMON + ' start')
-
-
-def dhcp_server_stop():
+    return DHCP_FILE.update(render_config())
+
+
+def dhcp_server_stop(apply=True):
     # Don't stop if DHCP is not to be used
     if not db.get('prefix_dhcp'):
         return
-        
-    # Stop DHCP daemon
-    bash(DHCP_DAEMON + ' stop')
+
     # Remove previous configuration for this NCP
-    db.del_from_file(DHCP_CONFIG, '\niface %s' % db.get('interior_ifname'), '\n}\n')
-    # Allow for the file to be stored
-    time.sleep(0.2)
+    DHCP_FILE.remove_block(
+        '\niface %s' % db.get('interior_ifname'), '\n}\n', apply=apply
+    )
+
+
+def embedded_server_configure():
+    '''Apply the current addresses to the embedded server, no restart needed'''
+    SERVER.configure(
+        db.get('prefix'),
+        DHCP_LIFETIME,
+        DHCP_LIFETIME,
+        options={
+            OPT_DNS_SERVERS: ipaddress.IPv6Address(db.get('ncp_mleid')).packed,
+            OPT_NTP_SERVER: bytes.fromhex(
+                ntp_server_opt(db.get('ncp_mleid')).replace(':', '')
+            ),
+        },
+        unicast=db.get('ncp_rloc'),
+    )
+
 
-    # Start DHCP daemon
-    bash(DHCP_DAEMON + ' start')
+def embedded_server_start():
+    global SERVER
+
+    # Don't start if DHCP is not to be used
+    if not db.get('prefix_dhcp'):
+        return
+
+    SERVER = DhcpServer(
+        db.get('interior_ifnumber'),
+        duid_ll(db.get('interior_mac')),
+        LeaseLog(db.CFG_PATH + DHCP_LEASE_LOG),
+    )
+    embedded_server_configure()
+    SERVER.start()
+
+
+def embedded_server_stop():
+    global SERVER
+
+    if SERVER:
+        SERVER.stop()
+        SERVER = None
+
+
+def leases_dump():
+    '''JSON view of the active leases of the server in use'''
+    if SERVER:
+        return SERVER.leases.dump()
+    return LEASES_DB.dump()
+
+
+class LeaseIndex:
+    '''
+    Active DHCP server leases, the file is only parsed again when its
+    modification time or size changes
+    '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.mutex = threading.Lock()
+        self.stamp = None
+        # DUID: {address: expiration ms}
+        self.leases = {}
+        # (expiration ms, DUID, address), soonest first
+        self.expiry = []
+        self.cached = None
+
+    def _parse(self, ifname):
+        self.leases = {}
+        self.expiry = []
+        root = None
+        for event, elem in xml.etree.ElementTree.iterparse(
+            self.file_path, events=('start', 'end')
+        ):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == 'AddrIA':
+                duid = elem.find('duid')
+                if elem.get('ifacename') == ifname and duid is not None:
+                    for addr in elem.iter('AddrAddr'):
+                        expires = 1000 * (
+                            int(addr.get('timestamp')) + int(addr.get('valid'))
+                        )
+                        self.leases.setdefault(duid.text, {})[addr.text] = expires
+                        self.expiry.append((expires, duid.text, addr.text))
+            elif elem.tag == 'AddrClient':
+                # Keep memory flat, parsed clients are no longer needed
+                root.clear()
+        heapq.heapify(self.expiry)
+
+    def _refresh(self):
+        ifname = db.get('interior_ifname')
+        try:
+            stat = os.stat(self.file_path)
+            stamp = (stat.st_mtime_ns, stat.st_size, ifname)
+        except OSError:
+            stamp = None
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.cached = None
+            try:
+                self._parse(ifname)
+            except (OSError, ValueError, TypeError, xml.etree.ElementTree.ParseError):
+                # Incomplete file, try again when it changes
+                self.leases = {}
+                self.expiry = []
+                if stamp:
+                    logging.warning('Unable to parse %s.', self.file_path)
+        # Drop the expired leases
+        now = 1000 * time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, duid, addr = heapq.heappop(self.expiry)
+            addrs = self.leases.get(duid, {})
+            if addrs.get(addr) == expires:
+                del addrs[addr]
+                if not addrs:
+                    del self.leases[duid]
+            self.cached = None
+
+    def as_dict(self):
+        leases = []
+        for duid, addrs in self.leases.items():
+            for addr, expires in addrs.items():
+                leases.append({'duid': duid, 'expires': expires, 'gua': addr})
+        return {'leases': leases}
+
+    def dump(self):
+        '''JSON view of the active leases'''
+        with self.mutex:
+            self._refresh()
+            if self.cached is None:
+                self.cached = json.dumps(self.as_dict(), indent=2)
+            return self.cached
+
+
+LEASES_DB = LeaseIndex(DHCP_LEASES)
 
 
 class DHCP(Ktask):
@@ -77,10 +249,34 @@ class DHCP(Ktask):
             stop_keys=['interior_ifname'],
             start_tasks=['network', 'serial'],
             period=2,
+            watch_keys=['prefix', 'ncp_rloc', 'ncp_mleid', 'dhcp_aloc'],
         )
 
-    def kstart(self):
-        dhcp_server_start()
+    async def kstart(self):
+        # The daemon commands take seconds, keep them off the event loop
+        loop = asyncio.get_event_loop()
+        if db.get('dhcp_embedded'):
+            # Both servers would use the same port. Without the old
+            # configuration, a later switch back starts dibbler again
+            await loop.run_in_executor(None, dhcp_server_stop, False)
+            await loop.run_in_executor(None, bash, DHCP_DAEMON + ' stop')
+            embedded_server_start()
+        else:
+            await loop.run_in_executor(None, dhcp_server_start)
+
+    async def kstop(self):
+        if SERVER:
+            embedded_server_stop()
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, dhcp_server_stop)
 
-    def kstop(self):
-        dhcp_server_stop()
+    async def periodic(self):
+        if SERVER:
+            embedded_server_configure()
+            return math.inf
+        # Let a burst of address changes settle into one reconfiguration
+        await asyncio.sleep(DHCP_DEBOUNCE)
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(None, dhcp_server_start):
+            logging.info('DHCPv6 server reconfigured.')
+        return math.inf
@@ -0,0 +1,376 @@
+'''Embedded DHCPv6 server for the interior interface (RFC 8415, stateful IA_NA)'''
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import socket
+import struct
+import time
+from threading import RLock
+
+import kibra.metrics as metrics
+
+SERVER_PORT = 547
+CLIENT_PORT = 546
+ALL_DHCP_AGENTS = 'ff02::1:2'
+
+# Message types
+SOLICIT = 1
+ADVERTISE = 2
+REQUEST = 3
+RENEW = 5
+REBIND = 6
+REPLY = 7
+RELEASE = 8
+INFORMATION_REQUEST = 11
+MSG_NAMES = {
+    SOLICIT: 'solicit',
+    REQUEST: 'request',
+    RENEW: 'renew',
+    REBIND: 'rebind',
+    RELEASE: 'release',
+    INFORMATION_REQUEST: 'information_request',
+}
+
+# Options
+OPT_CLIENTID = 1
+OPT_SERVERID = 2
+OPT_IA_NA = 3
+OPT_IAADDR = 5
+OPT_ORO = 6
+OPT_PREFERENCE = 7
+OPT_UNICAST = 12
+OPT_STATUS_CODE = 13
+OPT_RAPID_COMMIT = 14
+OPT_DNS_SERVERS = 23
+OPT_NTP_SERVER = 56
+
+STATUS_SUCCESS = 0
+STATUS_NO_ADDRS_AVAIL = 2
+
+# Seconds an address offered in an Advertise is kept for the client
+OFFER_TIME = 60
+# Attempts to find a free address for a client in the pool
+ALLOC_ATTEMPTS = 16
+# Largest datagram to read
+MAX_SIZE = 1500
+
+# Lease log record: operation, DUID length, IAID, address, expiration time
+# and the DUID padded to its maximum length (RFC 8415 section 11.1)
+LOG_RECORD = struct.Struct('!BBI16sd128s')
+LOG_LEASE = 1
+LOG_RELEASE = 2
+# The log is rewritten with the live leases when it has this many times more
+# records, and at least LOG_COMPACT_MIN
+LOG_COMPACT_FACTOR = 4
+LOG_COMPACT_MIN = 1024
+
+TRANSACTIONS = metrics.Counter(
+    'kibra_dhcp_transactions_total', 'DHCPv6 messages answered', ('type',)
+)
+
+
+def duid_ll(mac):
+    '''DUID based on the link-layer address, for Ethernet'''
+    return struct.pack('!HH', 3, 1) + bytes.fromhex(mac.replace(':', ''))
+
+
+def option(code, value=b''):
+    return struct.pack('!HH', code, len(value)) + value
+
+
+def parse_options(data, offset=0, end=None):
+    '''Code: list of option values'''
+    options = {}
+    end = len(data) if end is None else end
+    while offset + 4 <= end:
+        code, length = struct.unpack_from('!HH', data, offset)
+        offset += 4
+        options.setdefault(code, []).append(data[offset : offset + length])
+        offset += length
+    return options
+
+
+class LeaseLog:
+    '''
+    Leases kept in memory by DUID and address, and persisted in an append-only
+    log of fixed size records, so it can be replayed from a memory map
+    '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # Held to change the leases, which the web server reads from a worker
+        self.mutex = RLock()
+        # DUID: (IAID, address, expiration time)
+        self.by_duid = {}
+        # Address: DUID
+        self.by_addr = {}
+        self.records = 0
+        self._replay()
+        self.fd = os.open(file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _replay(self):
+        try:
+            with open(self.file_path, 'rb') as file_:
+                size = os.fstat(file_.fileno()).st_size
+                if size < LOG_RECORD.size:
+                    return
+                with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # A partial record at the end was an interrupted write
+                    for offset in range(0, size - LOG_RECORD.size + 1, LOG_RECORD.size):
+                        op, length, iaid, addr, expires, duid = LOG_RECORD.unpack_from(
+                            data, offset
+                        )
+                        self._apply(op, duid[:length], iaid, addr, expires)
+                        self.records += 1
+        except FileNotFoundError:
+            return
+        self.expire()
+        logging.info(
+            'Loaded %d DHCPv6 leases from %d records.', len(self.by_duid), self.records
+        )
+
+    def _apply(self, op, duid, iaid, addr, expires):
+        with self.mutex:
+            old = self.by_duid.pop(duid, None)
+            if old and self.by_addr.get(old[1]) == duid:
+                del self.by_addr[old[1]]
+            if op == LOG_LEASE:
+                self.by_duid[duid] = (iaid, addr, expires)
+                self.by_addr[addr] = duid
+
+    def _append(self, op, duid, iaid, addr, expires):
+        os.write(self.fd, LOG_RECORD.pack(op, len(duid), iaid, addr, expires, duid))
+        self.records += 1
+        self._apply(op, duid, iaid, addr, expires)
+        if self.records > LOG_COMPACT_FACTOR * max(len(self.by_duid), LOG_COMPACT_MIN):
+            self.compact()
+
+    def lease(self, duid, iaid, addr, expires):
+        self._append(LOG_LEASE, duid, iaid, addr, expires)
+
+    def release(self, duid):
+        if duid in self.by_duid:
+            iaid, addr, _ = self.by_duid[duid]
+            self._append(LOG_RELEASE, duid, iaid, addr, 0)
+
+    def owner(self, addr, now):
+        '''DUID holding a valid lease of the address'''
+        duid = self.by_addr.get(addr)
+        if duid is not None and self.by_duid[duid][2] > now:
+            return duid
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        for duid, (_, addr, expires) in list(self.by_duid.items()):
+            if expires <= now:
+                self._apply(LOG_RELEASE, duid, 0, addr, 0)
+
+    def compact(self):
+        '''Rewrite the log with the valid leases only'''
+        self.expire()
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'wb') as file_:
+            for duid, (iaid, addr, expires) in self.by_duid.items():
+                file_.write(
+                    LOG_RECORD.pack(LOG_LEASE, len(duid), iaid, addr, expires, duid)
+                )
+        os.replace(tmp_path, self.file_path)
+        os.close(self.fd)
+        self.fd = os.open(self.file_path, os.O_WRONLY | os.O_APPEND)
+        self.records = len(self.by_duid)
+
+    def close(self):
+        os.close(self.fd)
+
+    def as_dict(self):
+        now = time.time()
+        leases = []
+        with self.mutex:
+            items = list(self.by_duid.items())
+        for duid, (_, addr, expires) in items:
+            if expires > now:
+                leases.append(
+                    {
+                        'duid': ':'.join('%02x' % byte for byte in duid),
+                        'expires': int(1000 * expires),
+                        'gua': ipaddress.IPv6Address(addr).compressed,
+                    }
+                )
+        return {'leases': leases}
+
+    def dump(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+
+class DhcpServer:
+    '''
+    Stateful DHCPv6 server with one address per client from a pool prefix,
+    answering Solicit (with or without Rapid Commit), Request, Renew, Rebind,
+    Release and Information-request messages
+    '''
+
+    def __init__(self, ifindex, duid, leases):
+        self.ifindex = ifindex
+        self.duid = duid
+        self.leases = leases
+        self.loop = asyncio.get_event_loop()
+        self.sock = None
+        self.pool = None
+        self.preferred = 0
+        self.valid = 0
+        # Option code: value, sent when requested
+        self.options = {}
+        self.unicast = None
+
+    def configure(self, prefix, preferred, valid, options=None, unicast=None):
+        '''Pool prefix, lifetimes, extra options and server unicast address'''
+        self.pool = ipaddress.IPv6Network(prefix, strict=False)
+        self.preferred = preferred
+        self.valid = valid
+        self.options = options or {}
+        self.unicast = unicast and ipaddress.IPv6Address(unicast).packed
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('::', SERVER_PORT))
+        self.sock.setsockopt(
+            socket.IPPROTO_IPV6,
+            socket.IPV6_JOIN_GROUP,
+            socket.inet_pton(socket.AF_INET6, ALL_DHCP_AGENTS)
+            + struct.pack('@I', self.ifindex),
+        )
+        self.sock.setblocking(False)
+        self.loop.add_reader(self.sock, self._read)
+        logging.info('DHCPv6 server serving %s.', self.pool)
+
+    def stop(self):
+        if self.sock:
+            self.loop.remove_reader(self.sock)
+            self.sock.close()
+            self.sock = None
+        self.leases.close()
+
+    def _read(self):
+        try:
+            data, addr = self.sock.recvfrom(MAX_SIZE)
+        except OSError:
+            return
+        reply = self.handle(data)
+        if reply:
+            try:
+                self.sock.sendto(reply, addr)
+            except OSError as exc:
+                logging.warning('DHCPv6 reply to %s failed: %s', addr[0], exc)
+
+    def _allocate(self, duid, now):
+        '''Address for the client, its current one if still in the pool'''
+        lease = self.leases.by_duid.get(duid)
+        if lease and ipaddress.IPv6Address(lease[1]) in self.pool:
+            return lease[1]
+        hostmask = int(self.pool.hostmask)
+        base = int(self.pool.network_address)
+        seed = hashlib.sha256(duid).digest()
+        for attempt in range(ALLOC_ATTEMPTS):
+            iid = int.from_bytes(seed[attempt : attempt + 8], 'big') & hostmask
+            if not iid:
+                continue
+            addr = ipaddress.IPv6Address(base | iid).packed
+            if self.leases.owner(addr, now) in (None, duid):
+                return addr
+        return None
+
+    def _ia_na(self, duid, ia_na, commit, now):
+        '''IA_NA option with the client address, committing the lease'''
+        iaid = ia_na[:4]
+        requested = [
+            value[:16]
+            for value in parse_options(ia_na, 12).get(OPT_IAADDR, [])
+            if len(value) >= 24
+        ]
+        addr = self._allocate(duid, now)
+        if addr is None:
+            status = option(
+                OPT_STATUS_CODE,
+                struct.pack('!H', STATUS_NO_ADDRS_AVAIL) + b'No addresses available',
+            )
+            return option(OPT_IA_NA, iaid + struct.pack('!II', 0, 0) + status)
+        iaid_value = struct.unpack('!I', iaid)[0]
+        if commit:
+            self.leases.lease(duid, iaid_value, addr, now + self.valid)
+        elif self.leases.owner(addr, now) != duid:
+            # Reserved for a while for the Request that should follow
+            self.leases.lease(duid, iaid_value, addr, now + OFFER_TIME)
+        value = iaid + struct.pack('!II', 0, 0)
+        value += option(
+            OPT_IAADDR, addr + struct.pack('!II', self.preferred, self.valid)
+        )
+        # Addresses no longer valid for the client
+        for old in requested:
+            if old != addr:
+                value += option(OPT_IAADDR, old + struct.pack('!II', 0, 0))
+        return option(OPT_IA_NA, value)
+
+    def handle(self, data, now=None):
+        '''Reply to a client message, None if it has to be ignored'''
+        try:
+            return self._handle(data, now)
+        except (IndexError, ValueError, struct.error) as exc:
+            logging.debug('Malformed DHCPv6 message dropped: %s', exc)
+            return None
+
+    def _handle(self, data, now):
+        if len(data) < 4 or data[0] not in MSG_NAMES or self.pool is None:
+            return None
+        msg_type = data[0]
+        options = parse_options(data, 4)
+        client_id = options.get(OPT_CLIENTID, [None])[0]
+        server_id = options.get(OPT_SERVERID, [None])[0]
+        if msg_type in (SOLICIT, REBIND):
+            if not client_id or server_id is not None:
+                return None
+        elif msg_type in (REQUEST, RENEW, RELEASE):
+            if not client_id or server_id != self.duid:
+                return None
+        elif server_id is not None and server_id != self.duid:
+            return None
+        now = time.time() if now is None else now
+        TRANSACTIONS.inc(MSG_NAMES[msg_type])
+        # IAID, T1 and T2 are needed before any address option
+        ia_nas = [ia_na for ia_na in options.get(OPT_IA_NA, []) if len(ia_na) >= 12]
+
+        reply_type = REPLY
+        reply = b''
+        if client_id:
+            reply += option(OPT_CLIENTID, client_id)
+        reply += option(OPT_SERVERID, self.duid)
+        if msg_type == SOLICIT:
+            rapid = OPT_RAPID_COMMIT in options
+            if rapid:
+                reply += option(OPT_RAPID_COMMIT)
+            else:
+                reply_type = ADVERTISE
+            reply += option(OPT_PREFERENCE, b'\xff')
+            for ia_na in ia_nas:
+                reply += self._ia_na(client_id, ia_na, rapid, now)
+        elif msg_type in (REQUEST, RENEW, REBIND):
+            for ia_na in ia_nas:
+                reply += self._ia_na(client_id, ia_na, True, now)
+        elif msg_type == RELEASE:
+            self.leases.release(client_id)
+            reply += option(
+                OPT_STATUS_CODE, struct.pack('!H', STATUS_SUCCESS) + b'Released'
+            )
+
+        if self.unicast and msg_type != INFORMATION_REQUEST:
+            reply += option(OPT_UNICAST, self.unicast)
+        requested = b''.join(options.get(OPT_ORO, []))
+        for offset in range(0, len(requested) - 1, 2):
+            code = struct.unpack_from('!H', requested, offset)[0]
+            if code in self.options:
+                reply += option(code, self.options[code])
+        return bytes([reply_type]) + data[1:4] + reply
@@ -1,11 +1,16 @@
-import copy
+import asyncio
+import collections
 import ipaddress
+import json
 import logging
+import random
 import time
+from threading import RLock
 
 import kibra
 import kibra.database as db
 import kibra.iptables as IPTABLES
+import kibra.metrics as metrics
 import kibra.network as NETWORK
 import kibra.thread as THREAD
 from kibra.coapclient import CoapClient
@@ -23,15 +28,350 @@ PET_DIAGS = ThreadTLV(t=THREAD.TLV.D_TYPE_LIST, l=len(VALUES), v=VALUES).array()
 
 NODE_INACTIVE_MS = 90000
 
-DIAGS_DB = {}
+# Maximum number of DIAG_GET requests in flight, kept low for the 125 kbps link
+CRAWL_WINDOW = 4
+# Seconds to wait for each node response, and retries after a timeout
+CRAWL_TIMEOUT = 6
+CRAWL_RETRIES = 1
+# Bounds for the pacing between consecutive requests, in seconds
+CRAWL_GAP_MIN = 0.05
+CRAWL_GAP_MAX = 1.0
+
+# Number of node changes remembered for incremental readers
+CHANGELOG_LEN = 1024
+
+# Crawler of the diagnostics task, read by the gauges
+CRAWLER = None
+
+SWEEPS = metrics.Counter('kibra_diags_sweeps_total', 'Diagnostics sweeps')
+TIMEOUTS = metrics.Counter(
+    'kibra_diags_timeouts_total',
+    'Diagnostics requests without a response in time, retries included',
+)
+RESPONSE = metrics.Histogram(
+    'kibra_diags_response_seconds', 'Response time of the nodes to DIAG_GET'
+)
+metrics.Gauge(
+    'kibra_diags_window',
+    'Maximum number of DIAG_GET requests in flight',
+    lambda: CRAWLER.window if CRAWLER else 0,
+)
+metrics.Gauge(
+    'kibra_diags_srtt_seconds',
+    'Smoothed response time used to pace the requests',
+    lambda: (CRAWLER.srtt or 0) if CRAWLER else 0,
+)
+metrics.Gauge(
+    'kibra_diags_sweep_seconds',
+    'Duration of the last sweep',
+    lambda: CRAWLER.stats['sweep_ms'] / 1000 if CRAWLER else 0,
+)
+metrics.Gauge(
+    'kibra_diags_sweep_nodes',
+    'Nodes queried in the last sweep',
+    lambda: CRAWLER.stats['sweep_nodes'] if CRAWLER else 0,
+)
+metrics.Gauge(
+    'kibra_diags_node_latency_seconds',
+    'Last response time of each node',
+    lambda: _latencies(),
+    ('rloc16',),
+)
 
 
 def _epoch_ms():
     return int(time.mktime(time.localtime()) * 1000)
 
 
+def _latencies():
+    if not CRAWLER:
+        return {}
+    return {
+        (rloc16,): latency / 1000
+        for rloc16, latency in CRAWLER.stats['latency_ms'].items()
+    }
+
+
+class NodeRecord:
+    '''Information about one Thread node, as seen by the diagnostics'''
+
+    __slots__ = (
+        'rloc16',
+        'id',
+        'roles',
+        'routes',
+        'addresses',
+        'children',
+        'timeout',
+        'internet_access',
+        'active',
+        'first_seen',
+        'last_seen',
+    )
+
+    # slot: JSON field
+    FIELDS = (
+        ('rloc16', 'rloc16'),
+        ('id', 'id'),
+        ('roles', 'roles'),
+        ('routes', 'routes'),
+        ('addresses', 'addresses'),
+        ('children', 'children'),
+        ('timeout', 'timeout'),
+        ('internet_access', 'internetAccess'),
+        ('active', 'active'),
+        ('first_seen', 'firstSeen'),
+        ('last_seen', 'lastSeen'),
+    )
+
+    def __init__(self, rloc16, roles, last_seen):
+        self.rloc16 = rloc16
+        self.id = None
+        self.roles = roles
+        self.routes = None
+        self.addresses = None
+        self.children = None
+        self.timeout = None
+        self.internet_access = None
+        self.active = 'yes'
+        self.first_seen = None
+        self.last_seen = last_seen
+
+    def same_as(self, other):
+        '''Compare the contents of two records, except for the seen times'''
+        for slot, _ in NodeRecord.FIELDS:
+            if slot in ('first_seen', 'last_seen'):
+                continue
+            if getattr(self, slot) != getattr(other, slot):
+                return False
+        return True
+
+    def as_dict(self):
+        node = {}
+        for slot, field in NodeRecord.FIELDS:
+            value = getattr(self, slot)
+            if value is not None:
+                node[field] = value
+        return node
+
+
+class NodeStore:
+    '''
+    Thread nodes indexed by RLOC16, with a log of the changes so that readers
+    can obtain only what changed since a given version. Versions restart when
+    the store is cleared, so they are only comparable within a generation.
+    '''
+
+    def __init__(self):
+        self.mutex = RLock()
+        # Functions called after every change, from the changing thread
+        self.listeners = []
+        self.clear()
+
+    def clear(self):
+        with self.mutex:
+            self.nodes = {}
+            self.generation = '%08x' % random.getrandbits(32)
+            self.version = 0
+            # (version, rloc16) for each change
+            self.changelog = collections.deque(maxlen=CHANGELOG_LEN)
+            self._notify()
+
+    def _changed(self, rloc16):
+        self.version += 1
+        self.changelog.append((self.version, rloc16))
+        self._notify()
+
+    def _notify(self):
+        for listener in list(self.listeners):
+            listener()
+
+    def update(self, record):
+        '''
+        Add or refresh a node, keeping its first seen time. Refreshing only the
+        last seen time is not logged as a change.
+        '''
+        with self.mutex:
+            old = self.nodes.get(record.rloc16)
+            if old:
+                record.first_seen = old.first_seen
+                unchanged = old.same_as(record)
+            else:
+                logging.info('New node! "%s"', record.rloc16)
+                record.first_seen = _epoch_ms()
+                unchanged = False
+            self.nodes[record.rloc16] = record
+            if not unchanged:
+                self._changed(record.rloc16)
+
+    def deactivate(self, rloc16):
+        with self.mutex:
+            node = self.nodes.get(rloc16)
+            if node and node.active == 'yes':
+                node.active = 'no'
+                self._changed(rloc16)
+
+    def inactive_since(self, timestamp):
+        '''Return the RLOC16 of the active nodes not seen after timestamp'''
+        with self.mutex:
+            return [
+                rloc16
+                for rloc16, node in self.nodes.items()
+                if node.active == 'yes' and node.last_seen < timestamp
+            ]
+
+    def changes_since(self, version):
+        '''
+        Return the nodes added, updated and removed (deactivated) after the
+        given version, or None if the log does not reach back that far
+        '''
+        with self.mutex:
+            if version > self.version:
+                return None
+            if version < self.version and (
+                not self.changelog or self.changelog[0][0] > version + 1
+            ):
+                return None
+            changed = []
+            for change_version, rloc16 in reversed(self.changelog):
+                if change_version <= version:
+                    break
+                changed.append(rloc16)
+            # Keep only the latest change of each node, in order
+            changed = list(collections.OrderedDict.fromkeys(changed))
+            result = {
+                'generation': self.generation,
+                'version': self.version,
+                'nodes': [],
+                'removed': [],
+            }
+            for rloc16 in reversed(changed):
+                node = self.nodes.get(rloc16)
+                if node is None or node.active != 'yes':
+                    result['removed'].append(rloc16)
+                else:
+                    result['nodes'].append(node.as_dict())
+            return result
+
+    def as_dict(self):
+        with self.mutex:
+            return {
+                'generation': self.generation,
+                'version': self.version,
+                'nodes': [node.as_dict() for node in self.nodes.values()],
+            }
+
+    def delta(self, since=None, generation=None):
+        '''
+        All the nodes, or only the changes after the given version of the same
+        generation if the change log allows it
+        '''
+        data = None
+        with self.mutex:
+            if since is not None and generation == self.generation:
+                data = self.changes_since(since)
+            if data is None:
+                data = self.as_dict()
+        return data
+
+    def dump(self, since=None, generation=None):
+        return json.dumps(self.delta(since, generation), separators=(',', ':'))
+
+
+DIAGS_DB = NodeStore()
+
+
+class DiagsCrawler:
+    '''Query a set of Thread nodes concurrently with a bounded window'''
+
+    def __init__(self, petitioner, window=CRAWL_WINDOW):
+        self.petitioner = petitioner
+        self.window = window
+        # Smoothed RTT (RFC 6298 style) used to pace the requests
+        self.srtt = None
+        self.next_tx = 0
+        self.pace_lock = asyncio.Lock()
+        self.stats = {
+            'sweeps': 0,
+            'sweep_ms': 0,
+            'sweep_nodes': 0,
+            'timeouts': 0,
+            'srtt_ms': 0,
+            'latency_ms': {},
+        }
+
+    def _gap(self):
+        '''Time between consecutive requests, derived from the observed RTT'''
+        if self.srtt is None:
+            return CRAWL_GAP_MIN
+        return min(CRAWL_GAP_MAX, max(CRAWL_GAP_MIN, self.srtt / self.window))
+
+    def _update_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.stats['srtt_ms'] = int(self.srtt * 1000)
+
+    async def _pace(self):
+        async with self.pace_lock:
+            delay = self.next_tx - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_tx = time.monotonic() + self._gap()
+
+    async def _query(self, rloc16, addr, sem):
+        async with sem:
+            for _ in range(1 + CRAWL_RETRIES):
+                await self._pace()
+                start = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(
+                        self.petitioner.con_request(
+                            addr, THREAD.DEFS.PORT_MM, THREAD.URI.D_DG, PET_DIAGS
+                        ),
+                        timeout=CRAWL_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    self.stats['timeouts'] += 1
+                    TIMEOUTS.inc()
+                    logging.debug('Diagnostics timeout for node %s.', rloc16)
+                    continue
+                if response:
+                    rtt = time.monotonic() - start
+                    self._update_rtt(rtt)
+                    RESPONSE.observe(rtt)
+                    self.stats['latency_ms'][rloc16] = int(rtt * 1000)
+                    return response
+            self.stats['latency_ms'].pop(rloc16, None)
+            return None
+
+    async def sweep(self, targets):
+        '''
+        Query all the targets ({rloc16: address}) and return a list of
+        (rloc16, response) tuples, response being None for silent nodes
+        '''
+        start = time.monotonic()
+        sem = asyncio.Semaphore(self.window)
+        rlocs = list(targets.keys())
+        responses = await asyncio.gather(
+            *[self._query(rloc16, targets[rloc16], sem) for rloc16 in rlocs]
+        )
+        sweep_time = time.monotonic() - start
+        self.stats['sweeps'] += 1
+        SWEEPS.inc()
+        self.stats['sweep_ms'] = int(sweep_time * 1000)
+        self.stats['sweep_nodes'] = len(rlocs)
+        logging.debug(
+            'Diagnostics sweep of %d nodes took %d ms.', len(rlocs), sweep_time * 1000
+        )
+        return list(zip(rlocs, responses))
+
+
 class DIAGS(Ktask):
     def __init__(self):
+        global CRAWLER
+
         Ktask.__init__(
             self,
             name='diags',
@@ -40,17 +380,18 @@ class DIAGS(Ktask):
             period=3,
         )
         self.petitioner = CoapClient()
+        self.crawler = CRAWLER = DiagsCrawler(self.petitioner)
         self.br_rloc16 = ''
         self.br_permanent_addr = ''
         self.br_internet_access = 'offline'
-        self.nodes_list = []
+        self.nodes_list = set()
         self.last_diags = []
         self.last_time = 0
 
     def kstart(self):
         ll_addr = ipaddress.IPv6Address(db.get('ncp_ll')).compressed
         self.br_permanent_addr = '%s%%%s' % (ll_addr, db.get('interior_ifname'))
-        DIAGS_DB['nodes'] = []
+        DIAGS_DB.clear()
         IPTABLES.handle_diag('I', db.get('ncp_rloc'))
 
     def kstop(self):
@@ -88,36 +429,36 @@ class DIAGS(Ktask):
             self.last_time = current_time
             self._parse_diags(response)
             # Update nodes info
+            targets = {}
             for rloc16 in self.nodes_list:
                 if rloc16 == self.br_rloc16:
                     continue
-                node_rloc = THREAD.get_rloc_from_short(db.get('ncp_prefix'), rloc16)
-                response = await self.petitioner.con_request(
-                    node_rloc, THREAD.DEFS.PORT_MM, THREAD.URI.D_DG, PET_DIAGS
+                targets[rloc16] = THREAD.get_rloc_from_short(
+                    db.get('ncp_prefix'), rloc16
                 )
-                self._parse_diags(response)
-                time.sleep(0.2)
+            for _, response in await self.crawler.sweep(targets):
+                if response:
+                    self._parse_diags(response)
             self._mark_old_nodes()
 
     def _parse_diags(self, tlvs):
         now = _epoch_ms()
-        json_node_info = {}
-        json_node_info['roles'] = []
-        json_node_info['routes'] = []
-        json_node_info['addresses'] = []
-        json_node_info['children'] = []
+        roles = []
         leader_rloc16 = None
 
         # Address16 TLV
         value = ThreadTLV.get_value(tlvs, THREAD.TLV.D_MAC_ADDRESS)
         if value:
-            json_node_info['rloc16'] = '%02x%02x' % (value[0], value[1])
+            node = NodeRecord('%02x%02x' % (value[0], value[1]), roles, now)
             if value[1] == 0:
-                json_node_info['roles'].append('router')
+                roles.append('router')
             else:
-                json_node_info['roles'].append('end-device')
+                roles.append('end-device')
         else:
             return
+        node.routes = []
+        node.addresses = []
+        node.children = []
 
         # Route 64 TLV
         value = ThreadTLV.get_value(tlvs, THREAD.TLV.D_ROUTE64)
@@ -134,16 +475,15 @@ class DIAGS(Ktask):
                 q_out = (router_quality & 0xC0) >> 6
                 q_in = (router_quality & 0x30) >> 4
                 cost = router_quality & 0x0F
-                if q_in is not 0 and q_out is not 0:
+                if q_in != 0 and q_out != 0:
                     json_router_info = {}
                     json_router_info['id'] = '%u' % router_id
                     json_router_info['target'] = '%04x' % (router_id << 10)
                     json_router_info['inCost'] = '%u' % q_in
-                    json_node_info['routes'].append(json_router_info)
-                    if json_router_info['target'] not in self.nodes_list:
-                        self.nodes_list.append(json_router_info['target'])
-                elif q_in is 0 and q_out is 0 and cost is 1:
-                    json_node_info['id'] = '%u' % router_id
+                    node.routes.append(json_router_info)
+                    self.nodes_list.add(json_router_info['target'])
+                elif q_in == 0 and q_out == 0 and cost == 1:
+                    node.id = '%u' % router_id
 
         # Leader Data TLV
         value = ThreadTLV.get_value(tlvs, THREAD.TLV.D_LEADER_DATA)
@@ -158,69 +498,44 @@ class DIAGS(Ktask):
                 str_addr = ipaddress.IPv6Address(
                     int.from_bytes(addr, byteorder='big')
                 ).compressed
-                json_node_info['addresses'].append(str_addr)
+                node.addresses.append(str_addr)
 
-        # Now process child info, because json_node_info['rloc16'] is needed
+        # Now process child info, because the node RLOC16 is needed
         # Child Table TLV
         value = ThreadTLV.get_value(tlvs, THREAD.TLV.D_CHILD_TABLE)
         if value:
+            rloc_high = bytearray.fromhex(node.rloc16)[0]
             children = [value[i : i + 3] for i in range(0, len(value), 3)]
             for child in children:
                 json_child_info = {}
-                rloc_high = bytearray.fromhex(json_node_info['rloc16'])[0]
-                rloc_high |= child[0] & 0x01
-                json_child_info['rloc16'] = '%02x%02x' % (rloc_high, child[1])
+                json_child_info['rloc16'] = '%02x%02x' % (
+                    rloc_high | (child[0] & 0x01),
+                    child[1],
+                )
                 json_child_info['timeout'] = '%u' % (
                     child[0] >> 3
                 )  # TODO: convert to seconds
-                json_node_info['children'].append(json_child_info)
+                node.children.append(json_child_info)
 
         # Update other informations
-        if leader_rloc16 and json_node_info['rloc16'] in leader_rloc16:
-            json_node_info['roles'].append('leader')
-        if json_node_info['rloc16'] in self.br_rloc16:
-            json_node_info['roles'].append('border-router')
-            json_node_info['internetAccess'] = self.br_internet_access
-        json_node_info['active'] = 'yes'
-        json_node_info['lastSeen'] = now
+        if node.rloc16 == leader_rloc16:
+            roles.append('leader')
+        if node.rloc16 == self.br_rloc16:
+            roles.append('border-router')
+            node.internet_access = self.br_internet_access
 
         # Add node to database
-        self._add_node(json_node_info)
+        logging.debug('Updated data for node %s.', node.rloc16)
+        DIAGS_DB.update(node)
 
         # Add children to database
-        for child in json_node_info['children']:
-            independent_child = copy.deepcopy(child)
-            independent_child['roles'] = ['end-device']
-            independent_child['active'] = 'yes'
-            independent_child['lastSeen'] = now
-            self._add_node(independent_child)
-
-    def _add_node(self, json_node_info):
-        logging.debug('Updated data for node %s.', json_node_info['rloc16'])
-        # Find previous node data
-        for index, node in enumerate(DIAGS_DB['nodes']):
-            if node['rloc16'] in json_node_info['rloc16']:
-                # Retrieve firstSeen
-                if 'firstSeen' in node:
-                    json_node_info['firstSeen'] = node['firstSeen']
-                # Remove old data
-                DIAGS_DB['nodes'].pop(index)
-        # Set firstSeen
-        if 'firstSeen' not in json_node_info:
-            logging.info('New node! "%s"', json_node_info['rloc16'])
-            json_node_info['firstSeen'] = _epoch_ms()
-        # Set new data
-        DIAGS_DB['nodes'].append(json_node_info)
+        for child in node.children:
+            independent_child = NodeRecord(child['rloc16'], ['end-device'], now)
+            independent_child.timeout = child['timeout']
+            DIAGS_DB.update(independent_child)
 
     def _mark_old_nodes(self):
-        now = _epoch_ms()
-        for i, node in enumerate(DIAGS_DB['nodes']):
-            if node['active'] is 'yes':
-                if now - node['lastSeen'] > NODE_INACTIVE_MS:
-                    logging.info('Node %s became inactive.', node['rloc16'])
-                    # Remove from database
-                    DIAGS_DB['nodes'][i]['active'] = 'no'
-                    # Remove from nodes_list
-                    self.nodes_list = [
-                        n for n in self.nodes_list if n not in node['rloc16']
-                    ]
+        for rloc16 in DIAGS_DB.inactive_since(_epoch_ms() - NODE_INACTIVE_MS):
+            logging.info('Node %s became inactive.', rloc16)
+            DIAGS_DB.deactivate(rloc16)
+            self.nodes_list.discard(rloc16)
@@ -1,12 +1,52 @@
-from time import sleep
-
 import kibra.database as db
-import kitools
+from kibra.config import ConfigFile
+from kibra.dnsd import Dns64Server
 from kibra.ktask import Ktask
-from kibra.shell import bash
+from kibra.nat import NAT64_PREFIX
 
 DNS_CONFIG = '/etc/unbound/unbound.conf'
 DNS_DAEMON = 'unbound'
+DNS_FILE = ConfigFile(DNS_DAEMON, DNS_CONFIG, ['service %s restart' % DNS_DAEMON])
+
+# Built-in forwarder, when used instead of Unbound
+SERVER = None
+
+
+def render_config():
+    lines = []
+    lines.append('')
+    lines.append('server:')
+    lines.append('    interface: %s' % db.get('ncp_mleid'))
+    lines.append('    access-control: ::/0 allow')
+    lines.append('    module-config: "dns64 validator iterator"')
+    lines.append('    dns64-prefix: %s' % NAT64_PREFIX)
+    lines.append('    dns64-synthall: yes')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _unbound_stop():
+    # Remove previous configuration for this NCP
+    DNS_FILE.remove_block('\nserver:', '\n    dns64-synthall: yes\n')
+
+
+def _embedded_start():
+    global SERVER
+
+    SERVER = Dns64Server(NAT64_PREFIX)
+    try:
+        SERVER.start(db.get('ncp_mleid'))
+    except BaseException:
+        # Release the sockets already bound, Unbound may be used next time
+        _embedded_stop()
+        raise
+
+
+def _embedded_stop():
+    global SERVER
+
+    SERVER.stop()
+    SERVER = None
 
 
 class DNS(Ktask):
@@ -25,22 +65,13 @@ class DNS(Ktask):
         if not db.get('prefix_dhcp'):
             return
 
-        # Stop DNS daemon
-        bash('service %s stop' % DNS_DAEMON)
-        # Remove previous configuration
-        db.del_from_file(DNS_CONFIG, '\nserver:', '\n    dns64-synthall: yes\n')
-        # Add new configuration
-        with open(DNS_CONFIG, 'w') as file_:
-            file_.write('\nserver:')
-            file_.write('\n    interface: %s' % db.get('ncp_mleid'))
-            file_.write('\n    access-control: ::/0 allow')
-            file_.write('\n    module-config: "dns64 validator iterator"')
-            file_.write('\n    dns64-prefix: 64:ff9b::/96')
-            file_.write('\n    dns64-synthall: yes\n')
-        # Allow for the file to be stored
-        sleep(0.2)
-        # Start DNS daemon
-        bash('service %s start' % DNS_DAEMON)
+        if db.get('dns_embedded'):
+            # Unbound must not listen on the same address
+            _unbound_stop()
+            _embedded_start()
+        else:
+            # Restart the DNS daemon only with a new configuration
+            DNS_FILE.update(render_config())
 
     def kstop(self):
         # Don't stop if DHCP is not to be used
@@ -48,11 +79,7 @@ class DNS(Ktask):
             return
 
         # TODO: https://www.claudiokuenzler.com/blog/694/get-unbount-dns-lookups-resolution-working-ubuntu-16.04-xenial
-        # Stop DNS daemon
-        bash('service %s stop' % DNS_DAEMON)
-        # Remove previous configuration for this NCP
-        db.del_from_file(DNS_CONFIG, '\nserver:', '\n    dns64-synthall: yes\n')
-        # Allow for the file to be stored
-        sleep(0.2)
-        # Start DNS daemon
-        bash('service %s start' % DNS_DAEMON)
+        if SERVER:
+            _embedded_stop()
+        else:
+            _unbound_stop()
@@ -0,0 +1,477 @@
+'''Built-in DNS64 forwarder (RFC 6147) with a response cache'''
+import asyncio
+import collections
+import ipaddress
+import logging
+import os
+import random
+import socket
+import struct
+import time
+
+import kibra.metrics as metrics
+from kibra.mdnsd import pack_name, unpack_name
+
+DNS_PORT = 53
+RESOLV_CONF = '/etc/resolv.conf'
+# Seconds between checks of the upstream servers file
+RESOLV_CHECK = 5
+
+# Resource record types
+T_A = 1
+T_CNAME = 5
+T_SOA = 6
+T_AAAA = 28
+T_DNAME = 39
+T_OPT = 41
+C_IN = 1
+
+# Header flags and response codes
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+OPCODE_MASK = 0x7800
+RCODE_MASK = 0x000F
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+# Responses kept in the cache
+CACHE_SIZE = 1024
+# Longest TTL cached, in seconds
+MAX_TTL = 86400
+# TTL of negative answers without an SOA record, and longest one (RFC 2308)
+NEGATIVE_TTL = 60
+MAX_NEGATIVE_TTL = 900
+# Seconds to wait for an upstream server before trying the next one
+UPSTREAM_TIMEOUT = 2
+# UDP payload size announced in the queries for A records
+UPSTREAM_SIZE = 1232
+# Largest response accepted without EDNS (RFC 1035)
+CLASSIC_SIZE = 512
+MAX_SIZE = 65535
+# Synthesize AAAA records also for names that have them, as dns64-synthall
+SYNTHALL = True
+
+QUERIES = metrics.Counter(
+    'kibra_dns_queries_total', 'DNS queries answered by result', ('result',)
+)
+UPSTREAM = metrics.Histogram(
+    'kibra_dns_upstream_seconds', 'Response time of the upstream DNS servers'
+)
+
+Question = collections.namedtuple('Question', 'name qtype qclass end')
+# offset is the position of the TTL in the message
+Rr = collections.namedtuple('Rr', 'name rtype rclass ttl offset rdata')
+Message = collections.namedtuple('Message', 'id flags question answers authority extra')
+
+
+def _lower(labels):
+    return tuple(label.lower() for label in labels)
+
+
+def parse(data):
+    '''Message with one question, raises ValueError if it is malformed'''
+    try:
+        id_, flags, qdcount, ancount, nscount, arcount = struct.unpack_from(
+            '!HHHHHH', data
+        )
+        if qdcount != 1:
+            raise ValueError('One question expected')
+        name, offset = unpack_name(data, 12)
+        qtype, qclass = struct.unpack_from('!HH', data, offset)
+        offset += 4
+        question = Question(name, qtype, qclass, offset)
+        sections = []
+        for count in (ancount, nscount, arcount):
+            section = []
+            for _ in range(count):
+                rname, offset = unpack_name(data, offset)
+                rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+                rdata = data[offset + 10 : offset + 10 + length]
+                # Names in the rdata may point anywhere in the message
+                if rtype in (T_CNAME, T_DNAME):
+                    rdata = pack_name(unpack_name(data, offset + 10)[0])
+                elif rtype == T_SOA:
+                    mname, end = unpack_name(data, offset + 10)
+                    rname_, end = unpack_name(data, end)
+                    rdata = pack_name(mname) + pack_name(rname_) + data[end : end + 20]
+                section.append(Rr(rname, rtype, rclass, ttl, offset + 4, rdata))
+                offset += 10 + length
+            sections.append(section)
+        if offset > len(data):
+            raise ValueError('Truncated message')
+    except (IndexError, struct.error) as exc:
+        raise ValueError('Malformed message') from exc
+    return Message(id_, flags, question, *sections)
+
+
+def payload_size(msg):
+    '''Largest response the sender of a query accepts'''
+    for rr in msg.extra:
+        if rr.rtype == T_OPT:
+            return max(rr.rclass, CLASSIC_SIZE)
+    return CLASSIC_SIZE
+
+
+def message_ttl(msg):
+    '''Seconds a response can be cached, None if it should not be'''
+    rcode = msg.flags & RCODE_MASK
+    if msg.flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return None
+    answers = [rr for rr in msg.answers if rr.rtype != T_OPT]
+    if rcode == RCODE_NOERROR and answers:
+        return min(min(rr.ttl for rr in answers), MAX_TTL)
+    # Negative answer, NXDOMAIN or no data (RFC 2308 section 5)
+    for rr in msg.authority:
+        if rr.rtype == T_SOA and len(rr.rdata) >= 20:
+            minimum = struct.unpack('!I', rr.rdata[-4:])[0]
+            return min(rr.ttl, minimum, MAX_NEGATIVE_TTL)
+    return NEGATIVE_TTL
+
+
+def embed_ipv4(prefix, addr):
+    '''IPv4-embedded IPv6 address as RFC 6052 section 2.2'''
+    data = prefix.network_address.packed[: prefix.prefixlen // 8] + addr
+    if len(data) < 16:
+        # Bits 64 to 71 are always zero
+        data = data[:8] + b'\0' + data[8:]
+    return data.ljust(16, b'\0')
+
+
+def read_upstreams(file_path=RESOLV_CONF):
+    '''Name server addresses of a resolv.conf file'''
+    servers = []
+    try:
+        with open(file_path) as file_:
+            for line in file_:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    # The same text as the source address of the responses
+                    try:
+                        servers.append(str(ipaddress.ip_address(fields[1])))
+                    except ValueError:
+                        servers.append(fields[1])
+    except OSError as exc:
+        logging.warning('Unable to read the DNS servers: %s', exc)
+    return servers
+
+
+class DnsCache:
+    '''Responses by question, least recently used first, with their TTLs'''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        # key: (expiry, store time, response, [(TTL offset, TTL)])
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, now):
+        '''Cached response with the TTLs reduced by its age, or None'''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expiry, stored, data, ttls = entry
+        if now >= expiry:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        age = int(now - stored)
+        if not age:
+            return data
+        data = bytearray(data)
+        for offset, ttl in ttls:
+            struct.pack_into('!I', data, offset, max(ttl - age, 0))
+        return bytes(data)
+
+    def put(self, key, data, msg, now):
+        ttl = message_ttl(msg)
+        if not ttl:
+            return
+        ttls = [
+            (rr.offset, rr.ttl)
+            for rr in msg.answers + msg.authority + msg.extra
+            if rr.rtype != T_OPT
+        ]
+        self.entries[key] = (now + ttl, now, data, ttls)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Dns64Server:
+    '''
+    Forward the queries to the upstream servers and synthesize the AAAA records
+    of the names with A records, using the NAT64 prefix. Identical queries in
+    flight share one upstream query.
+    '''
+
+    def __init__(self, prefix, upstreams=None, cache_size=CACHE_SIZE):
+        self.prefix = ipaddress.IPv6Network(prefix)
+        if self.prefix.prefixlen not in (32, 40, 48, 56, 64, 96):
+            raise ValueError('Invalid NAT64 prefix length %d' % self.prefix.prefixlen)
+        self.loop = asyncio.get_event_loop()
+        self.cache = DnsCache(cache_size)
+        # Fixed servers, or read from resolv.conf when None
+        self.fixed = upstreams
+        self.upstreams = []
+        self.resolv_check = None
+        self.resolv_mtime = None
+        # Cache key: future of the response
+        self.inflight = {}
+        # (server, query id): future of the response
+        self.pending = {}
+        self.sock = None
+        self.clients = {}
+        self.local = set()
+
+    def _socket(self, family, addr):
+        sock = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.bind(addr)
+        sock.setblocking(False)
+        return sock
+
+    def start(self, addr, port=DNS_PORT):
+        family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+        self.sock = self._socket(family, (addr, port))
+        self.loop.add_reader(self.sock, self._read)
+        # Upstream sockets with a random source port each
+        for family in (socket.AF_INET6, socket.AF_INET):
+            any_addr = '::' if family == socket.AF_INET6 else '0.0.0.0'
+            sock = self._socket(family, (any_addr, 0))
+            self.loop.add_reader(sock, self._read_upstream, sock)
+            self.clients[family] = sock
+        # Never forward to ourselves
+        self.local = {addr}
+        logging.info('DNS64 server started on [%s]:%d.', addr, port)
+        return self.sock.getsockname()[1]
+
+    def stop(self):
+        for sock in [self.sock] + list(self.clients.values()):
+            if sock:
+                self.loop.remove_reader(sock)
+                sock.close()
+        self.sock = None
+        self.clients = {}
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+
+    def _servers(self):
+        if self.fixed is not None:
+            return self.fixed
+        now = time.monotonic()
+        if self.resolv_check is None or now - self.resolv_check >= RESOLV_CHECK:
+            self.resolv_check = now
+            try:
+                mtime = os.stat(RESOLV_CONF).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.resolv_mtime:
+                self.resolv_mtime = mtime
+                self.upstreams = [
+                    (addr, DNS_PORT)
+                    for addr in read_upstreams()
+                    if addr not in self.local
+                ]
+                logging.info(
+                    'DNS64 upstream servers: %s',
+                    ', '.join(addr for addr, _ in self.upstreams) or 'none',
+                )
+        return self.upstreams
+
+    def _read(self):
+        try:
+            data, addr = self.sock.recvfrom(MAX_SIZE)
+        except OSError:
+            return
+        query = self.lookup(data)
+        if query is None:
+            return
+        msg, key, response = query
+        if response is None:
+            self.loop.create_task(self._answer(data, addr, msg, key))
+        else:
+            # Cached responses are sent without scheduling a task
+            self._send(response, addr)
+
+    def _read_upstream(self, sock):
+        try:
+            data, addr = sock.recvfrom(MAX_SIZE)
+        except OSError:
+            return
+        if len(data) < 12:
+            return
+        future = self.pending.pop(((addr[0], addr[1]), data[:2]), None)
+        if future and not future.done():
+            future.set_result(data)
+
+    async def _answer(self, data, addr, msg, key):
+        self._send(await self.resolve(data, msg, key), addr)
+
+    def _send(self, response, addr):
+        if self.sock:
+            try:
+                self.sock.sendto(response, addr)
+            except OSError as exc:
+                logging.debug('DNS response to %s failed: %s', addr[0], exc)
+
+    def lookup(self, data):
+        '''
+        Parsed query, cache key and cached response (None if not cached) of a
+        query, None if it has to be ignored
+        '''
+        try:
+            msg = parse(data)
+        except ValueError:
+            return None
+        if msg.flags & (FLAG_QR | OPCODE_MASK):
+            return None
+        question = msg.question
+        key = (_lower(question.name), question.qtype, question.qclass)
+        key += (payload_size(msg),)
+
+        response = self.cache.get(key, time.monotonic())
+        if response is not None:
+            QUERIES.inc('cached')
+            response = data[:2] + response[2:]
+        return msg, key, response
+
+    async def resolve(self, data, msg, key):
+        '''Response to a query not in the cache'''
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.loop.create_future()
+            self.inflight[key] = future
+            try:
+                result, response = await self._resolve(data, msg, key[-1])
+                self.cache.put(key, response, parse(response), time.monotonic())
+                future.set_result((result, response))
+            except Exception as exc:
+                future.set_exception(exc)
+            finally:
+                # Cancelled, the other queries for the same key must not hang
+                if not future.done():
+                    future.cancel()
+                del self.inflight[key]
+        try:
+            result, response = await asyncio.shield(future)
+        except (OSError, ValueError, asyncio.TimeoutError) as exc:
+            logging.debug('DNS query failed: %s', exc)
+            QUERIES.inc('failed')
+            return self._failure(data, msg)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            logging.debug('DNS query failed: the resolution was cancelled')
+            QUERIES.inc('failed')
+            return self._failure(data, msg)
+        QUERIES.inc(result)
+        return data[:2] + response[2:]
+
+    async def _resolve(self, data, msg, size):
+        '''Result name and response to a query'''
+        question = msg.question
+        if question.qtype != T_AAAA or question.qclass != C_IN:
+            return 'forwarded', await self._query(data, question.end)
+        if not SYNTHALL:
+            response = await self._query(data, question.end)
+            rsp = parse(response)
+            if rsp.flags & RCODE_MASK != RCODE_NOERROR or any(
+                rr.rtype == T_AAAA for rr in rsp.answers
+            ):
+                return 'forwarded', response
+        query = self._a_query(question.name)
+        rsp = parse(await self._query(query, len(query) - 11))
+        if not SYNTHALL and not any(rr.rtype == T_A for rr in rsp.answers):
+            # No data for either type
+            return 'forwarded', response
+        return 'synthesized', self._synthesize(data, msg, rsp, size)
+
+    @staticmethod
+    def _a_query(name):
+        '''Recursive query for the A records of a name, with EDNS'''
+        data = struct.pack('!HHHHHH', 0, FLAG_RD, 1, 0, 0, 1)
+        data += pack_name(name) + struct.pack('!HH', T_A, C_IN)
+        # OPT record: root name, payload size, no extended flags
+        data += b'\0' + struct.pack('!HHIH', T_OPT, UPSTREAM_SIZE, 0, 0)
+        return data
+
+    async def _query(self, data, end):
+        '''Response of the first upstream server that answers'''
+        servers = self._servers()
+        if not servers:
+            raise OSError('No upstream DNS servers')
+        for server in servers:
+            family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+            sock = self.clients.get(family)
+            if sock is None:
+                continue
+            # Responses are matched by server, port and a random ID
+            id_ = struct.pack('!H', random.getrandbits(16))
+            while (server, id_) in self.pending:
+                id_ = struct.pack('!H', random.getrandbits(16))
+            future = self.loop.create_future()
+            self.pending[(server, id_)] = future
+            start = time.monotonic()
+            try:
+                sock.sendto(id_ + data[2:], server)
+                response = await asyncio.wait_for(future, UPSTREAM_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as exc:
+                logging.debug('DNS server %s did not answer: %s', server[0], exc)
+                continue
+            finally:
+                self.pending.pop((server, id_), None)
+            UPSTREAM.observe(time.monotonic() - start)
+            # The question has to be the one sent
+            if response[12:end].lower() == data[12:end].lower():
+                return response
+        raise asyncio.TimeoutError('No upstream DNS server answered')
+
+    def _synthesize(self, data, msg, rsp, size):
+        '''AAAA response to a query from the response for the A records'''
+        question = msg.question
+        records = []
+        for rr in rsp.answers:
+            if rr.rtype == T_A and len(rr.rdata) == 4:
+                records.append(
+                    (rr.name, T_AAAA, rr.ttl, embed_ipv4(self.prefix, rr.rdata))
+                )
+            elif rr.rtype in (T_CNAME, T_DNAME):
+                records.append((rr.name, rr.rtype, rr.ttl, rr.rdata))
+        # Keep the SOA record for the negative caching of the clients
+        authority = [
+            (rr.name, rr.rtype, rr.ttl, rr.rdata)
+            for rr in rsp.authority
+            if rr.rtype == T_SOA and not records
+        ]
+        flags = FLAG_QR | FLAG_RA | (msg.flags & FLAG_RD) | (rsp.flags & RCODE_MASK)
+        qname = _lower(question.name)
+        while True:
+            response = struct.pack(
+                '!HHHHHH', msg.id, flags, 1, len(records), len(authority), 0
+            )
+            response += data[12 : question.end]
+            for name, rtype, ttl, rdata in records + authority:
+                # Names equal to the question point to it
+                if _lower(name) == qname:
+                    response += b'\xc0\x0c'
+                else:
+                    response += pack_name(name)
+                response += struct.pack('!HHIH', rtype, C_IN, ttl, len(rdata)) + rdata
+            if len(response) <= size or not records:
+                return response
+            # Truncated, the client should retry over TCP
+            records.pop()
+            flags |= FLAG_TC
+
+    @staticmethod
+    def _failure(data, msg):
+        flags = FLAG_QR | FLAG_RA | (msg.flags & FLAG_RD) | RCODE_SERVFAIL
+        return (
+            data[:2]
+            + struct.pack('!HHHHH', flags, 1, 0, 0, 0)
+            + data[12 : msg.question.end]
+        )
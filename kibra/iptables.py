@@ -2,6 +2,7 @@ import ipaddress
 import logging
 
 import kibra.database as db
+import kibra.nat as NAT
 from kibra.shell import bash
 from kibra.thread import DEFS
 
@@ -178,7 +179,6 @@ def handle_bagent_fwd(ext_addr, int_addr, enable=True):
         is_ipv4 = True
     except:
         is_ipv4 = False
-    jool_action = 'add' if enable else 'remove'
     ipt_action = 'I' if enable else 'D'
     ipt_bin = IPTM if is_ipv4 else IP6TM
     ext_ifame = db.get('exterior_ifname')
@@ -186,10 +186,10 @@ def handle_bagent_fwd(ext_addr, int_addr, enable=True):
     int_port = db.get('bagent_port')
     brdg_mark = db.get('bridging_mark')
 
-    # NAT 4 -> 6
+    # NAT 4 -> 6, applied with the rest of the Jool changes
     if is_ipv4:
-        params = (jool_action, ext_addr, ext_port, int_addr, int_port)
-        bash('jool bib %s %s#%s %s#%s --udp' % params)
+        ipv6 = '%s#%s' % (int_addr, int_port)
+        NAT.handle_bib('UDP', ipv6, '%s#%s' % (ext_addr, ext_port), enable)
     # NAT 6 -> 6
     else:
         params = (IP6TN, ipt_action, ext_ifame, ext_addr, ext_port, int_addr, int_port)
@@ -0,0 +1,172 @@
+'''Non-blocking logging pipeline with a rotating log file'''
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+import kibra.database as db
+import kibra.metrics as metrics
+
+LOG_FORMAT = '\r%(asctime)s - %(levelname)s [%(module)s]: %(message)s'
+# Rotate the log file at this size, keeping some previous files
+LOG_MAX_BYTES = 4 * 1024 * 1024
+LOG_BACKUPS = 3
+# Records waiting to be written, newer records are dropped when full
+LOG_QUEUE_SIZE = 10000
+
+# Database entries with the log levels
+LEVEL_KEYS = ('log_level', 'log_levels')
+
+HANDLER = None
+LEVELS = None
+LISTENER = None
+SETUP_PID = None
+
+metrics.Gauge(
+    'kibra_log_dropped_records', 'Log records lost with a full queue', lambda: dropped()
+)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''Queue handler that never blocks, counting the records it drops'''
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+        self.reported = 0
+
+    def prepare(self, record):
+        # Records stay in this process and only reach this handler, so there is
+        # no need for a formatted copy, just freeze the message arguments
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        # Let the log reader know that something is missing
+        if self.reported != self.dropped:
+            lost = self.dropped - self.reported
+            self.reported = self.dropped
+            warning = logging.makeLogRecord(
+                {
+                    'msg': '%d log records were dropped.' % lost,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'module': 'klog',
+                }
+            )
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                pass
+
+
+class QueueWriter(logging.handlers.QueueListener):
+    '''Queue listener that can be stopped with a full queue'''
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class ModuleLevelFilter(logging.Filter):
+    '''
+    Minimum level per module, from the database entries log_level (default)
+    and log_levels ({"module": "LEVEL"}), applied as soon as they change
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.default = logging.INFO
+        self.levels = {}
+        self.refresh()
+
+    def refresh(self, key=None):
+        try:
+            default = _level(db.get('log_level') or 'INFO')
+            levels = {
+                module: _level(name)
+                for module, name in (db.get('log_levels') or {}).items()
+            }
+        except Exception:
+            # Keep the previous levels for malformed values
+            return
+        self.default, self.levels = default, levels
+        # Let the root logger discard earlier what no module needs
+        logging.getLogger().setLevel(min([default] + list(levels.values())))
+
+    def filter(self, record):
+        return record.levelno >= self.levels.get(record.module, self.default)
+
+
+def _level(name):
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError('Unknown log level %s' % name)
+    return level
+
+
+def refresh_levels():
+    '''Apply the log levels of a configuration loaded after setup()'''
+    if LEVELS:
+        LEVELS.refresh()
+
+
+def dropped():
+    '''Number of records lost because the queue was full'''
+    return HANDLER.dropped if HANDLER else 0
+
+
+def setup():
+    '''
+    Route all the logging through a queue, so that callers never wait for the
+    disk. Can be called again after forking to restart the writer thread.
+    '''
+    global HANDLER, LEVELS, LISTENER, SETUP_PID
+
+    if SETUP_PID == os.getpid():
+        return
+    SETUP_PID = os.getpid()
+
+    # TODO: log file folder might not exist
+    file_handler = logging.handlers.RotatingFileHandler(
+        db.LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS
+    )
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    # Every run starts with an empty log file, keeping the previous ones
+    if os.path.getsize(db.LOG_FILE):
+        file_handler.doRollover()
+
+    if LEVELS:
+        for key in LEVEL_KEYS:
+            db.unsubscribe(key, LEVELS.refresh)
+    # Sets the root logger level too
+    LEVELS = ModuleLevelFilter()
+    for key in LEVEL_KEYS:
+        db.subscribe(key, LEVELS.refresh)
+
+    HANDLER = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    HANDLER.addFilter(LEVELS)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(HANDLER)
+
+    LISTENER = QueueWriter(HANDLER.queue, file_handler)
+    LISTENER.start()
+    atexit.register(stop)
+
+
+def stop():
+    '''Write the pending records'''
+    global LISTENER
+
+    if LISTENER:
+        LISTENER.stop()
+        LISTENER = None
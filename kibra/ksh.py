@@ -1,12 +1,17 @@
+import asyncio
+import concurrent.futures
+import itertools
 import logging
 import os
 import struct
 import sys
+import threading
 import time
 
 import importlib_resources
 import kibra
 import kibra.database as db
+import kibra.metrics as metrics
 import kibra.network as NETWORK
 from kibra.ktask import Ktask
 from kibra.shell import bash
@@ -15,20 +20,172 @@ from kibra.tlv import ThreadTLV
 from kitools import kidfu, kifwu, kiserial
 
 NCP_FW_FOLDER = 'kibra.ncp_fw'
+# Command priorities, lower values are sent first
+PRIO_BBR = 0
+PRIO_NORMAL = 1
+# Seconds to wait for a command response, including the time in the queue
+SERIAL_TIMEOUT = 10
+
+# NCP settings in the order they are applied: database key, KiNOS parameter,
+# quoted value
+NCP_SETTINGS = [
+    ('ncp_emac', 'emac', False),
+    ('ncp_outband', 'outband', False),
+    ('ncp_xpanid', 'xpanid', False),
+    ('ncp_netkey', 'mkey', False),
+    ('ncp_prefix', 'mlprefix', False),
+    ('ncp_channel', 'channel', False),
+    ('ncp_panid', 'panid', False),
+    ('ncp_netname', 'netname', True),
+    ('ncp_commcred', 'commcred', True),
+    ('ncp_role', 'role', False),
+]
 
 SERIAL_DEV = None
+# Last known NCP settings, parameter: value
+NCP_STATE = {}
+# Serializes the access to the device between the channel and send_cmd
+SERIAL_LOCK = threading.Lock()
 
+COMMANDS = metrics.Counter(
+    'kibra_serial_commands_total', 'NCP commands by result', ('result',)
+)
+LATENCY = metrics.Histogram(
+    'kibra_serial_seconds', 'NCP command latency, including the time in the queue'
+)
 
-def send_cmd(cmd, debug_level=None):
-    logging.info(cmd)
-    try:
-        resp = SERIAL_DEV.ksh_cmd(cmd, debug_level)
-    except:
-        logging.error('Device %s is not responding.', db.get('serial_device'))
+
+def _device_call(func, *args):
+    with SERIAL_LOCK:
+        return func(*args)
+
+
+def _ksh_cmd(cmd, debug_level=None):
+    with SERIAL_LOCK:
+        logging.info(cmd)
+        try:
+            resp = SERIAL_DEV.ksh_cmd(cmd, debug_level)
+        except Exception:
+            logging.error('Device %s is not responding.', db.get('serial_device'))
+            raise
     logging.info('\n'.join(resp))
     return resp
 
 
+class SerialChannel:
+    '''
+    Queue of commands for the KiNOS device, sent one at a time by a single
+    owner task so that the event loop never waits for the serial port
+    '''
+
+    def __init__(self):
+        self.loop = None
+        # Thread running the loop, to detect the calls made from it
+        self.thread_id = None
+        self.queue = None
+        self.sequence = itertools.count()
+        # The device is only used from this thread
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Command: {count, errors, timeouts, wait_ms, total_ms, max_ms}
+        self.stats = {}
+
+    def _stats(self, cmd):
+        return self.stats.setdefault(
+            ' '.join(cmd.split()[:2]),
+            {
+                'count': 0,
+                'errors': 0,
+                'timeouts': 0,
+                'wait_ms': 0.0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+            },
+        )
+
+    def _account(self, cmd, queued, started, error=False):
+        stats = self._stats(cmd)
+        latency = 1000 * (time.time() - queued)
+        stats['count'] += 1
+        stats['errors'] += int(error)
+        stats['wait_ms'] += 1000 * (started - queued)
+        stats['total_ms'] += latency
+        stats['max_ms'] = max(stats['max_ms'], latency)
+        COMMANDS.inc('error' if error else 'ok')
+        LATENCY.observe(latency / 1000)
+
+    def running(self):
+        return self.queue is not None
+
+    async def run(self):
+        '''Owner task, the only one writing to the device'''
+        self.loop = asyncio.get_event_loop()
+        self.thread_id = threading.get_ident()
+        self.queue = asyncio.PriorityQueue()
+        while True:
+            _, _, cmd, debug_level, future, queued = await self.queue.get()
+            # The caller has already given up
+            if future.done():
+                continue
+            started = time.time()
+            try:
+                resp = await self.loop.run_in_executor(
+                    self.executor, _ksh_cmd, cmd, debug_level
+                )
+            except Exception as exc:
+                self._account(cmd, queued, started, error=True)
+                if not future.done():
+                    future.set_exception(exc)
+                continue
+            self._account(cmd, queued, started)
+            if not future.done():
+                future.set_result(resp)
+
+    async def send(
+        self, cmd, priority=PRIO_NORMAL, timeout=SERIAL_TIMEOUT, debug_level=None
+    ):
+        '''Queue a command and wait for its response lines'''
+        if not self.running():
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, _ksh_cmd, cmd, debug_level
+            )
+        future = self.loop.create_future()
+        queued = time.time()
+        self.queue.put_nowait(
+            (priority, next(self.sequence), cmd, debug_level, future, queued)
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._stats(cmd)['timeouts'] += 1
+            COMMANDS.inc('timeout')
+            logging.error('Command "%s" timed out after %ss.', cmd, timeout)
+            raise
+
+    async def call(self, func, *args):
+        '''Run any other blocking device function in the owner thread'''
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, _device_call, func, *args
+        )
+
+
+SERIAL_CHANNEL = SerialChannel()
+
+
+async def ksh_cmd(cmd, priority=PRIO_NORMAL, timeout=SERIAL_TIMEOUT):
+    return await SERIAL_CHANNEL.send(cmd, priority=priority, timeout=timeout)
+
+
+def send_cmd(cmd, debug_level=None):
+    '''Blocking version of ksh_cmd, for the code outside the event loop'''
+    loop = SERIAL_CHANNEL.loop
+    if SERIAL_CHANNEL.running() and loop.is_running():
+        if threading.get_ident() != SERIAL_CHANNEL.thread_id:
+            return asyncio.run_coroutine_threadsafe(
+                SERIAL_CHANNEL.send(cmd, debug_level=debug_level), loop
+            ).result()
+    return _ksh_cmd(cmd, debug_level)
+
+
 def _find_device(snum):
     '''Find the serial device with the required serial number'''
     if snum:
@@ -78,119 +235,157 @@ def ncp_fw_update():
     logging.info('NCP updated successfully.')
 
 
-def enable_ncp():
+def _open_device():
     '''Find the device and initialize the port'''
     global SERIAL_DEV
 
-    # Find device and initialize port
     port = _find_device(db.get('ncp_serial'))
-    if not port:
-        return
     logging.info('Serial device is %s.', port)
     db.set('serial_device', port)
     SERIAL_DEV = kiserial.KiSerial(port, debug=kiserial.KiDebug(kiserial.KiDebug.NONE))
     send_cmd('debug level none', debug_level=kiserial.KiDebug.NONE)
+    # The device settings have to be read again
+    NCP_STATE.clear()
+
+
+def enable_ncp():
+    '''Open the device and make sure it runs the required firmware and mode'''
+    _open_device()
 
     # Save serial number
     serial = send_cmd('show snum')[0]
     db.set('ncp_serial', serial)
 
     # Update the NCP firmware if needed
-    if kibra.__kinosver__ not in send_cmd('show swver')[-1]:
+    while kibra.__kinosver__ not in send_cmd('show swver')[-1]:
         logging.info('NCP needs a firmware update.')
         ncp_fw_update()
-        enable_ncp()
-    # No need to continue if NCP fw version is up to date
-    else:
-        logging.info('NCP firmware is up to date.')
-
-        # Make sure we are running Thread v3 (1.2.0)
-        if not kibra.__harness__ and 'Thread v3' not in send_cmd('show thver')[0]:
-            send_cmd('clear')
-            SERIAL_DEV.wait_for('status', 'none')
-            send_cmd('config thver 3')
-
-        # Enable ECM if not enabled
-        if 'off' in send_cmd('show hwconfig')[3]:
-            logging.info('Enabling CDC Ethernet and reseting device.')
-            send_cmd('config hwmode 4')
-            send_cmd('reset')
-            time.sleep(3)
-            del SERIAL_DEV
-            enable_ncp()
-
-
-def _ncp_apply_config():
-    # Config network parameters
-    if 'ncp_emac' in db.CFG:
-        send_cmd('config emac %s' % db.get('ncp_emac'))
-    if db.get('ncp_outband'):
-        # TODO: make sure that the required settings exist
-        send_cmd('config outband')
-    if 'ncp_xpanid' in db.CFG:
-        send_cmd('config xpanid %s' % db.get('ncp_xpanid'))
-    if 'ncp_netkey' in db.CFG:
-        send_cmd('config mkey %s' % db.get('ncp_netkey'))
-    if 'ncp_prefix' in db.CFG:
-        send_cmd('config mlprefix %s' % db.get('ncp_prefix').split('/')[0])
-    if 'ncp_channel' in db.CFG:
-        logging.info('Configure NCP channel %s.', db.get('ncp_channel'))
-        send_cmd('config channel %s' % db.get('ncp_channel'))
-    if 'ncp_panid' in db.CFG:
-        logging.info('Configure NCP panid %s.', db.get('ncp_panid'))
-        send_cmd('config panid %s' % db.get('ncp_panid'))
-    if 'ncp_netname' in db.CFG:
-        logging.info('Configure NCP network name %s.', db.get('ncp_netname'))
-        send_cmd('config netname "%s"' % db.get('ncp_netname'))
-    if 'ncp_commcred' in db.CFG:
-        logging.info(
-            'Configure NCP comissioner credential %s.', db.get('ncp_commcred')
-        )
-        send_cmd('config commcred "%s"' % db.get('ncp_commcred'))
-
-    # Set role
-    role = db.get('ncp_role')
-    logging.info('Set NCP as %s.', role)
-    send_cmd('config role %s' % role)
+        _open_device()
+    logging.info('NCP firmware is up to date.')
 
-
-def _configure():
-    global SERIAL_DEV
-
-    # Wait for the NCP to reach a steady status
-    logging.info('Waiting until NCP is steady...')
-    ncp_status = 'disconnected'
-    while not ('none' in ncp_status or 'joined' in ncp_status):
-        ncp_status = send_cmd('show status')[0]
-        time.sleep(1)
-    db.set('ncp_status', ncp_status)
-
-    # Different actions according to NCP status
-    if ncp_status == 'none':
-        if not kibra.__harness__:
-            _ncp_apply_config()
-        _enable_br()
-        send_cmd('ifup')
-    elif ncp_status == 'none - saved configuration':
-        _enable_br()
-        send_cmd('ifup')
-    elif ncp_status == 'joined':
-        send_cmd('ifdown')
-        _configure()
-    else:  # Other 'none' statuses
-        logging.warning('Dongle status was "%s".' % ncp_status)
+    # Make sure we are running Thread v3 (1.2.0)
+    if not kibra.__harness__ and 'Thread v3' not in send_cmd('show thver')[0]:
         send_cmd('clear')
         SERIAL_DEV.wait_for('status', 'none')
-        _configure()
+        send_cmd('config thver 3')
+
+    # Enable ECM if not enabled
+    if 'off' in send_cmd('show hwconfig')[3]:
+        logging.info('Enabling CDC Ethernet and reseting device.')
+        send_cmd('config hwmode 4')
+        send_cmd('reset')
+        time.sleep(3)
+        # Everything else was already checked, just open the port again
+        _open_device()
+
+
+def _ncp_normalize(value):
+    value = str(value).strip().strip('"').lower()
+    return value[2:] if value.startswith('0x') else value
+
+
+def _ncp_wanted():
+    '''Settings from the database, parameter: value'''
+    wanted = {}
+    for key, param, _ in NCP_SETTINGS:
+        value = db.get(key)
+        if value is None:
+            continue
+        if key == 'ncp_prefix':
+            value = value.split('/')[0]
+        wanted[param] = str(value)
+    return wanted
+
+
+async def _ncp_read_config(params):
+    '''Read the NCP settings that are not known yet'''
+    params = [param for param in params if param not in NCP_STATE]
+    resps = await asyncio.gather(
+        *[ksh_cmd('show %s' % param) for param in params], return_exceptions=True
+    )
+    for param, resp in zip(params, resps):
+        # Unknown values are configured anyway
+        if isinstance(resp, list) and resp:
+            NCP_STATE[param] = resp[0]
+
+
+async def _ncp_apply_config():
+    '''Send only the NCP settings that differ from the database ones'''
+    wanted = _ncp_wanted()
+    # Out of band commissioning is not a value that can be read
+    outband = bool(wanted.pop('outband', None))
+    await _ncp_read_config(wanted.keys())
+
+    changes = []
+    for _, param, quoted in NCP_SETTINGS:
+        if param == 'outband':
+            if outband:
+                # TODO: make sure that the required settings exist
+                changes.append((param, None, 'config outband'))
+        elif param in wanted:
+            value = wanted[param]
+            if _ncp_normalize(NCP_STATE.get(param)) == _ncp_normalize(value):
+                continue
+            logging.info('Configure NCP %s %s.', param, value)
+            cmd = 'config %s %s' % (param, '"%s"' % value if quoted else value)
+            changes.append((param, value, cmd))
+    if not changes:
+        logging.info('NCP configuration is up to date.')
+        return
+
+    # Queue them all at once, the channel keeps the order
+    resps = await asyncio.gather(
+        *[ksh_cmd(cmd) for _, _, cmd in changes], return_exceptions=True
+    )
+    for (param, value, _), resp in zip(changes, resps):
+        if isinstance(resp, Exception):
+            NCP_STATE.pop(param, None)
+        elif value is not None:
+            NCP_STATE[param] = value
+    for resp in resps:
+        if isinstance(resp, Exception):
+            raise resp
+
+
+async def _configure():
+    while True:
+        # Wait for the NCP to reach a steady status
+        logging.info('Waiting until NCP is steady...')
+        ncp_status = 'disconnected'
+        while not ('none' in ncp_status or 'joined' in ncp_status):
+            ncp_status = (await ksh_cmd('show status'))[0]
+            await asyncio.sleep(1)
+        db.set('ncp_status', ncp_status)
+
+        # Different actions according to NCP status
+        if ncp_status == 'none':
+            # Cleared, reset or defaulted since the settings were read
+            NCP_STATE.clear()
+            if not kibra.__harness__:
+                await _ncp_apply_config()
+            await _enable_br()
+            await ksh_cmd('ifup')
+            return
+        elif ncp_status == 'none - saved configuration':
+            await _enable_br()
+            await ksh_cmd('ifup')
+            return
+        elif ncp_status == 'joined':
+            await ksh_cmd('ifdown')
+        else:  # Other 'none' statuses
+            logging.warning('Dongle status was "%s".' % ncp_status)
+            await ksh_cmd('clear')
+            NCP_STATE.clear()
+            await SERIAL_CHANNEL.call(SERIAL_DEV.wait_for, 'status', 'none')
 
 
-def _enable_br():
+async def _enable_br():
     '''Enable CDC ETH traffic'''
-    send_cmd('config brouter on')
+    await ksh_cmd('config brouter on')
     logging.info('CDC ETH traffic has been enabled.')
 
 
-def bbr_dataset_update():
+async def bbr_dataset_update():
     '''
     Update Thread BBR Service Data
     Automatically increases the sequence number
@@ -212,13 +407,14 @@ def bbr_dataset_update():
     db.set('bbr_seq', bbr_sequence_number)
 
     # Enable BBR
-    send_cmd(
+    await ksh_cmd(
         'config service add %u %s %s'
         % (
             DEFS.THREAD_ENTERPRISE_NUMBER,
             DEFS.THREAD_SERVICE_DATA_BBR,
             bytes(s_server_data).hex(),
-        )
+        ),
+        priority=PRIO_BBR,
     )
     logging.info(
         'BBR update: Seq. = %d MLR Timeout = %d, Rereg. Delay = %d'
@@ -226,7 +422,7 @@ def bbr_dataset_update():
     )
 
 
-def prefix_handle(
+async def prefix_handle(
     type_: str,  # 'prefix' or 'route'
     action: str,  # 'add' or 'remove'
     prefix: str,  # 'prefix/length'
@@ -287,17 +483,20 @@ def prefix_handle(
     flags = '0x' + str(hex(flags).replace('0x', '').zfill(4))
     pool, length = prefix.split('/')
 
-    send_cmd('config %s %s %s %s %s' % (type_, action, pool, length, flags))
+    await ksh_cmd(
+        'config %s %s %s %s %s' % (type_, action, pool, length, flags),
+        priority=PRIO_BBR,
+    )
     logging.info('Config %s %s %s/%s', type_, action, pool, length)
 
 
-def _bagent_on():
-    send_cmd('config bagent on')
+async def _bagent_on():
+    await ksh_cmd('config bagent on', priority=PRIO_BBR)
     logging.info('Border agent has been enabled.')
 
 
-def _bagent_off():
-    send_cmd('config bagent off')
+async def _bagent_off():
+    await ksh_cmd('config bagent off', priority=PRIO_BBR)
     logging.info('Border agent has been disabled.')
 
 
@@ -328,18 +527,18 @@ class SERIAL(Ktask):
             period=2,
         )
 
-    def kstart(self):
+    async def kstart(self):
         db.set('prefix_active', 0)
-        db.set('ncp_heui64', send_cmd('show heui64')[0])
-        _configure()
+        db.set('ncp_heui64', (await ksh_cmd('show heui64'))[0])
+        await _configure()
         # From now on the syslog daemon will detect changes
 
-    def kstop(self):
+    async def kstop(self):
         if db.get('prefix_active'):
             # Remove prefix from the network
             slaac, dhcp, dp = _get_prefix_flags()
 
-            prefix_handle(
+            await prefix_handle(
                 'prefix',
                 'remove',
                 db.get('prefix'),
@@ -354,16 +553,18 @@ class SERIAL(Ktask):
             # Mark prefix as inactive
             db.set('prefix_active', 0)
 
-        _bagent_off()
-        send_cmd('ifdown')
+        await _bagent_off()
+        await ksh_cmd('ifdown')
+        # The device may be changed before the next start
+        NCP_STATE.clear()
 
     async def periodic(self):
         # Detect if serial was disconnected
         try:
-            SERIAL_DEV.is_active()
+            await SERIAL_CHANNEL.call(SERIAL_DEV.is_active)
         except IOError:
             logging.error('Device %s has been disconnected.', db.get('serial_device'))
-            self.kstop()
+            await self.kstop()
             self.kill()
         except Exception:
             logging.error('Device %s is not responding.', db.get('serial_device'))
@@ -383,13 +584,13 @@ class SERIAL(Ktask):
                 return
 
             # Enable border agent
-            _bagent_on()
+            await _bagent_on()
 
             # Add route
             NETWORK.ncp_route_enable(db.get('prefix'))
 
             # Announce prefix to the network
-            prefix_handle(
+            await prefix_handle(
                 'prefix',
                 'add',
                 db.get('prefix'),
@@ -406,7 +607,7 @@ class SERIAL(Ktask):
             logging.info('This BBR is now Secondary.')
 
             # Announce service
-            bbr_dataset_update()
+            await bbr_dataset_update()
 
             # Mark prefix as active
             db.set('prefix_active', 1)
@@ -1,8 +1,39 @@
 import abc
 import asyncio
+import collections
 import logging
+import math
+import time
 
 import kibra.database as db
+import kibra.metrics as metrics
+
+# Seconds between checks of the database keys a task needs to start or stop
+KEYS_POLL = 0.2
+
+# Futures of the coroutines waiting for a task status change
+WAITERS = set()
+# (task, phase): seconds of the last start and stop
+TIMINGS = {}
+# Task: times of its loop wakeups in the last minute
+WAKEUPS = {}
+
+WAKEUPS_TOTAL = metrics.Counter(
+    'kibra_task_wakeups_total', 'Task loop wakeups by cause', ('task', 'cause')
+)
+
+metrics.Gauge(
+    'kibra_task_seconds',
+    'Duration of the last start and stop of each task',
+    lambda: dict(TIMINGS),
+    ('task', 'phase'),
+)
+metrics.Gauge(
+    'kibra_task_wakeups_per_minute',
+    'Task loop wakeups in the last minute',
+    lambda: {(task,): count for task, count in wakeups_per_minute().items()},
+    ('task',),
+)
 
 
 class status:
@@ -20,11 +51,45 @@ class action:
     KILL = 'kill'
 
 
+def set_status(name, value):
+    db.set('status_' + name, value)
+    for waiter in WAITERS:
+        if not waiter.done():
+            waiter.set_result(None)
+    WAITERS.clear()
+
+
+def wakeups_per_minute():
+    '''Task: loop wakeups in the last minute'''
+    now = time.monotonic()
+    report = {}
+    for task, times in WAKEUPS.items():
+        while times and times[0] < now - 60:
+            times.popleft()
+        report[task] = len(times)
+    return report
+
+
+async def wait_status(names, states):
+    '''Wait until all the named tasks are in one of the given states'''
+    while not all(db.get('status_' + name) in states for name in names):
+        waiter = asyncio.get_event_loop().create_future()
+        WAITERS.add(waiter)
+        await waiter
+
+
 class Ktask:
     __metaclass__ = abc.ABCMeta
 
     def __init__(
-        self, name, start_keys=[], stop_keys=[], start_tasks=[], stop_tasks=[], period=2
+        self,
+        name,
+        start_keys=[],
+        stop_keys=[],
+        start_tasks=[],
+        stop_tasks=[],
+        period=2,
+        watch_keys=[],
     ):
         super(Ktask, self).__init__()
         self.name = name
@@ -35,6 +100,11 @@ class Ktask:
         self.start_tasks = start_tasks
         self.stop_tasks = stop_tasks
         self.period = period
+        # Database keys whose changes wake the task up
+        self.watch_keys = watch_keys
+        self.is_alive = False
+        self.runner = None
+        self.wakeup = None
 
     @abc.abstractmethod
     def kstart(self):
@@ -45,7 +115,11 @@ class Ktask:
         '''Stop.'''
 
     async def periodic(self):
-        pass
+        '''
+        Return the seconds until the next call, None to use the task period or
+        math.inf to wait for a change in the watched keys
+        '''
+        return math.inf
 
     def check_status(self):
         return status.STOPPED
@@ -54,86 +128,239 @@ class Ktask:
         logging.info('Killing task [%s]...', self.name)
         db.set(self.action_key, action.KILL)
 
+    async def start(self):
+        '''Wait for the start keys and start the task, True if it is running'''
+        begin = time.monotonic()
+        set_status(self.name, status.STARTING)
+        while not db.has_keys(self.start_keys):
+            await asyncio.sleep(KEYS_POLL)
+        try:
+            # kstart and kstop may also be coroutines
+            result = self.kstart()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as exc:
+            set_status(self.name, status.ERRORED)
+            logging.error('Task [%s] errored on start: %s', self.name, exc)
+            return False
+        finally:
+            db.set(self.action_key, action.NONE)
+            TIMINGS[(self.name, 'start')] = round(time.monotonic() - begin, 3)
+        set_status(self.name, status.RUNNING)
+        logging.info(
+            'Task [%s] has now started (%.3f s).',
+            self.name,
+            TIMINGS[(self.name, 'start')],
+        )
+        return True
+
+    async def stop(self):
+        '''Wait for the stop keys and stop the task'''
+        begin = time.monotonic()
+        set_status(self.name, status.STOPPING)
+        while not db.has_keys(self.stop_keys):
+            logging.info('Task [%s] cannot be stopped' % self.name)
+            await asyncio.sleep(KEYS_POLL)
+        try:
+            result = self.kstop()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as exc:
+            logging.error('Task [%s] errored on stop: %s', self.name, exc)
+        db.set(self.action_key, action.NONE)
+        TIMINGS[(self.name, 'stop')] = round(time.monotonic() - begin, 3)
+        set_status(self.name, status.STOPPED)
+        logging.info(
+            'Task [%s] has now stopped (%.3f s).',
+            self.name,
+            TIMINGS[(self.name, 'stop')],
+        )
+
     async def run(self):
-        logging.info('Loading task [%s]...', self.name)
+        '''
+        Periodic work of a started task, and the actions requested for it in
+        the database, until it is killed
+        '''
         self.is_alive = True
+        self.wakeup = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        times = WAKEUPS.setdefault(self.name, collections.deque())
 
-        # Preconfiguration
-        if self.check_status() is status.STOPPED:
-            db.set(self.status_key, status.STOPPED)
-            db.set(self.action_key, action.START)
-        else:
-            db.set(self.action_key, action.NONE)
-            db.set(self.status_key, self.check_status())
-
-        # Loop
-        while self.is_alive:
-            task_action = db.get(self.action_key)
+        # Actions, the status of the tasks it depends on and its own keys
+        def notify(key):
+            loop.call_soon_threadsafe(self.wakeup.set)
 
-            if task_action in (action.STOP, action.KILL):
-                db.set(self.status_key, status.STOPPING)
+        keys = [self.action_key] + ['status_' + task for task in self.start_tasks]
+        keys += self.watch_keys
+        for key in keys:
+            db.subscribe(key, notify)
 
-            task_status = db.get(self.status_key)
+        try:
+            while self.is_alive:
+                task_action = db.get(self.action_key)
+                task_status = db.get(self.status_key)
+                delay = self.period
 
-            # Stopped case
-            if task_status is status.STOPPED:
-                # Start task if needed
-                if task_action is action.START:
-                    db.set(self.status_key, status.STARTING)
-                    # Wait for tasks
-                    # TODO: make tasks only dependant on keys, not other tasks
-                    for task in self.start_tasks:
-                        logging.info(
-                            'Task [%s] is waiting for [%s] to start.', self.name, task
-                        )
-                        while db.get('status_' + task) is not status.RUNNING:
-                            await asyncio.sleep(1)
-                    # Wait for keys
-                    while not db.has_keys(self.start_keys):
-                        await asyncio.sleep(1)
-                    try:
-                        self.kstart()
-                        db.set(self.status_key, status.RUNNING)
-                        logging.info('Task [%s] has now started.', self.name)
-                    except Exception as exc:
-                        db.set(self.status_key, status.ERRORED)
-                        logging.error('Task [%s] errored on start: %s', self.name, exc)
-                    db.set(self.action_key, action.NONE)
-                elif task_action is action.KILL:
-                    self.is_alive = False
-            # Running case
-            if task_status is status.RUNNING:
-                # Check if other dependant tasks have stopped or errored
-                for task in self.start_tasks:
-                    if db.get('status_' + task) is not status.RUNNING:
-                        logging.info(
-                            'Task [%s] stopped and forced [%s] to stop.',
-                            task,
-                            self.name,
-                        )
-                        self.kill()
-                        break
-                # Periodic tasks
-                if task_action is action.NONE:
-                    # Avoid execution on start/stop processes
-                    await self.periodic()
-            # Stop task if needed
-            if task_status is status.STOPPING:
                 if task_action in (action.STOP, action.KILL):
-                    for task in self.stop_tasks:
-                        logging.info(
-                            'Task [%s] is waiting for [%s] to stop.', self.name, task
+                    if task_status is not status.STOPPED:
+                        # Not running any more, so that the tasks depending on
+                        # this one see it and stop first
+                        set_status(self.name, status.STOPPING)
+                        await wait_status(
+                            self.stop_tasks, (status.STOPPED, status.ERRORED, None)
                         )
-                        while db.get('status_' + task) is not (status.STOPPED or None):
-                            await asyncio.sleep(1)
-                    while not db.has_keys(self.stop_keys):
-                        logging.info('Task [%s] cannot be stopped' % self.name)
-                        await asyncio.sleep(1)
-                    self.kstop()
+                        await self.stop()
                     if task_action is action.KILL:
                         self.is_alive = False
-                    db.set(self.action_key, action.NONE)
-                    db.set(self.status_key, status.STOPPED)
-                    logging.info('Task [%s] has now stopped.', self.name)
-            # All cases
-            await asyncio.sleep(self.period)
+                        break
+                elif task_status is status.STOPPED:
+                    if task_action is action.START:
+                        logging.info('Task [%s] is waiting for its tasks.', self.name)
+                        await wait_status(self.start_tasks, (status.RUNNING,))
+                        await self.start()
+                        continue
+                    # Nothing to do until some action is requested
+                    delay = math.inf
+                elif task_status is status.RUNNING:
+                    # Check if other dependant tasks have stopped or errored
+                    for task in self.start_tasks:
+                        if db.get('status_' + task) is not status.RUNNING:
+                            logging.info(
+                                'Task [%s] stopped and forced [%s] to stop.',
+                                task,
+                                self.name,
+                            )
+                            self.kill()
+                            break
+                    else:
+                        # Avoid execution on start/stop processes
+                        if task_action is action.NONE:
+                            result = await self.periodic()
+                            if result is not None:
+                                delay = max(0, result)
+
+                # All cases
+                try:
+                    await asyncio.wait_for(
+                        self.wakeup.wait(), None if delay == math.inf else delay
+                    )
+                    cause = 'event'
+                except asyncio.TimeoutError:
+                    cause = 'timer'
+                self.wakeup.clear()
+                now = time.monotonic()
+                times.append(now)
+                while times[0] < now - 60:
+                    times.popleft()
+                WAKEUPS_TOTAL.inc(self.name, cause)
+        finally:
+            for key in keys:
+                db.unsubscribe(key, notify)
+
+
+def _sort(deps):
+    '''Topological order of a {node: [nodes it depends on]} graph'''
+    order = []
+    pending = {node: set(parents) for node, parents in deps.items()}
+    while pending:
+        ready = sorted(node for node, parents in pending.items() if not parents)
+        if not ready:
+            raise ValueError('Task dependency cycle: %s' % _cycle(pending))
+        for node in ready:
+            order.append(node)
+            del pending[node]
+        for parents in pending.values():
+            parents.difference_update(ready)
+    return order
+
+
+def _cycle(deps):
+    '''Text with one of the cycles in a graph without nodes ready to go'''
+    path = [next(iter(deps))]
+    while path.count(path[-1]) < 2:
+        path.append(sorted(deps[path[-1]])[0])
+    return ' -> '.join(path[path.index(path[-1]) :])
+
+
+class Scheduler:
+    '''
+    Start a set of Ktasks concurrently, each one as soon as the tasks it
+    depends on are running, and stop them in the reverse order
+    '''
+
+    def __init__(self, tasks):
+        self.tasks = {task.name: task for task in tasks}
+        self.start_deps = {}
+        self.stop_deps = {name: set() for name in self.tasks}
+        for name, task in self.tasks.items():
+            unknown = set(task.start_tasks) - set(self.tasks)
+            if unknown:
+                raise ValueError(
+                    'Task [%s] depends on unknown tasks %s' % (name, sorted(unknown))
+                )
+            self.start_deps[name] = set(task.start_tasks)
+            # A task stops after those depending on it and its stop tasks
+            for dep in task.start_tasks:
+                self.stop_deps[dep].add(name)
+            self.stop_deps[name].update(set(task.stop_tasks) & set(self.tasks))
+        self.start_order = _sort(self.start_deps)
+        self.stop_order = _sort(self.stop_deps)
+
+    async def _start_task(self, task, results, begin):
+        running = True
+        for dep in self.start_deps[task.name]:
+            running = await results[dep] and running
+        if db.get(task.status_key) is status.STARTING:
+            # Already being started by someone else
+            await wait_status([task.name], (status.RUNNING, status.ERRORED))
+            running = db.get(task.status_key) is status.RUNNING
+        elif db.get(task.status_key) is status.RUNNING:
+            pass
+        elif not running:
+            logging.warning('Task [%s] not started, a dependency failed.', task.name)
+            set_status(task.name, status.STOPPED)
+        elif task.check_status() is status.RUNNING:
+            set_status(task.name, status.RUNNING)
+        else:
+            running = await task.start()
+        if running and (task.runner is None or task.runner.done()):
+            task.runner = asyncio.ensure_future(task.run())
+        if running:
+            logging.info(
+                'Task [%s] running at +%.3f s.', task.name, time.monotonic() - begin
+            )
+        results[task.name].set_result(running)
+
+    async def start(self):
+        '''Start all the tasks, return True if all of them are running'''
+        begin = time.monotonic()
+        loop = asyncio.get_event_loop()
+        results = {name: loop.create_future() for name in self.tasks}
+        await asyncio.gather(
+            *[
+                self._start_task(self.tasks[name], results, begin)
+                for name in self.start_order
+            ]
+        )
+        logging.info('Tasks started in %.3f s.', time.monotonic() - begin)
+        return all(future.result() for future in results.values())
+
+    async def _stop_task(self, task, results):
+        for dep in self.stop_deps[task.name]:
+            await results[dep]
+        if task.runner and not task.runner.done():
+            task.kill()
+            await task.runner
+        elif db.get(task.status_key) not in (status.STOPPED, None):
+            await task.stop()
+        results[task.name].set_result(None)
+
+    async def stop(self):
+        '''Stop all the tasks'''
+        begin = time.monotonic()
+        loop = asyncio.get_event_loop()
+        results = {name: loop.create_future() for name in self.tasks}
+        await asyncio.gather(
+            *[self._stop_task(self.tasks[name], results) for name in self.stop_order]
+        )
+        logging.info('Tasks stopped in %.3f s.', time.monotonic() - begin)
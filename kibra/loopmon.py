@@ -0,0 +1,189 @@
+'''Event loop health: scheduling lag and the code that keeps the loop busy'''
+import asyncio
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import kibra.metrics as metrics
+from kibra.ktask import Ktask, wakeups_per_minute
+
+# Seconds a callback may run before it is reported as slow
+SLOW_CALLBACK = 0.1
+# Seconds between checks of the loop responsiveness
+PROBE_INTERVAL = 0.25
+# Slow callbacks kept for the report
+STALL_HISTORY = 50
+# Innermost frames kept from each captured stack
+STACK_DEPTH = 12
+
+KIBRA_DIR = os.path.dirname(os.path.abspath(__file__))
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+LOOP_LAG = metrics.Histogram(
+    'kibra_loop_lag_seconds', 'Delay of the event loop in running a callback'
+)
+STALLS = metrics.Counter('kibra_loop_stalls_total', 'Slow callbacks detected')
+
+MONITOR = None
+
+
+def _origin(frame):
+    '''
+    Return the KiBRA entry point running in the frame (Ktask, CoAP resource or
+    function) and the innermost KiBRA code location
+    '''
+    origin = None
+    where = None
+    while frame is not None:
+        code = frame.f_code
+        # Frames below the loop callback are not part of it
+        if origin and code.co_filename.startswith(ASYNCIO_DIR):
+            break
+        if code.co_filename.startswith(KIBRA_DIR):
+            module = os.path.basename(code.co_filename)
+            if where is None:
+                where = '%s:%d %s' % (module, frame.f_lineno, code.co_name)
+            owner = frame.f_locals.get('self')
+            if isinstance(owner, Ktask):
+                origin = 'task %s' % owner.name
+            elif owner is not None:
+                origin = '%s.%s' % (type(owner).__name__, code.co_name)
+            else:
+                origin = '%s %s' % (module, code.co_name)
+        frame = frame.f_back
+    return origin or 'asyncio', where or ''
+
+
+class SlowCallbackHandler(logging.Handler):
+    '''Collect the slow callbacks that asyncio reports in debug mode'''
+
+    def __init__(self, monitor):
+        super().__init__(logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record):
+        if str(record.msg).startswith('Executing %s took') and record.args:
+            handle, duration = record.args
+            self.monitor.add(duration, 'asyncio %s' % str(handle)[:200], '', [])
+
+
+class LoopMonitor:
+    '''
+    A watchdog thread checks that the loop runs a callback within
+    SLOW_CALLBACK seconds. When it does not, the loop thread stack is captured
+    to find what is blocking it. Durations are counted from the check, so they
+    are a lower bound of the real ones.
+    '''
+
+    def __init__(self, loop, threshold=SLOW_CALLBACK, interval=PROBE_INTERVAL):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = collections.deque(maxlen=STALL_HISTORY)
+        self.answered = threading.Event()
+        self.thread_id = None
+        self.running = False
+
+    def start(self):
+        '''Start watching the loop, to be called from the loop thread'''
+        self.thread_id = threading.get_ident()
+        self.running = True
+        # Reported by asyncio itself if the loop runs in debug mode
+        self.loop.slow_callback_duration = self.threshold
+        logging.getLogger('asyncio').addHandler(SlowCallbackHandler(self))
+        try:
+            self.loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        except (NotImplementedError, RuntimeError):
+            pass
+        threading.Thread(target=self._watch, name='loopmon', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _watch(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.answered.clear()
+            sent = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(self.answered.set)
+            except RuntimeError:
+                # The loop is closed
+                return
+            if not self.answered.wait(self.threshold):
+                # Blocked: look at what it is doing now
+                frame = sys._current_frames().get(self.thread_id)
+                origin, where = _origin(frame)
+                stack = traceback.format_stack(frame)[-STACK_DEPTH:] if frame else []
+                while self.running and not self.answered.wait(self.interval):
+                    pass
+                self.add(time.monotonic() - sent, origin, where, stack)
+            LOOP_LAG.observe(time.monotonic() - sent)
+
+    def add(self, duration, origin, where, stack):
+        STALLS.inc()
+        self.stalls.append(
+            {
+                'time': time.time(),
+                'duration': round(duration, 3),
+                'origin': origin,
+                'where': where,
+                'stack': ''.join(stack),
+            }
+        )
+
+    def report(self):
+        '''Slow callbacks, worst first, and their totals per origin'''
+        stalls = sorted(list(self.stalls), key=lambda stall: -stall['duration'])
+        offenders = {}
+        for stall in stalls:
+            offender = offenders.setdefault(
+                stall['origin'], {'count': 0, 'worst': 0, 'total': 0}
+            )
+            offender['count'] += 1
+            offender['worst'] = max(offender['worst'], stall['duration'])
+            offender['total'] = round(offender['total'] + stall['duration'], 3)
+        return {'threshold': self.threshold, 'offenders': offenders, 'stalls': stalls}
+
+    def dump(self):
+        '''Write the report to the log'''
+        report = self.report()
+        logging.warning(
+            'Event loop: %d slow callbacks over %ss',
+            len(report['stalls']),
+            self.threshold,
+        )
+        for origin, offender in report['offenders'].items():
+            logging.warning(
+                '%s: %d times, worst %ss, total %ss',
+                origin,
+                offender['count'],
+                offender['worst'],
+                offender['total'],
+            )
+        for stall in report['stalls']:
+            logging.warning(
+                '%.3fs in %s (%s)\n%s',
+                stall['duration'],
+                stall['origin'],
+                stall['where'],
+                stall['stack'],
+            )
+
+
+def start():
+    global MONITOR
+
+    MONITOR = LoopMonitor(asyncio.get_event_loop())
+    MONITOR.start()
+
+
+def report():
+    result = MONITOR.report() if MONITOR else {}
+    result['wakeups'] = wakeups_per_minute()
+    return result
@@ -17,6 +17,7 @@ import time
 
 import kibra.database as db
 import kibra.iptables as iptables
+import kibra.metrics as metrics
 
 MCROUTE_EXPIRY = 60
 
@@ -41,6 +42,14 @@ sockaddr_in6_fmt = 'HHI16sI'
 mf6cctl_fmt = '28s28sHH32s'  # Second H is padding for the non-packed struct
 mrt6msg_fmt = 'BBHI16s16s'
 
+UPCALLS = metrics.Counter(
+    'kibra_mfc_upcalls_total', 'Kernel multicast upcalls by input MIF', ('mif',)
+)
+ROUTES_ADDED = metrics.Counter('kibra_mfc_routes_added_total', 'MFC routes installed')
+ROUTES_REMOVED = metrics.Counter(
+    'kibra_mfc_routes_removed_total', 'MFC routes removed', ('reason',)
+)
+
 
 class MCRoute:
     def __init__(self, src, dst, in_mif, out_mif):
@@ -121,55 +130,59 @@ class MCRouter:
             except:
                 # socket.timeout: timed out
                 time.sleep(0.2)
-
-            if not 'primary' in db.get('bbr_status'):
                 continue
+            self.handle_upcall(data)
 
-            # Signal must start with zero
-            if data[0] != 0:
-                continue
+    def handle_upcall(self, data):
+        '''Add a route for the multicast traffic that has to be forwarded'''
+        if not 'primary' in db.get('bbr_status'):
+            return
 
-            # Get the upcall paramters
-            _, type_, in_mif, _, src, dst = struct.unpack(
-                mrt6msg_fmt, data[: struct.calcsize(mrt6msg_fmt)]
-            )
+        # Signal must start with zero
+        if data[0] != 0:
+            return
 
-            # Debug
-            src_addr = ipaddress.IPv6Address(src).compressed
-            dst_addr = ipaddress.IPv6Address(dst).compressed
-            logging.debug(
-                'Upcall: type=%d mif=%d src=%s dst=%s'
-                % (type_, in_mif, src_addr, dst_addr)
-            )
+        # Get the upcall paramters
+        _, type_, in_mif, _, src, dst = struct.unpack(
+            mrt6msg_fmt, data[: struct.calcsize(mrt6msg_fmt)]
+        )
 
-            if type_ != MRT6MSG_NOCACHE:
-                continue
+        # Debug
+        src_addr = ipaddress.IPv6Address(src).compressed
+        dst_addr = ipaddress.IPv6Address(dst).compressed
+        logging.debug(
+            'Upcall: type=%d mif=%d src=%s dst=%s' % (type_, in_mif, src_addr, dst_addr)
+        )
 
-            # Packet from Backbone Network (9.4.7.3)
-            if in_mif == EXT_MIF:
-                # Filter by registered multicast groups
-                if not db.get('mlr_cache'):
-                    continue
-                maddrs = list(db.get('mlr_cache').keys())
-                if str(dst_addr) not in maddrs:
-                    continue
-                out_mif = INT_MIF
-            # Packet from Thread Network (9.4.7.4)
-            elif in_mif == INT_MIF:
-                # Rules 1 and 3 handled by KiNOS
-                # Filter by forwarding flags
-                dst_scope = dst[1] & 0x0F
-                if dst_scope < 4:
-                    continue
-                if db.get('mcast_out_fwd') == 0:
-                    continue
-                if dst_scope == 4 and db.get('mcast_admin_fwd') == 0:
-                    continue
-                out_mif = EXT_MIF
-            else:
-                continue
+        if type_ != MRT6MSG_NOCACHE:
+            return
+        UPCALLS.inc(in_mif)
+
+        # Packet from Backbone Network (9.4.7.3)
+        if in_mif == EXT_MIF:
+            # Filter by registered multicast groups
+            if not db.get('mlr_cache'):
+                return
+            maddrs = list(db.get('mlr_cache').keys())
+            if str(dst_addr) not in maddrs:
+                return
+            out_mif = INT_MIF
+        # Packet from Thread Network (9.4.7.4)
+        elif in_mif == INT_MIF:
+            # Rules 1 and 3 handled by KiNOS
+            # Filter by forwarding flags
+            dst_scope = dst[1] & 0x0F
+            if dst_scope < 4:
+                return
+            if db.get('mcast_out_fwd') == 0:
+                return
+            if dst_scope == 4 and db.get('mcast_admin_fwd') == 0:
+                return
+            out_mif = EXT_MIF
+        else:
+            return
 
-            self.add_route(MCRoute(src, dst, in_mif, out_mif))
+        self.add_route(MCRoute(src, dst, in_mif, out_mif))
 
     def add_route(self, route):
         old_route = None
@@ -186,9 +199,10 @@ class MCRouter:
         # If the route existed, there is no need to add it to the kernel
         if old_route:
             # Remove it because it's going to be added with updated timeout
-            self.mcroutes.pop(old_route)
+            self.mcroutes.remove(old_route)
         else:
             self.mc6r_sock.setsockopt(IPPROTO_IPV6, MRT6_ADD_MFC, route.get_mf6cctl())
+            ROUTES_ADDED.inc()
 
         # Save the newly created route
         self.mcroutes.append(route)
@@ -205,6 +219,7 @@ class MCRouter:
             self.mc6r_sock.setsockopt(
                 IPPROTO_IPV6, MRT6_DEL_MFC, old_route.get_mf6cctl()
             )
+            ROUTES_REMOVED.inc('expired')
             logging.info('Route removed: %s' % old_route)
 
     def rem_group_routes(self, mcgroup):
@@ -221,6 +236,7 @@ class MCRouter:
             self.mc6r_sock.setsockopt(
                 IPPROTO_IPV6, MRT6_DEL_MFC, old_route.get_mf6cctl()
             )
+            ROUTES_REMOVED.inc('group')
             logging.info('Route removed: %s' % old_route)
 
     def join_leave_group(self, action, mcgroup, ifnumber=None):
@@ -1,18 +1,78 @@
 import logging
-import pathlib
 import socket
 import struct
 
 import kibra.database as db
+from kibra.config import ConfigFile
 from kibra.ktask import Ktask
-from kibra.shell import bash
+from kibra.mdnsd import MdnsResponder
+
+try:
+    import dbus  # https://dbus.freedesktop.org/doc/dbus-python/
+except ImportError:
+    dbus = None
 
 MDNS_CONFIG = '/etc/avahi/avahi-daemon.conf'
 MDNS_HOSTS = '/etc/avahi/hosts'
 MDNS_SERVICES = '/etc/avahi/services'
+MDNS_FILE = ConfigFile('avahi', MDNS_CONFIG, ['service avahi-daemon restart'])
+# Seconds between service checks when nothing changes
+MDNS_REFRESH = 60
+# Database keys used in the service definition
+MDNS_KEYS = [
+    'bbr_port',
+    'bbr_seq',
+    'bbr_status',
+    'exterior_port_mc',
+    'kibra_model',
+    'kibra_vendor',
+    'ncp_heui64',
+    'ncp_name',
+    'ncp_netname',
+    'ncp_secpol',
+    'ncp_status',
+    'ncp_xpanid',
+]
+# MeshCoP service type
+MDNS_TYPE = '_meshcop._udp'
+MDNS_SERVICE = ('_meshcop', '_udp', 'local')
+# TXT records with binary values, given in hexadecimal
+MDNS_BINARY = ('sb', 'xp', 'sq', 'bb')
+
+# Avahi D-Bus API
+AVAHI_BUS = 'org.freedesktop.Avahi'
+AVAHI_IF_UNSPEC = -1
+AVAHI_PROTO_UNSPEC = -1
+
+# Changes in the keys of the records, and the count when they were computed
+CHANGES = 0
+RECORDS = (None, None)
+
+
+def _records_changed(key):
+    global CHANGES
+
+    CHANGES += 1
+
+
+for _key in MDNS_KEYS:
+    db.subscribe(_key, _records_changed)
 
 
 def get_records():
+    '''MeshCoP TXT records, only computed again when their keys change'''
+    global RECORDS
+
+    changes, records = RECORDS
+    if changes != CHANGES:
+        # A change while computing them is noticed in the next call
+        changes = CHANGES
+        records = _get_records()
+        RECORDS = (changes, records)
+    return dict(records)
+
+
+def _get_records():
     records = {}
     '''Table 8-5. Border Agent State Bitmap'''
     CONNECTION_MODE = 0
@@ -81,12 +141,123 @@ def get_records():
     return records
 
 
+def get_txt(records):
+    '''Service TXT strings, in the order they were published in Avahi files'''
+    txt = {'rv': '1', 'tv': '1.2.0'}
+    for key in ('sb', 'vn', 'mn', 'nn', 'xp', 'sq', 'bb'):
+        if key in records:
+            txt[key] = records[key]
+    return txt
+
+
+def get_txt_bytes(txt):
+    '''TXT strings in wire format, with the binary values decoded'''
+    items = []
+    for key, value in txt.items():
+        if key in MDNS_BINARY:
+            value = bytes.fromhex(value)
+        else:
+            value = value.encode()
+        items.append(key.encode() + b'=' + value)
+    return items
+
+
 def new_external_addresses():
     '''Be notified about new addresses in the external interface'''
 
-    # Restart Avahi to make it use the new addresses
-    logging.info('Restarting Avahi service.')
-    bash('service avahi-daemon restart')
+    # Avahi follows the interface addresses by itself, a restart would only
+    # flush the mDNS caches in the network. The built-in responder announces
+    # them when the task sees the exterior_addrs change.
+    if db.get('mdns_responder'):
+        logging.info('New exterior addresses, announced by the mDNS responder.')
+    else:
+        logging.info('New exterior addresses, announced by Avahi.')
+
+
+class AvahiService:
+    '''
+    Service registered through an Avahi D-Bus entry group, which is kept while
+    the daemon runs and only has its TXT records updated when they change
+    '''
+
+    def __init__(self):
+        self.bus = dbus.SystemBus()
+        self.group = None
+        self.name = None
+        self.port = None
+        self.txt = None
+
+    def _txt_array(self, txt):
+        array = [dbus.ByteArray(item) for item in get_txt_bytes(txt)]
+        return dbus.Array(array, signature='ay')
+
+    def _register(self, name, port, txt):
+        if self.group is None:
+            server = dbus.Interface(
+                self.bus.get_object(AVAHI_BUS, '/'), AVAHI_BUS + '.Server'
+            )
+            self.group = dbus.Interface(
+                self.bus.get_object(AVAHI_BUS, server.EntryGroupNew()),
+                AVAHI_BUS + '.EntryGroup',
+            )
+        else:
+            self.group.Reset()
+        self.group.AddService(
+            AVAHI_IF_UNSPEC,
+            AVAHI_PROTO_UNSPEC,
+            dbus.UInt32(0),
+            name,
+            MDNS_TYPE,
+            '',
+            '',
+            dbus.UInt16(port),
+            self._txt_array(txt),
+        )
+        self.group.Commit()
+        logging.info('mDNS service %s registered.', name)
+
+    def publish(self, name, port, txt):
+        '''Register the service or update its TXT records if needed'''
+        try:
+            if self.group is None or (name, port) != (self.name, self.port):
+                self._register(name, port, txt)
+            elif txt != self.txt:
+                self.group.UpdateServiceTxt(
+                    AVAHI_IF_UNSPEC,
+                    AVAHI_PROTO_UNSPEC,
+                    dbus.UInt32(0),
+                    name,
+                    MDNS_TYPE,
+                    '',
+                    self._txt_array(txt),
+                )
+                changed = set(txt.items()).symmetric_difference(self.txt.items())
+                logging.info(
+                    'mDNS records updated: %s',
+                    ', '.join(sorted(set(key for key, _ in changed))),
+                )
+            else:
+                # Nothing changed, check that Avahi still has the service
+                self.group.GetState()
+        except dbus.DBusException as exc:
+            # The daemon was restarted and the group was lost
+            logging.warning('Avahi D-Bus error: %s', exc)
+            self.group = None
+            self._register(name, port, txt)
+        self.name = name
+        self.port = port
+        self.txt = txt
+
+    def remove(self):
+        if self.group is not None:
+            try:
+                self.group.Reset()
+                self.group.Free()
+            except dbus.DBusException:
+                pass
+            self.group = None
+        self.txt = None
+
 
 class MDNS(Ktask):
     def __init__(self):
@@ -95,100 +266,132 @@ class MDNS(Ktask):
             name='mdns',
             start_keys=['exterior_ifname', 'bbr_seq', 'bbr_port'],
             period=2,
+            watch_keys=MDNS_KEYS + ['exterior_addrs', 'exterior_ipv6_ll'],
         )
+        self.responder = None
+        self.avahi = None
 
     async def periodic(self):
         self.service_update()
+        return MDNS_REFRESH
 
     def kstart(self):
+        if db.get('mdns_responder'):
+            # No Avahi daemon involved
+            self.responder = MdnsResponder(db.get('exterior_ifnumber'))
+            self.responder.start()
+            self.service_update()
+            return
+
         logging.info('Configuring Avahi daemon.')
 
-        with open(MDNS_CONFIG, 'w') as file_:
-            lines = []
-            lines.append('[server]')
-            lines.append('use-ipv4=yes')
-            lines.append('use-ipv6=yes')
-            lines.append('allow-interfaces=%s' % db.get('exterior_ifname'))
-            lines.append('disallow-other-stacks=yes\n')
-            lines.append('[publish]')
-            lines.append('publish-addresses=yes')
-            lines.append('publish-hinfo=no')
-            lines.append('publish-workstation=no')
-            lines.append('publish-domain=no')
-            lines.append('publish-aaaa-on-ipv4=no')
-            lines.append('publish-a-on-ipv6=no\n')
-            lines.append('[rlimits]')
-            lines.append('rlimit-core=0')
-            lines.append('rlimit-data=4194304')
-            lines.append('rlimit-fsize=0')
-            lines.append('rlimit-nofile=30')
-            lines.append('rlimit-stack=4194304')
-            lines.append('rlimit-nproc=3')
-            lines.append('')
-            lines = '\n'.join(lines)
-            file_.write(lines)
+        lines = []
+        lines.append('[server]')
+        lines.append('use-ipv4=yes')
+        lines.append('use-ipv6=yes')
+        lines.append('allow-interfaces=%s' % db.get('exterior_ifname'))
+        lines.append('disallow-other-stacks=yes\n')
+        lines.append('[publish]')
+        lines.append('publish-addresses=yes')
+        lines.append('publish-hinfo=no')
+        lines.append('publish-workstation=no')
+        lines.append('publish-domain=no')
+        lines.append('publish-aaaa-on-ipv4=no')
+        lines.append('publish-a-on-ipv6=no\n')
+        lines.append('[rlimits]')
+        lines.append('rlimit-core=0')
+        lines.append('rlimit-data=4194304')
+        lines.append('rlimit-fsize=0')
+        lines.append('rlimit-nofile=30')
+        lines.append('rlimit-stack=4194304')
+        lines.append('rlimit-nproc=3')
+        lines.append('')
+        lines = '\n'.join(lines)
+
+        # Only restart the daemon if its configuration changed
+        MDNS_FILE.update(lines)
+
+        # Prefer a persistent registration to the service files
+        self.avahi = None
+        if dbus:
+            try:
+                self.avahi = AvahiService()
+            except dbus.DBusException as exc:
+                logging.warning('Avahi D-Bus not available: %s', exc)
+        if self.avahi:
+            self._service_file().delete()
 
         # Enable service
         self.service_update()
 
     def kstop(self):
         # Disable service
+        if self.responder:
+            logging.info('Removing mDNS service.')
+            self.responder.stop()
+            self.responder = None
+            return
+
         logging.info('Removing Avahi service.')
-        bash('rm /etc/avahi/services/%s.service' % db.get('ncp_name'))
-        bash('service avahi-daemon restart')
+        if self.avahi:
+            self.avahi.remove()
+            self.avahi = None
+        else:
+            self._service_file().delete()
 
-    def service_update(self):
-        r_txt = '\t\t<txt-record>%s=%s</txt-record>'
-        r_bin = '\t\t<txt-record value-format="binary-hex">%s=%s</txt-record>'
+    def _service_file(self):
+        return ConfigFile(
+            'avahi',
+            '%s/%s.service' % (MDNS_SERVICES, db.get('ncp_name')),
+            ['service avahi-daemon reload'],
+        )
 
+    def service_update(self):
         try:
             records = get_records()
-            hostname = socket.gethostname()
         except:
             logging.warning('Unable to get the mDNS records.')
             return
+        name = '%s %s %s' % (db.get('ncp_name'), records['vn'], records['mn'])
+        port = db.get('exterior_port_mc')
+        txt = get_txt(records)
+
+        if self.responder:
+            # Addresses already known before the interior network is up
+            addrs = db.get('exterior_addrs') or [db.get('exterior_ipv6_ll')]
+            changed = self.responder.publish(
+                name, MDNS_SERVICE, port, get_txt_bytes(txt), [a for a in addrs if a]
+            )
+            if changed:
+                logging.info('mDNS service updated, %d records announced.', changed)
+            return
+
+        if self.avahi:
+            try:
+                self.avahi.publish(name, port, txt)
+            except dbus.DBusException as exc:
+                logging.warning('Unable to publish the mDNS service: %s', exc)
+            return
+
+        r_txt = '\t\t<txt-record>%s=%s</txt-record>'
+        r_bin = '\t\t<txt-record value-format="binary-hex">%s=%s</txt-record>'
+
         # Compose the new service data
         snw = []
         snw.append('<?xml version="1.0" encoding="utf-8" standalone="no"?>')
         snw.append('<!DOCTYPE service-group SYSTEM "avahi-service.dtd">')
         snw.append('<service-group>')
-        snw.append(
-            '\t<name>%s %s %s</name>'
-            % (db.get('ncp_name'), records['vn'], records['mn'])
-        )
+        snw.append('\t<name>%s</name>' % name)
         snw.append('\t<service>')
-        snw.append('\t\t<type>_meshcop._udp</type>')
-        snw.append('\t\t<host-name>%s.local</host-name>' % hostname)
-        snw.append('\t\t<port>%d</port>' % db.get('exterior_port_mc'))
-        snw.append(r_txt % ('rv', '1'))
-        snw.append(r_txt % ('tv', '1.2.0'))
-        snw.append(r_bin % ('sb', records['sb']))
-        snw.append(r_txt % ('vn', records['vn']))
-        snw.append(r_txt % ('mn', records['mn']))
-        if 'nn' in records.keys():
-            snw.append(r_txt % ('nn', records['nn']))
-        if 'xp' in records.keys():
-            snw.append(r_bin % ('xp', records['xp']))
-        if 'sq' in records.keys():
-            snw.append(r_bin % ('sq', records['sq']))
-        if 'bb' in records.keys():
-            snw.append(r_bin % ('bb', records['bb']))
+        snw.append('\t\t<type>%s</type>' % MDNS_TYPE)
+        snw.append('\t\t<host-name>%s.local</host-name>' % socket.gethostname())
+        snw.append('\t\t<port>%d</port>' % port)
+        for key, value in txt.items():
+            snw.append((r_bin if key in MDNS_BINARY else r_txt) % (key, value))
         snw.append('\t</service>')
         snw.append('</service-group>\n')
         snw = '\n'.join(snw)
 
-        # Load the previous service file, or create it
-        pathlib.Path(MDNS_SERVICES).mkdir(parents=True, exist_ok=True)
-        service_file = '%s/%s.service' % (MDNS_SERVICES, db.get('ncp_name'))
-        file_name = pathlib.Path(service_file)
-        file_name.touch(exist_ok=True)
-
-        with open(str(service_file), 'r') as file_:
-            sod = file_.read()
-
-        # Only restart service if something changed
-        if snw != sod:
-            with open(str(file_name), 'w') as file_:
-                file_.write(snw)
-            bash('service avahi-daemon reload')
+        # Only reload the service if something changed since the last write
+        if self._service_file().update(snw):
             logging.info('mDNS service updated.')
@@ -0,0 +1,380 @@
+'''Built-in mDNS responder for DNS-SD services (RFC 6762 and RFC 6763)'''
+import asyncio
+import collections
+import ipaddress
+import logging
+import socket
+import struct
+import time
+
+import kibra.metrics as metrics
+
+MDNS_PORT = 5353
+MDNS_GROUP4 = '224.0.0.251'
+MDNS_GROUP6 = 'ff02::fb'
+
+# Resource record types and class
+T_A = 1
+T_PTR = 12
+T_TXT = 16
+T_AAAA = 28
+T_SRV = 33
+T_ANY = 255
+C_IN = 1
+# Cache flush bit of a record class, unicast response bit of a question class
+C_FLUSH = 0x8000
+C_UNICAST = 0x8000
+
+# Header flags: response, authoritative answer
+FLAGS_RESPONSE = 0x8400
+FLAG_QR = 0x8000
+OPCODE_MASK = 0x7800
+
+# Record TTLs in seconds (RFC 6762 section 10)
+TTL_HOST = 120
+TTL_OTHER = 4500
+# Maximum TTL of the answers to legacy unicast queries
+TTL_LEGACY = 10
+# Seconds between multicasts of the same record (RFC 6762 section 6)
+RATE_LIMIT = 1
+# Unsolicited announcements of new records, and seconds between them
+ANNOUNCE_COUNT = 2
+ANNOUNCE_INTERVAL = 1
+# Largest datagram to read
+MAX_SIZE = 9000
+
+SERVICES = ('_services', '_dns-sd', '_udp', 'local')
+
+QUERIES = metrics.Counter('kibra_mdns_queries_total', 'mDNS queries received')
+SENT = metrics.Counter(
+    'kibra_mdns_records_sent_total', 'mDNS records sent', ('destination',)
+)
+SUPPRESSED = metrics.Counter(
+    'kibra_mdns_records_suppressed_total',
+    'mDNS answers not sent',
+    ('reason',),
+)
+
+# name and rdata are the ones sent, value is the rdata with lower case names
+Record = collections.namedtuple('Record', 'name rtype ttl flush rdata value')
+Message = collections.namedtuple('Message', 'id flags questions answers')
+
+
+def _lower(labels):
+    return tuple(label.lower() for label in labels)
+
+
+def pack_name(labels):
+    '''Uncompressed wire format of a domain name given as a tuple of labels'''
+    data = b''
+    for label in labels:
+        label = label.encode()[:63]
+        data += struct.pack('!B', len(label)) + label
+    return data + b'\0'
+
+
+def unpack_name(data, offset):
+    '''Return the labels of a possibly compressed name and the offset after it'''
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise ValueError('Name compression loop')
+            offset = (length & 0x3F) << 8 | data[offset + 1]
+        elif length:
+            labels.append(
+                data[offset + 1 : offset + 1 + length].decode('utf-8', 'replace')
+            )
+            offset += 1 + length
+        else:
+            return tuple(labels), end if end is not None else offset + 1
+
+
+def record(name, rtype, ttl, flush, rdata):
+    '''Record with the comparison value of its rdata'''
+    value = rdata
+    if rtype == T_PTR:
+        value = pack_name(_lower(unpack_name(rdata, 0)[0]))
+    elif rtype == T_SRV:
+        value = rdata[:6] + pack_name(_lower(unpack_name(rdata, 6)[0]))
+    return Record(name, rtype, ttl, flush, rdata, value)
+
+
+def parse(data):
+    '''Message with the questions and the answers (known answers in a query)'''
+    id_, flags, qdcount, ancount, _, _ = struct.unpack_from('!HHHHHH', data)
+    offset = 12
+    questions = []
+    for _ in range(qdcount):
+        name, offset = unpack_name(data, offset)
+        qtype, qclass = struct.unpack_from('!HH', data, offset)
+        offset += 4
+        questions.append((_lower(name), qtype, qclass))
+    answers = []
+    for _ in range(ancount):
+        name, offset = unpack_name(data, offset)
+        rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        rdata = data[offset : offset + length]
+        # Names in the rdata may point anywhere in the message
+        if rtype == T_PTR:
+            rdata = pack_name(unpack_name(data, offset)[0])
+        elif rtype == T_SRV:
+            rdata = rdata[:6] + pack_name(unpack_name(data, offset + 6)[0])
+        offset += length
+        answers.append(record(name, rtype, ttl, rclass & C_FLUSH, rdata))
+    return Message(id_, flags, questions, answers)
+
+
+def pack_message(answers, additionals=(), id_=0, flags=FLAGS_RESPONSE, questions=()):
+    '''Wire format of a message, questions as (labels, type, class) tuples'''
+    data = struct.pack(
+        '!HHHHHH', id_, flags, len(questions), len(answers), 0, len(additionals)
+    )
+    for name, qtype, qclass in questions:
+        data += pack_name(name) + struct.pack('!HH', qtype, qclass)
+    for rec in list(answers) + list(additionals):
+        rclass = C_IN | (C_FLUSH if rec.flush else 0)
+        data += pack_name(rec.name)
+        data += struct.pack('!HHIH', rec.rtype, rclass, rec.ttl, len(rec.rdata))
+        data += rec.rdata
+    return data
+
+
+def service_records(instance, service, port, txt, host, addrs):
+    '''
+    DNS-SD records of a service instance, txt given as a list of bytes and
+    the service and host names as tuples of labels
+    '''
+    fqdn = (instance,) + service
+    records = [
+        record(SERVICES, T_PTR, TTL_OTHER, False, pack_name(service)),
+        record(service, T_PTR, TTL_OTHER, False, pack_name(fqdn)),
+        record(
+            fqdn,
+            T_SRV,
+            TTL_HOST,
+            True,
+            struct.pack('!HHH', 0, 0, port) + pack_name(host),
+        ),
+        record(
+            fqdn,
+            T_TXT,
+            TTL_OTHER,
+            True,
+            b''.join(struct.pack('!B', len(item)) + item for item in txt) or b'\0',
+        ),
+    ]
+    for addr in addrs:
+        addr = ipaddress.ip_address(addr.split('%')[0])
+        rtype = T_AAAA if addr.version == 6 else T_A
+        records.append(record(host, rtype, TTL_HOST, True, addr.packed))
+    return records
+
+
+class MdnsResponder:
+    '''
+    Answer the mDNS queries received on an interface for the published
+    records. Known answers in the queries are not repeated, and a record is not
+    multicast again within RATE_LIMIT seconds.
+    '''
+
+    def __init__(self, ifindex, hostname=None):
+        self.ifindex = ifindex
+        self.host = ((hostname or socket.gethostname()).split('.')[0], 'local')
+        self.loop = asyncio.get_event_loop()
+        self.records = []
+        # (name, type, value): time it was last multicast
+        self.multicast = {}
+        self.socks = []
+
+    def _socket(self, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            ifindex = struct.pack('@I', self.ifindex)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(('::', MDNS_PORT))
+            sock.setsockopt(
+                socket.IPPROTO_IPV6,
+                socket.IPV6_JOIN_GROUP,
+                socket.inet_pton(family, MDNS_GROUP6) + ifindex,
+            )
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, ifindex)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, 255)
+        else:
+            # struct ip_mreqn
+            mreqn = socket.inet_aton(MDNS_GROUP4) + socket.inet_aton('0.0.0.0')
+            mreqn += struct.pack('@i', self.ifindex)
+            sock.bind(('', MDNS_PORT))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreqn)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, mreqn)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        sock.setblocking(False)
+        return sock
+
+    def start(self):
+        for family in (socket.AF_INET6, socket.AF_INET):
+            try:
+                sock = self._socket(family)
+            except OSError as exc:
+                logging.warning('mDNS responder not using %s: %s', family.name, exc)
+                continue
+            self.loop.add_reader(sock, self._read, sock)
+            self.socks.append(sock)
+        logging.info('mDNS responder started as %s.local.', self.host[0])
+
+    def stop(self):
+        # Goodbye packets, to remove the records from the caches
+        self._multicast([rec._replace(ttl=0) for rec in self.records], force=True)
+        self.records = []
+        for sock in self.socks:
+            self.loop.remove_reader(sock)
+            sock.close()
+        self.socks = []
+
+    def publish(self, instance, service, port, txt, addrs):
+        '''Set the records of a service instance, announcing the changed ones'''
+        records = service_records(instance, service, port, txt, self.host, addrs)
+        new_keys = set(self._key(rec) for rec in records)
+        old_keys = set(self._key(rec) for rec in self.records)
+        # Shared records no longer valid have to be removed explicitly
+        goodbyes = [
+            rec._replace(ttl=0)
+            for rec in self.records
+            if self._key(rec) not in new_keys and not rec.flush
+        ]
+        changed = [rec for rec in records if self._key(rec) not in old_keys]
+        self.records = records
+        if goodbyes:
+            self._multicast(goodbyes, force=True)
+        if changed:
+            self._announce(changed, ANNOUNCE_COUNT)
+        return len(changed)
+
+    def _announce(self, records, count):
+        # Stop announcing records replaced in the meantime
+        records = [rec for rec in records if rec in self.records]
+        if not records or not self.socks:
+            return
+        self._multicast(records, force=True)
+        if count > 1:
+            self.loop.call_later(ANNOUNCE_INTERVAL, self._announce, records, count - 1)
+
+    @staticmethod
+    def _key(rec):
+        return (_lower(rec.name), rec.rtype, rec.value)
+
+    def _send(self, data, dst):
+        for sock in self.socks:
+            if sock.family != (socket.AF_INET6 if ':' in dst[0] else socket.AF_INET):
+                continue
+            try:
+                sock.sendto(data, dst)
+            except OSError as exc:
+                logging.debug('mDNS send to %s failed: %s', dst[0], exc)
+
+    def _multicast(self, records, force=False):
+        now = time.monotonic()
+        if not force:
+            fresh = []
+            for rec in records:
+                if now - self.multicast.get(self._key(rec), -RATE_LIMIT) < RATE_LIMIT:
+                    SUPPRESSED.inc('rate_limit')
+                else:
+                    fresh.append(rec)
+            records = fresh
+        if not records:
+            return
+        for rec in records:
+            self.multicast[self._key(rec)] = now
+        data = pack_message(records)
+        self._send(data, (MDNS_GROUP6, MDNS_PORT, 0, self.ifindex))
+        self._send(data, (MDNS_GROUP4, MDNS_PORT))
+        SENT.inc('multicast', amount=len(records))
+
+    def _read(self, sock):
+        try:
+            data, addr = sock.recvfrom(MAX_SIZE)
+        except OSError:
+            return
+        # Only the exterior link, when the source scope is known
+        if len(addr) == 4 and addr[3] and addr[3] != self.ifindex:
+            return
+        self.handle(data, addr)
+
+    def answer(self, msg):
+        '''Answers and additional records for a query'''
+        known = {self._key(rec): rec.ttl for rec in msg.answers}
+        answers = []
+        for qname, qtype, _ in msg.questions:
+            for rec in self.records:
+                if _lower(rec.name) != qname or qtype not in (rec.rtype, T_ANY):
+                    continue
+                if rec in answers:
+                    continue
+                # Known-answer suppression (RFC 6762 section 7.1)
+                if known.get(self._key(rec), 0) >= rec.ttl / 2:
+                    SUPPRESSED.inc('known_answer')
+                    continue
+                answers.append(rec)
+
+        # The records a querier will need next (RFC 6763 section 12)
+        targets = set()
+        for rec in answers:
+            if rec.rtype == T_PTR:
+                targets.add(unpack_name(rec.value, 0)[0])
+            if rec.rtype in (T_PTR, T_SRV):
+                targets.add(_lower(self.host))
+        additionals = [
+            rec
+            for rec in self.records
+            if _lower(rec.name) in targets
+            and rec not in answers
+            and self._key(rec) not in known
+        ]
+        return answers, additionals
+
+    def handle(self, data, addr):
+        try:
+            msg = parse(data)
+        except (IndexError, ValueError, struct.error):
+            logging.debug('Malformed mDNS message from %s', addr[0])
+            return
+        # Only standard queries
+        if msg.flags & (FLAG_QR | OPCODE_MASK):
+            return
+        QUERIES.inc()
+        answers, additionals = self.answer(msg)
+        if not answers:
+            return
+
+        if addr[1] != MDNS_PORT:
+            # Legacy unicast query (RFC 6762 section 6.7)
+            records = [
+                rec._replace(ttl=min(rec.ttl, TTL_LEGACY), flush=False)
+                for rec in answers + additionals
+            ]
+            questions = [(name, qtype, C_IN) for name, qtype, _ in msg.questions]
+            data = pack_message(
+                records[: len(answers)],
+                records[len(answers) :],
+                id_=msg.id,
+                questions=questions,
+            )
+            self._send(data, addr)
+            SENT.inc('unicast', amount=len(records))
+        elif all(qclass & C_UNICAST for _, _, qclass in msg.questions):
+            # Unicast responses requested
+            self._send(pack_message(answers, additionals), addr)
+            SENT.inc('unicast', amount=len(answers) + len(additionals))
+        else:
+            self._multicast(answers + additionals)
@@ -0,0 +1,114 @@
+'''Internal counters exported in the Prometheus text format'''
+import bisect
+
+# Default histogram buckets in seconds, from a fast serial command to a slow
+# shell command
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+REGISTRY = []
+
+
+def _labels(names, values, extra=''):
+    pairs = [
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'),
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    '''
+    Monotonic value per combination of labels. Increments are not locked: a
+    concurrent increment from another thread may very rarely be lost, which is
+    fine for monitoring and keeps the hot paths cheap.
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self):
+        for values, value in list(self.values.items()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, values), value)
+
+
+class Gauge:
+    '''
+    Value read when exporting, from a function returning a number or a
+    {label values tuple: number} dictionary
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_, func, labels=()):
+        self.name = name
+        self.help = help_
+        self.func = func
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def render(self):
+        result = self.func()
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in result.items():
+            yield '%s%s %s' % (self.name, _labels(self.labels, values), value)
+
+
+class Histogram:
+    '''Distribution of observed values in fixed buckets'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = buckets
+        # Label values: [counts per bucket and +Inf, sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *values):
+        entry = self.values.get(values)
+        if entry is None:
+            entry = self.values.setdefault(values, [[0] * (len(self.buckets) + 1), 0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self):
+        for values, (counts, sum_) in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '%s_bucket%s %s' % (
+                    self.name,
+                    _labels(self.labels, values, 'le="%s"' % bound),
+                    total,
+                )
+            yield '%s_sum%s %s' % (self.name, _labels(self.labels, values), sum_)
+            yield '%s_count%s %s' % (self.name, _labels(self.labels, values), total)
+
+
+def render():
+    '''All the metrics in the Prometheus text exposition format'''
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
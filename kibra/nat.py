@@ -1,58 +1,200 @@
+import asyncio
 import ipaddress
+import json
 import logging
+import os
 import re
 
+import kibra.config as config
 import kibra.database as db
+import kibra.metrics as metrics
 from kibra.ktask import Ktask, status
-from kibra.shell import bash
+from kibra.shell import bash, bash_status
+
+# Well-known prefix for the IPv4-embedded IPv6 addresses (RFC 6052)
+NAT64_PREFIX = '64:ff9b::/96'
+
+# Jool instance configuration, applied at once with "jool file handle"
+JOOL_CONFIG = 'jool.json'
+JOOL_INSTANCE = 'default'
+# Ports and ICMP identifiers of every Pool 4 address, above the Linux
+# ephemeral ports. Each protocol has its own port space in Jool.
+POOL4_PORTS = {'TCP': (61001, 65535), 'UDP': (61001, 65535), 'ICMP': (61001, 65535)}
+# Seconds between reads of the Jool tables
+STATS_PERIOD = 60
+# Share of the Pool 4 ports in use that triggers a warning
+STATS_WARNING = 0.8
+
+# Desired and applied state: Pool 4 addresses and static BIB entries as
+# (protocol, IPv6 transport address, IPv4 transport address). Nothing is
+# applied while the engine is stopped, and FAILED after a rejected call.
+POOL4 = set()
+BIB = set()
+FAILED = (None, None)
+APPLIED = None
+
+# Protocol: BIB entries and sessions, as last read from Jool
+BIB_ENTRIES = {}
+SESSIONS = {}
+# Protocols whose Pool 4 usage is over the warning level
+EXHAUSTED = set()
+
+metrics.Gauge(
+    'kibra_nat64_pool4_ports',
+    'NAT64 Pool 4 transport addresses',
+    lambda: {(protocol,): pool4_size(protocol) for protocol in POOL4_PORTS},
+    ('protocol',),
+)
+metrics.Gauge(
+    'kibra_nat64_bib_entries',
+    'NAT64 BIB entries, each one uses a Pool 4 transport address',
+    lambda: {(protocol,): count for protocol, count in BIB_ENTRIES.items()},
+    ('protocol',),
+)
+metrics.Gauge(
+    'kibra_nat64_sessions',
+    'NAT64 sessions',
+    lambda: {(protocol,): count for protocol, count in SESSIONS.items()},
+    ('protocol',),
+)
+
+
+def _render():
+    data = {
+        'instance': JOOL_INSTANCE,
+        'framework': 'netfilter',
+        'global': {'pool6': NAT64_PREFIX},
+        'pool4': [
+            {'protocol': protocol, 'prefix': addr, 'port range': '%d-%d' % ports}
+            for addr in sorted(POOL4)
+            for protocol, ports in POOL4_PORTS.items()
+        ],
+        'bib': [
+            {'protocol': protocol, 'ipv6 address': ipv6, 'ipv4 address': ipv4}
+            for protocol, ipv6, ipv4 in sorted(BIB)
+        ],
+    }
+    return json.dumps(data, indent=2) + '\n'
+
+
+def jool_apply():
+    '''Apply the changes in the desired state with one Jool call'''
+    # Applied when the engine is started
+    if APPLIED is None:
+        return
+    pool4, bib = APPLIED
+    if APPLIED is FAILED:
+        logging.info('Applying the NAT64 engine configuration again.')
+    elif pool4 == POOL4 and bib == BIB:
+        return
+    else:
+        logging.info(
+            'Updating NAT64 engine: Pool 4 +%d -%d, BIB +%d -%d.',
+            len(POOL4 - pool4),
+            len(pool4 - POOL4),
+            len(BIB - bib),
+            len(bib - BIB),
+        )
+    _jool_handle()
 
-POOL4_ACTIVE = None
 
+def _jool_handle():
+    global APPLIED
 
-def _nat_enable():
-    global POOL4_ACTIVE
+    file_path = db.CFG_PATH + JOOL_CONFIG
+    config.write(file_path, _render())
+    if bash_status('jool file handle %s' % file_path):
+        # Jool state unknown, retried at the next change or statistics read
+        APPLIED = FAILED
+    else:
+        APPLIED = (set(POOL4), set(BIB))
 
-    _nat_disable()
 
-    bash('/sbin/modprobe jool')
-    POOL4_ACTIVE = False
+def _nat_enable():
+    # Keep the module, and its instance if it exists, from a previous run
+    if not os.path.isdir('/sys/module/jool'):
+        bash('/sbin/modprobe jool')
     logging.info('NAT64 engine started.')
 
-    bash('jool instance add --netfilter --pool6 64:ff9b::/96')
-    logging.info('Prefix 64:ff9b::/96 added to NAT64 engine.')
+    # The instance is created if needed, and updated otherwise
+    _jool_handle()
+    if APPLIED is not FAILED:
+        logging.info('Prefix %s added to NAT64 engine.', NAT64_PREFIX)
 
 
 def _nat_disable():
-    bash('/sbin/modprobe -r jool')
+    global APPLIED
+
+    APPLIED = None
+    bash('jool instance remove %s' % JOOL_INSTANCE)
     logging.info('NAT64 engine stopped.')
 
 
 def handle_nat64_masking(ext_addr, enable=True):
     '''Enable or disable one exterior IPv4 address in the NAT64 Pool 4'''
-    global POOL4_ACTIVE
-
     # Don't allow IPv6 addresses here
     try:
         ipaddress.IPv4Address(ext_addr)
     except:
         return
 
-    jool_action = 'add' if enable else 'remove'
     log_action = 'used' if enable else 'removed'
 
-    # Only allow one address in the Pool 4
-    if (enable and POOL4_ACTIVE) or (not enable and not POOL4_ACTIVE):
-        logging.info(
-            'Unable to %s %s as stateful NAT64 masking address.', jool_action, ext_addr
-        )
-        return
-
-    params = (jool_action, ext_addr)
-    bash('jool pool4 %s %s 61001-65535 --udp' % params)
-    bash('jool pool4 %s %s 61001-65535 --icmp' % params)
-    POOL4_ACTIVE = True
-
-    logging.info('%s %s as stateful NAT64 masking address.', ext_addr, log_action)
+    # Every exterior address adds its ports to the Pool 4
+    if enable:
+        POOL4.add(ext_addr)
+    else:
+        POOL4.discard(ext_addr)
+
+    logging.info(
+        '%s %s as stateful NAT64 masking address, %d in use.',
+        ext_addr,
+        log_action,
+        len(POOL4),
+    )
+
+
+def pool4_size(protocol):
+    '''Transport addresses of a protocol in the Pool 4'''
+    first, last = POOL4_PORTS[protocol]
+    return len(POOL4) * (last - first + 1)
+
+
+def _jool_count(table, protocol):
+    output = bash(
+        'jool %s display --%s --numeric --csv --no-headers' % (table, protocol.lower())
+    )
+    return len(output.splitlines()) if output else 0
+
+
+def jool_stats():
+    '''Read the Jool tables occupancy and warn before the Pool 4 runs out'''
+    for protocol in POOL4_PORTS:
+        BIB_ENTRIES[protocol] = _jool_count('bib', protocol)
+        SESSIONS[protocol] = _jool_count('session', protocol)
+        size = pool4_size(protocol)
+        usage = BIB_ENTRIES[protocol] / size if size else 0
+        if usage >= STATS_WARNING and protocol not in EXHAUSTED:
+            EXHAUSTED.add(protocol)
+            logging.warning(
+                'NAT64 %s Pool 4 is %d%% used (%d of %d), new flows will fail '
+                'when it runs out.',
+                protocol,
+                100 * usage,
+                BIB_ENTRIES[protocol],
+                size,
+            )
+        elif usage < STATS_WARNING and protocol in EXHAUSTED:
+            EXHAUSTED.discard(protocol)
+            logging.info('NAT64 %s Pool 4 is %d%% used.', protocol, 100 * usage)
+
+
+def handle_bib(protocol, ipv6, ipv4, enable=True):
+    '''Enable or disable a static BIB entry, addresses given as addr#port'''
+    if enable:
+        BIB.add((protocol, ipv6, ipv4))
+    else:
+        BIB.discard((protocol, ipv6, ipv4))
 
 
 class NAT(Ktask):
@@ -71,3 +213,9 @@ class NAT(Ktask):
 
     def kstop(self):
         _nat_disable()
+
+    async def periodic(self):
+        jool_apply()
+        # The Jool tables can be long, keep the reading off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, jool_stats)
+        return STATS_PERIOD
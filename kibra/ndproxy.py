@@ -16,6 +16,7 @@ import struct
 import time
 
 import kibra.database as db
+import kibra.metrics as metrics
 import kibra.network as NETWORK
 from kibra.thread import DEFS
 
@@ -43,6 +44,13 @@ OPT_FMT = '!BB%ss'
 EXT_IFNUMBER = None
 EXT_EUI48 = None
 
+NS_RECEIVED = metrics.Counter(
+    'kibra_nd_ns_received_total', 'Neighbor Solicitations received'
+)
+NA_SENT = metrics.Counter(
+    'kibra_nd_na_sent_total', 'Neighbor Advertisements sent', ('solicited',)
+)
+
 
 def icmp6_filter_setpass(filter_, type_):
     index = 4 * int(type_ / 32) + 3 - int((type_ % 32) / 8)
@@ -116,24 +124,29 @@ class NDProxy:
             except:
                 # socket.timeout: timed out
                 time.sleep(0.2)
-
-            # Accepting Neighbor solicit only
-            if data[0] != ND_NEIGHBOR_SOLICIT:
                 continue
+            self.handle_ns(data, src)
+
+    def handle_ns(self, data, src):
+        '''Answer the Neighbor Solicitations for our addresses and DUAs'''
+        # Accepting Neighbor solicit only
+        if data[0] != ND_NEIGHBOR_SOLICIT:
+            return
 
-            # Get the paramters
-            _, _, _, _, tgt = struct.unpack(NS_FMT, data[: struct.calcsize(NS_FMT)])
+        # Get the paramters
+        _, _, _, _, tgt = struct.unpack(NS_FMT, data[: struct.calcsize(NS_FMT)])
+        NS_RECEIVED.inc()
 
-            # Debug
-            ns_tgt = ipaddress.IPv6Address(tgt).compressed
-            logging.info('in ns from %s for %s' % (src[0], ns_tgt))
+        # Debug
+        ns_tgt = ipaddress.IPv6Address(tgt).compressed
+        logging.info('in ns from %s for %s' % (src[0], ns_tgt))
 
-            # Generate Neighbor Advertisement
-            if ns_tgt in db.get('exterior_addrs'):
-                self.send_na(src[0], ns_tgt)
-            elif ns_tgt in list(self.duas.keys()):
-                delayed = not ns_tgt in db.get('ncp_eid_cache')
-                self.send_na(src[0], ns_tgt, delayed=delayed)
+        # Generate Neighbor Advertisement
+        if ns_tgt in db.get('exterior_addrs'):
+            self.send_na(src[0], ns_tgt)
+        elif ns_tgt in list(self.duas.keys()):
+            delayed = not ns_tgt in db.get('ncp_eid_cache')
+            self.send_na(src[0], ns_tgt, delayed=delayed)
 
     def add_del_dua(self, action, dua, reg_time=0, ifnumber=None):
         if not 'primary' in db.get('bbr_status'):
@@ -216,6 +229,7 @@ class NDProxy:
         # Send ICMPv6 packet
         try:
             self.icmp6_sock.sendto(header + opts, (dst, 0, 0, EXT_IFNUMBER))
+            NA_SENT.inc(int(solicited))
         except Exception as exc:
             logging.warn('Cannot send NA to %s. Error: %s' % (dst, exc))
 
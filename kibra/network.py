@@ -1,7 +1,12 @@
+import asyncio
+import collections
+import errno
 import hashlib
 import ipaddress
 import json
 import logging
+import math
+import select
 import socket
 import struct
 import time
@@ -9,11 +14,11 @@ import time
 import kibra
 import kibra.database as db
 import kibra.iptables as IPTABLES
-import kibra.dhcp as DHCP
 import kibra.coapserver as COAPSERVER
 import kibra.mdns as MDNS
 import kibra.nat as NAT
 import pyroute2  # http://docs.pyroute2.org/iproute.html#api
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR, RTMGRP_IPV6_IFADDR, RTMGRP_LINK
 from kibra.ktask import Ktask
 from kibra.shell import bash
 
@@ -25,6 +30,13 @@ IFF_UP = 0x1
 IFF_LOOPBACK = 0x8
 IFF_MULTICAST = 0x1000
 
+# Netlink notifications received by the network task
+NETLINK_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR
+# Seconds between checks of the netlink monitor being stopped
+NETLINK_POLL = 1
+# Event queued when notifications were lost and a full dump is needed
+NETLINK_RESYNC = 'RESYNC'
+
 
 def send_udp(host, port, payload=''):
     '''TH: Send IPv6 UDP datagram to the exterior interface'''
@@ -270,9 +282,7 @@ def handle_addr(addr, action='add'):
             # Changes in RLOC affect servers
             if old_ncp_rloc and addr != old_ncp_rloc:
                 IPR.addr('del', index=idx, address=old_ncp_rloc, prefixlen=64)
-                # Restart DHCP server
-                DHCP.dhcp_server_stop()
-                DHCP.dhcp_server_start()
+                # The DHCP task reconfigures the server when it sees the change
                 if old_ncp_rloc:
                     # Reconfigure Iptables for Diagnostics
                     IPTABLES.handle_diag('D', old_ncp_rloc)
@@ -281,10 +291,7 @@ def handle_addr(addr, action='add'):
                     for ext_addr in db.get('exterior_addrs'):
                         IPTABLES.handle_bagent_fwd(ext_addr, old_ncp_rloc, enable=False)
                         IPTABLES.handle_bagent_fwd(ext_addr, addr, enable=True)
-        elif type_ == 'dhcp_aloc':
-            # Restart DHCP server
-            DHCP.dhcp_server_stop()
-            DHCP.dhcp_server_start()
+                    NAT.jool_apply()
         elif type_ == 'bbr_primary_aloc':
             if 'primary' not in db.get('bbr_status'):
                 db.set('bbr_status', 'primary')
@@ -433,6 +440,93 @@ def ncp_route_disable(prefix):
         logging.warning('Route for %s could not be disabled', prefix)
 
 
+def _link_up(index):
+    try:
+        links = IPR.get_links(index)
+    except Exception:
+        return False
+    return bool(links) and bool(links[0]['flags'] & IFF_UP)
+
+
+class NetlinkMonitor:
+    '''
+    Queue the link and address changes of some interfaces as (event, index,
+    address) tuples, calling notify in the event loop when there are new ones
+    '''
+
+    def __init__(self, indexes, notify):
+        self.indexes = indexes
+        self.notify = notify
+        self.events = collections.deque()
+        self.loop = asyncio.get_event_loop()
+        self._open()
+
+        # Run the daemon
+        self.running = True
+        self.loop.run_in_executor(None, self.run_daemon)
+
+    def stop(self):
+        self.running = False
+
+    def _open(self):
+        ipr = pyroute2.IPRoute()
+        try:
+            ipr.bind(groups=NETLINK_GROUPS)
+        except OSError:
+            ipr.close()
+            raise
+        self.ipr = ipr
+
+    def _reopen(self):
+        '''Replace a failed socket, retrying until it works or is stopped'''
+        try:
+            self.ipr.close()
+        except OSError:
+            pass
+        while self.running:
+            try:
+                self._open()
+                return
+            except OSError as exc:
+                logging.warning('Netlink socket not available: %s', exc)
+                time.sleep(NETLINK_POLL)
+
+    def run_daemon(self):
+        while self.running:
+            try:
+                ready, _, _ = select.select([self.ipr], [], [], NETLINK_POLL)
+                if not ready:
+                    continue
+                msgs = self.ipr.get()
+            except OSError as exc:
+                if exc.errno == errno.ENOBUFS:
+                    # The socket buffer overflowed, some changes were lost
+                    logging.warning('Netlink notifications lost, resynchronizing.')
+                else:
+                    logging.warning('Netlink socket failed (%s), reopening it.', exc)
+                    self._reopen()
+                self.events.append((NETLINK_RESYNC, None, None))
+                msgs = []
+            for msg in msgs:
+                if msg.get('index') not in self.indexes:
+                    continue
+                if msg['event'] in ('RTM_NEWADDR', 'RTM_DELADDR'):
+                    value = msg.get_attr('IFA_ADDRESS')
+                else:
+                    value = msg['flags']
+                self.events.append((msg['event'], msg['index'], value))
+            if self.events:
+                self.loop.call_soon_threadsafe(self.notify)
+        self.ipr.close()
+
+    def pop(self):
+        '''Return and forget the events received so far'''
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
 class NETWORK(Ktask):
     def __init__(self):
         Ktask.__init__(
@@ -442,45 +536,85 @@ class NETWORK(Ktask):
             start_tasks=[],
             stop_tasks=['diags', 'coapserver'],
             period=1,
+            watch_keys=['ncp_rloc'],
         )
         self.syslog = None
+        self.netlink = None
+        # Exterior addresses dumped since the last lost notification
+        self.synced = False
 
     def kstart(self):
         ncp_conf()
         _ifup()
         IPTABLES.handle_ipv6('A')
+        self.synced = False
+        self.netlink = NetlinkMonitor(
+            [db.get('interior_ifnumber'), db.get('exterior_ifnumber')], self._notify
+        )
 
     def kstop(self):
+        if self.netlink:
+            self.netlink.stop()
+            self.netlink = None
         IPTABLES.handle_ipv6('D')
         _ifdown()
 
-    async def periodic(self):
-        # Detect if interior interface goes down
-        try:
-            IPR.link_lookup(ifname=db.get('interior_ifname'), operstate='UP')
-        except:
-            logging.error('Interface %s went down.', db.get('interior_ifname'))
-            self.kstop()
-            self.kill()
-
-        # Don't continue if NCP RLOC has not been asigned yet
-        if not db.has_keys(['ncp_rloc']):
-            return
-
-        # Keep track of exterior addresses
-        iface_addrs = []
-        iface_addrs += get_addrs(db.get('exterior_ifname'), socket.AF_INET)
-        iface_addrs += get_addrs(db.get('exterior_ifname'), socket.AF_INET6)
+    def _notify(self):
+        if self.wakeup:
+            self.wakeup.set()
 
-        # Find which addresses to remove and which ones to add
+    async def periodic(self):
+        interior = db.get('interior_ifnumber')
+        exterior = db.get('exterior_ifnumber')
         ext_addrs = db.get('exterior_addrs')
-        old_addrs = ext_addrs
         new_addrs = []
-        for addr in iface_addrs:
-            if addr not in old_addrs:
-                new_addrs.append(addr)
-            else:
-                old_addrs.remove(addr)
+        old_addrs = []
+
+        for event, index, value in self.netlink.pop():
+            if event == NETLINK_RESYNC:
+                self.synced = False
+                # The lost changes may include the interior interface going down
+                if not _link_up(interior):
+                    logging.error('Interface %s went down.', db.get('interior_ifname'))
+                    self.kill()
+                    return math.inf
+            elif index == interior and event in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                # Detect if interior interface goes down
+                if event == 'RTM_DELLINK' or not value & IFF_UP:
+                    logging.error('Interface %s went down.', db.get('interior_ifname'))
+                    self.kill()
+                    return math.inf
+            elif index == exterior and event == 'RTM_NEWADDR':
+                if value not in ext_addrs:
+                    ext_addrs.append(value)
+                    if value in old_addrs:
+                        old_addrs.remove(value)
+                    else:
+                        new_addrs.append(value)
+            elif index == exterior and event == 'RTM_DELADDR':
+                if value in ext_addrs:
+                    ext_addrs.remove(value)
+                    if value in new_addrs:
+                        new_addrs.remove(value)
+                    else:
+                        old_addrs.append(value)
+
+        # Don't continue if NCP RLOC has not been asigned yet, the addresses
+        # are dumped when it is
+        if not db.has_keys(['ncp_rloc']):
+            self.synced = False
+            return math.inf
+
+        if not self.synced:
+            # Keep track of exterior addresses
+            iface_addrs = []
+            iface_addrs += get_addrs(db.get('exterior_ifname'), socket.AF_INET)
+            iface_addrs += get_addrs(db.get('exterior_ifname'), socket.AF_INET6)
+            known = set(db.get('exterior_addrs'))
+            new_addrs = [addr for addr in iface_addrs if addr not in known]
+            old_addrs = list(known.difference(iface_addrs))
+            ext_addrs = iface_addrs
+            self.synced = True
 
         # Remove old addresses
         for addr in old_addrs:
@@ -493,8 +627,14 @@ class NETWORK(Ktask):
             NAT.handle_nat64_masking(addr, enable=True)
             IPTABLES.handle_bagent_fwd(addr, db.get('ncp_rloc'), enable=True)
 
+        # All the NAT64 changes in one call
+        NAT.jool_apply()
+
         # Notify MDNS service
         if new_addrs:
             MDNS.new_external_addresses()
 
-        db.set('exterior_addrs', iface_addrs)
+        db.set('exterior_addrs', ext_addrs)
+
+        # Nothing else to do until the next netlink event
+        return math.inf
@@ -0,0 +1,79 @@
+const loopUpdateMs = 5000;
+const loopJsonLocation = "http://" + window.location.hostname + "/db/loop";
+
+const offendersColumnValues = ["origin", "count", "worst", "total"];
+const offendersColumnNames = ["Origin", "Count", "Worst (s)", "Total (s)"];
+const stallsColumnValues = ["time", "duration", "origin", "where", "stack"];
+const stallsColumnNames = ["Time", "Duration (s)", "Origin", "Location", "Stack"];
+const wakeupsColumnValues = ["task", "wakeups"];
+const wakeupsColumnNames = ["Task", "Wakeups"];
+
+var offendersTbody = tableInit("#offendersdiv", offendersColumnNames);
+var stallsTbody = tableInit("#stallsdiv", stallsColumnNames);
+var wakeupsTbody = tableInit("#wakeupsdiv", wakeupsColumnNames);
+
+loopUpdateData();
+setInterval(loopUpdateData, loopUpdateMs);
+
+function loopUpdateData() {
+  d3.json(loopJsonLocation, function (error, jsonData) {
+    if (error || !jsonData.stalls) {
+      return;
+    }
+    d3.select("#loopsummary").text(jsonData.stalls.length +
+      " callbacks blocked the event loop for more than " + jsonData.threshold + " s.");
+    var offenders = Object.keys(jsonData.offenders).map(function (origin) {
+      var offender = jsonData.offenders[origin];
+      offender.origin = origin;
+      return offender;
+    });
+    offenders.sort(function (a, b) { return b.worst - a.worst; });
+    jsonData.stalls.forEach(function (stall) {
+      stall.time = (new Date(stall.time * 1000)).toLocaleString();
+    });
+    tableUpdate(offendersTbody, offenders, offendersColumnValues);
+    tableUpdate(stallsTbody, jsonData.stalls, stallsColumnValues);
+    var wakeups = Object.keys(jsonData.wakeups).map(function (task) {
+      return { task: task, wakeups: jsonData.wakeups[task] };
+    });
+    wakeups.sort(function (a, b) { return b.wakeups - a.wakeups; });
+    tableUpdate(wakeupsTbody, wakeups, wakeupsColumnValues);
+  });
+}
+
+//##### Table section #####
+
+function tableInit(div, columnNames) {
+  var table = d3.select(div).append("table");
+  table.append("thead").append("tr")
+    .selectAll("th")
+    .data(columnNames)
+    .enter()
+    .append("th")
+    .text(function (column) {
+      return column;
+    });
+  return table.append("tbody");
+}
+
+function tableUpdate(tbody, data, columnValues) {
+  var rows = tbody.selectAll("tr").data(data);
+  rows.enter().append("tr");
+  rows.exit().remove();
+
+  var cells = rows.selectAll("td")
+    .data(function (row) {
+      return columnValues.map(function (column) {
+        return row[column];
+      });
+    });
+  cells.enter().append("td");
+  cells.exit().remove();
+  cells.style("white-space", function (d, i) {
+    return columnValues[i] == "stack" ? "pre" : null;
+  }).style("text-align", function (d, i) {
+    return columnValues[i] == "stack" ? "left" : null;
+  }).text(function (d) {
+    return d;
+  });
+}
@@ -1,11 +1,12 @@
 const forceUpdateMs = 5000;
 const jsonLocation = "http://" + window.location.hostname + "/db/nodes";
+const eventsLocation = jsonLocation + "/events";
 // Force variables
 var nodes = [],
   links = [];
 var roles = ['leader', 'borderRouter', 'router', 'child', 'internet'];
 var linkQualities = ['bad', 'normal', 'good', 'child', 'online', 'offline'];
-var width, height, linkLayer, nodeLayer, force, labelInfo, drag, nodeInfo, legend;
+var width, height, linkLayer, nodeLayer, brLayer, baseLayer, shapeLayer, labelLayer, cloudLayer, force, labelInfo, drag, nodeInfo, legend;
 // Table variables
 var tableData = [];
 const columnValues = ["rloc16", "id", "isLeader", "isBorderRouter", "isRouter", "isEndDevice", "active", "firstSeen", "lastSeen"];
@@ -20,39 +21,83 @@ forceInit();
 var table = d3.select("#tablediv");
 tableInit();
 
+// Topology generation and version known by this view
+var nodesGeneration = null,
+  nodesVersion = null;
 updateData();
-setInterval(updateData, forceUpdateMs);
+if (window.EventSource) {
+  nodesStream();
+} else {
+  setInterval(updateData, forceUpdateMs);
+}
 
-function updateData() {
-  var dateOptions = {
-    weekday: 'short', year: 'numeric', month: 'short',
-    day: 'numeric', hour: 'numeric', minute: 'numeric', second: 'numeric',
-    hour12: false
+function nodesStream() {
+  var source = new EventSource(eventsLocation);
+  source.addEventListener("nodes", function (event) {
+    applyNodes(JSON.parse(event.data));
+  });
+  source.onerror = function () {
+    // Fall back to polling if the stream cannot be used
+    if (source.readyState === EventSource.CLOSED)
+      setInterval(updateData, forceUpdateMs);
   };
-  d3.json(jsonLocation, function (error, network) {
+}
+
+function updateData() {
+  var location = jsonLocation;
+  if (nodesVersion !== null)
+    location += "?since=" + nodesVersion + "&generation=" + nodesGeneration;
+  d3.json(location, function (error, network) {
     if (error) {
       // Restart visualization
       nodes = [];
       links = [];
+      nodesGeneration = null;
+      nodesVersion = null;
       notify("No access to database.");
-    } else if ("nodes" in network) {
-      network.nodes.forEach(function (node) {
-        var date = new Date(node.lastSeen);
-        node.lastSeen = date.toLocaleDateString('en-US', dateOptions);
-        date = new Date(node.firstSeen);
-        node.firstSeen = date.toLocaleDateString('en-US', dateOptions);
-        addForceNode(node);
-        addTableNode(node);
-        // Delete node
-        if (node.active == "no")
-          delForceNode(node);
-      });
-      updateForce();
-      updateTable();
+    } else {
+      applyNodes(network);
     }
   });
 }
 
+function applyNodes(network) {
+  var dateOptions = {
+    weekday: 'short', year: 'numeric', month: 'short',
+    day: 'numeric', hour: 'numeric', minute: 'numeric', second: 'numeric',
+    hour12: false
+  };
+  if (!("nodes" in network)) return;
+  if (network.generation === nodesGeneration && network.version === nodesVersion)
+    return;
+  // A full snapshot replaces the current view
+  if (!("removed" in network)) {
+    nodes = [];
+    links = [];
+    tableData = [];
+  }
+  nodesGeneration = network.generation;
+  nodesVersion = network.version;
+  network.nodes.forEach(function (node) {
+    var date = new Date(node.lastSeen);
+    node.lastSeen = date.toLocaleDateString('en-US', dateOptions);
+    date = new Date(node.firstSeen);
+    node.firstSeen = date.toLocaleDateString('en-US', dateOptions);
+    addForceNode(node);
+    addTableNode(node);
+    // Delete node
+    if (node.active == "no")
+      delForceNode(node);
+  });
+  (network.removed || []).forEach(function (rloc16) {
+    var node = getTableNode(rloc16);
+    if (node !== null) node.active = "no";
+    delForceNode({ "rloc16": rloc16 });
+  });
+  updateForce();
+  updateTable();
+}
+
 //##### Force section #####
 //window.addEventListener('resize', forceInit);
 function forceInit() {
@@ -70,6 +115,26 @@ function forceInit() {
 
   linkLayer = holder.append("g");
   nodeLayer = holder.append("g");
+  // Keep the drawing order of the node elements
+  brLayer = nodeLayer.append("g");
+  baseLayer = nodeLayer.append("g");
+  shapeLayer = nodeLayer.append("g");
+  labelLayer = nodeLayer.append("g");
+  cloudLayer = nodeLayer.append("g");
+
+  linkLayer.append("defs").selectAll("marker")
+    .data(["good", "normal", "bad"])
+    .enter().append("marker")
+    .attr("id", function (d) {
+      return d;
+    }).attr("viewBox", "0 -5 10 10")
+    .attr("refX", 29)
+    .attr("refY", 0)
+    .attr("markerWidth", 7)
+    .attr("markerHeight", 9)
+    .attr("orient", "auto")
+    .append("path")
+    .attr("d", "M0,-5L15,0L0,5");
 
   legend = holder.append("g")
     .append("text")
@@ -84,8 +149,8 @@ function forceInit() {
   labelInfo = 0;
 
   force.on("tick", function (e) {
-    linkLayer.selectAll(".link").attr("d", linkArc);
-    linkLayer.selectAll(".link.child, .link.online, .link.offline").attr("d", linkLine);
+    linkLayer.selectAll(".link.router").attr("d", linkArc);
+    linkLayer.selectAll(".link.tree").attr("d", linkLine);
     nodeLayer.selectAll(".nodebase, .node, .label, .cloud, .br").attr("transform", translate);
     nodeLayer.selectAll(".label").text(getLabel);
   });
@@ -140,78 +205,73 @@ function updateForce() {
       (l.quality == 'offline');
   });
 
-  linkLayer.selectAll('*').remove();
-  nodeLayer.selectAll('*').remove();
-
-  linkLayer.append("defs").selectAll("marker")
-    .data(["good", "normal", "bad"])
-    .enter().append("marker")
-    .attr("id", function (d) {
-      return d;
-    }).attr("viewBox", "0 -5 10 10")
-    .attr("refX", 29)
-    .attr("refY", 0)
-    .attr("markerWidth", 7)
-    .attr("markerHeight", 9)
-    .attr("orient", "auto")
-    .append("path")
-    .attr("d", "M0,-5L15,0L0,5");
-
-  linkLayer.selectAll(".link").data(linksRouter)
-    .enter().append("path")
-    .attr("class", function (d) {
-      return "link " + d.quality;
-    }).attr("marker-end", function (d) {
-      return "url(#" + d.quality + ")";
-    })
-    .attr("d", linkArc);
-
-  linkLayer.selectAll(".link.child").data(linksChild)
-    .enter().append("path")
-    .attr("class", function (d) {
-      return "link " + d.quality;
-    }).attr("d", linkLine);
-
-  nodeLayer.selectAll(".br").data(br)
-    .enter().append("path")
+  // Only the changed elements are entered, updated or removed
+  var routerLink = linkLayer.selectAll(".link.router").data(linksRouter, linkKey);
+  routerLink.enter().append("path");
+  routerLink.attr("class", function (d) {
+    return "link router " + d.quality;
+  }).attr("marker-end", function (d) {
+    return "url(#" + d.quality + ")";
+  }).attr("d", linkArc);
+  routerLink.exit().remove();
+
+  var childLink = linkLayer.selectAll(".link.tree").data(linksChild, linkKey);
+  childLink.enter().append("path");
+  childLink.attr("class", function (d) {
+    return "link tree " + d.quality;
+  }).attr("d", linkLine);
+  childLink.exit().remove();
+
+  var brShapes = brLayer.selectAll(".br").data(br, nodeKey);
+  brShapes.enter().append("path")
     .attr("d", brShape)
     .attr("class", "br");
+  brShapes.exit().remove();
 
-  nodeLayer.selectAll(".nodebase").data(devices)
-    .enter().append("circle")
+  var bases = baseLayer.selectAll(".nodebase").data(devices, nodeKey);
+  bases.enter().append("circle")
     .attr("r", 18)
-    .attr("class", function (n) {
-      if (getMainRole(n) == 'child') return "nodebase child";
-      return "nodebase";
-    })
     .on("dblclick", dblclick)
     .on("mouseover", showInfo)
     .on("mouseout", hideInfo)
     .call(drag);
+  bases.attr("class", function (n) {
+    if (getMainRole(n) == 'child') return "nodebase child";
+    return "nodebase";
+  });
+  bases.exit().remove();
 
-  nodeLayer.selectAll(".node").data(devices)
-    .enter().append("path")
-    .attr("d", threadShape)
-    .attr("class", function (n) {
-      return "node " + getMainRole(n);
-    });
+  var shapes = shapeLayer.selectAll(".node").data(devices, nodeKey);
+  shapes.enter().append("path")
+    .attr("d", threadShape);
+  shapes.attr("class", function (n) {
+    return "node " + getMainRole(n);
+  });
+  shapes.exit().remove();
 
-  nodeLayer.selectAll(".label").data(devices)
-    .enter().append("g").append("text")
-    .text(getLabel)
+  var labels = labelLayer.selectAll(".label").data(devices, nodeKey);
+  labels.enter().append("text")
     .attr("y", -24)
     .attr("class", "label")
     .on("click", labelInfoUpdate);
+  labels.text(getLabel);
+  labels.exit().remove();
 
-  globeCloud = nodeLayer.selectAll(".cloud").data(cloud).enter()
-  globeCloud.append("path")
+  var clouds = cloudLayer.selectAll(".cloud").data(cloud, nodeKey);
+  clouds.enter().append("path")
     .attr("d", cloudShape)
     .attr("class", "cloud")
     .on("dblclick", dblclick)
     .call(drag);
-  //globeCloud.append("path")
-  //  .attr("d", globeShape)
-  //  .attr("class", "cloud");
+  clouds.exit().remove();
+}
+
+function nodeKey(node) {
+  return node.rloc16;
+}
+
+function linkKey(link) {
+  return link.id;
 }
 
 function getMainRole(node) {
@@ -386,7 +446,6 @@ function delForceNode(node) {
   nodes = nodes.filter(function (n) {
     return n.rloc16 !== node.rloc16;
   });
-  updateForce();
 }
 
 function updateLinks(newNode) {
@@ -553,13 +612,14 @@ function updateTable() {
 }
 
 function addTableNode(jsonNode) {
-  var newNode = getTableNode(jsonNode.rloc16);
-  if (newNode === null) {
-    newNode = jsonNode;
-    tableData.push(newNode);
+  var oldNode = getTableNode(jsonNode.rloc16);
+  if (oldNode === null) {
+    tableData.push(jsonNode);
+  } else {
+    tableData[tableData.indexOf(oldNode)] = jsonNode;
   }
   // Update node information
-  newNode = jsonNode;
+  var newNode = jsonNode;
   if (newNode.roles.indexOf('leader') > -1)
     newNode.isLeader = 'x';
   if (newNode.roles.indexOf('border-router') > -1)
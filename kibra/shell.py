@@ -1,15 +1,21 @@
 import logging
+import time
 
+import kibra.metrics as metrics
 from bash import bash as alexcouperbash
 from colorama import Fore
 from colorama import init as colinit
 
 DEBUG = True
 
+COMMANDS = metrics.Histogram(
+    'kibra_bash_seconds', 'Duration of the shell commands run in a subprocess'
+)
+
 # TODO: https://docs.python.org/3/library/asyncio-subprocess.html
 
 
-def bash(command):
+def _run(command):
     if DEBUG:
         '''
         colinit()
@@ -17,11 +23,32 @@ def bash(command):
                                   command, Fore.RESET))
         '''
         logging.info(command)
+    start = time.perf_counter()
     stdout = alexcouperbash(command)
+    COMMANDS.observe(time.perf_counter() - start)
     if stdout:
         '''
         if DEBUG:
             print('%s%s%s' % (Fore.MAGENTA, stdout, Fore.RESET))
         '''
         logging.info(stdout)
+    return stdout
+
+
+def bash(command):
+    stdout = _run(command)
+    if stdout:
         return stdout.value()
+
+
+def bash_status(command):
+    '''Run a command and return its exit status, logging its errors'''
+    result = _run(command)
+    if result.code:
+        logging.warning(
+            'Command "%s" failed with status %d: %s',
+            command,
+            result.code,
+            (result.stderr or b'').decode(errors='replace').strip(),
+        )
+    return result.code
@@ -0,0 +1,4 @@
+'''
+Simulated KiNOS NCP, syslog messages and Thread/backbone CoAP peers, to run
+KiBRA and its benchmarks without a real dongle
+'''
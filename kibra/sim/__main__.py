@@ -0,0 +1,139 @@
+'''Run KiBRA with a simulated NCP, or generate syslog and CoAP load'''
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from kibra.sim.syslog import SyslogEmitter
+
+
+def _daemon(args):
+    from kibra import __main__ as kibra_main
+    from kibra.sim import ncp
+
+    ifindex = socket.if_nametoindex(args.syslog_if) if args.syslog_if else 0
+    syslog = SyslogEmitter(args.syslog_dst, ifindex=ifindex)
+    ncp.install(latency=args.latency / 1000, syslog=syslog)
+    kibra_main.main()
+
+
+def _peers(args):
+    from kibra.sim.peers import PeerPopulation
+
+    population = PeerPopulation(
+        args.count, args.mesh, args.backbone, dua_prefix=args.prefix
+    )
+    asyncio.get_event_loop().run_until_complete(
+        population.run(args.rate, args.duration)
+    )
+    print(json.dumps(population.report(), indent=2))
+
+
+def _syslog(args):
+    ifindex = socket.if_nametoindex(args.syslog_if) if args.syslog_if else 0
+    syslog = SyslogEmitter(args.syslog_dst, ifindex=ifindex)
+    # Alternate EID cache additions and deletions
+    start = time.time()
+    for i in range(args.count):
+        eid = 'fd00::%x' % (i // 2 + 1)
+        if i % 2:
+            syslog.cache_del(eid)
+        else:
+            syslog.cache_add(eid)
+        delay = start + (i + 1) / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.time() - start
+    print('%d messages in %.2f s' % (syslog.sent, elapsed))
+    syslog.close()
+
+
+def _mdns(args):
+    from kibra.mdnsd import (
+        ANNOUNCE_COUNT,
+        ANNOUNCE_INTERVAL,
+        RATE_LIMIT,
+        MdnsResponder,
+        T_PTR,
+    )
+    from kibra.sim.mdns import MdnsBrowser, describe
+
+    ifindex = socket.if_nametoindex(args.interface)
+    service = ('_meshcop', '_udp', 'local')
+    if args.serve:
+        # A responder with sample records in this process, over the loopback
+        # of the multicast traffic
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        responder = MdnsResponder(ifindex, hostname='kibra-sim')
+        responder.start()
+        txt = [b'rv=1', b'tv=1.2.0', b'sb=\x00\x00\x01\xb1', b'nn=KiNOS']
+        responder.publish('Sim Kirale KTDG', service, 49191, txt, ['fe80::1'])
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        # Let the announcements go, they also start the rate limiting
+        time.sleep(ANNOUNCE_COUNT * ANNOUNCE_INTERVAL + RATE_LIMIT)
+
+    browser = MdnsBrowser(ifindex)
+    report = {}
+    records, delay = browser.query(service, timeout=args.timeout)
+    report['records'] = sorted(set(describe(rec) for rec in records))
+    report['delay_ms'] = delay and round(1000 * delay, 2)
+    # Same query right away: multicast rate limited
+    again, _ = browser.query(service, timeout=args.timeout)
+    report['rate_limited'] = not again
+    # With the answers already known: suppressed
+    time.sleep(RATE_LIMIT)
+    known = [rec for rec in records if rec.rtype == T_PTR and rec.name == service]
+    suppressed, _ = browser.query(service, known=known, timeout=args.timeout)
+    report['known_answers_suppressed'] = bool(known) and not any(
+        rec.rtype == T_PTR and rec.name == service for rec in suppressed
+    )
+    browser.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python3 -m kibra.sim', description='KiBRA simulator'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    daemon = commands.add_parser('daemon', help='run KiBRA with a fake NCP')
+    daemon.add_argument(
+        '--latency', type=float, default=5, help='ms per serial command'
+    )
+    peers = commands.add_parser('peers', help='simulated Thread devices and BBRs')
+    peers.add_argument('--count', type=int, default=100, help='number of devices')
+    peers.add_argument('--mesh', required=True, help='BBR mesh address (RLOC)')
+    peers.add_argument('--backbone', required=True, help='BBR backbone address')
+    peers.add_argument('--prefix', default='fd00:7d03::/64', help='DUA prefix')
+    peers.add_argument('--rate', type=float, default=50, help='messages per second')
+    peers.add_argument('--duration', type=float, default=10, help='seconds')
+    syslog = commands.add_parser('syslog', help='EID cache syslog messages')
+    syslog.add_argument('--count', type=int, default=1000, help='messages')
+    syslog.add_argument('--rate', type=float, default=100, help='messages per second')
+    mdns = commands.add_parser('mdns', help='browse the MeshCoP mDNS service')
+    mdns.add_argument('--interface', required=True, help='exterior interface name')
+    mdns.add_argument('--timeout', type=float, default=1, help='seconds per query')
+    mdns.add_argument(
+        '--serve', action='store_true', help='also run a responder with sample records'
+    )
+    for command in (daemon, syslog):
+        command.add_argument(
+            '--syslog-dst', default='::1', help='KiBRA interior link-local address'
+        )
+        command.add_argument('--syslog-if', help='KiBRA interior interface name')
+
+    args = parser.parse_args()
+    if args.command == 'daemon':
+        _daemon(args)
+    elif args.command == 'peers':
+        _peers(args)
+    elif args.command == 'syslog':
+        _syslog(args)
+    elif args.command == 'mdns':
+        _mdns(args)
@@ -0,0 +1,97 @@
+'''mDNS browser for the MeshCoP service, to check the KiBRA mDNS responder'''
+import socket
+import struct
+import time
+
+from kibra.mdnsd import (
+    C_IN,
+    C_UNICAST,
+    MAX_SIZE,
+    MDNS_GROUP6,
+    MDNS_PORT,
+    T_A,
+    T_AAAA,
+    T_PTR,
+    T_SRV,
+    T_TXT,
+    FLAG_QR,
+    pack_message,
+    parse,
+    unpack_name,
+)
+
+TYPE_NAMES = {T_A: 'A', T_PTR: 'PTR', T_TXT: 'TXT', T_AAAA: 'AAAA', T_SRV: 'SRV'}
+
+
+def describe(rec):
+    '''Readable text of a record'''
+    if rec.rtype == T_PTR:
+        value = '.'.join(unpack_name(rec.rdata, 0)[0])
+    elif rec.rtype == T_SRV:
+        port = struct.unpack('!H', rec.rdata[4:6])[0]
+        value = '%s:%d' % ('.'.join(unpack_name(rec.rdata, 6)[0]), port)
+    elif rec.rtype == T_TXT:
+        items = []
+        offset = 0
+        while offset < len(rec.rdata):
+            length = rec.rdata[offset]
+            items.append(rec.rdata[offset + 1 : offset + 1 + length])
+            offset += 1 + length
+        value = ' '.join(repr(item)[2:-1] for item in items if item)
+    elif rec.rtype in (T_A, T_AAAA):
+        family = socket.AF_INET6 if rec.rtype == T_AAAA else socket.AF_INET
+        value = socket.inet_ntop(family, rec.rdata)
+    else:
+        value = rec.rdata.hex()
+    return '%s %s %d %s' % (
+        '.'.join(rec.name),
+        TYPE_NAMES.get(rec.rtype, rec.rtype),
+        rec.ttl,
+        value,
+    )
+
+
+class MdnsBrowser:
+    '''Multicast queries from the mDNS port, as sent by DNS-SD browsers'''
+
+    def __init__(self, ifindex):
+        self.ifindex = ifindex
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(('::', MDNS_PORT))
+        ifindex = struct.pack('@I', ifindex)
+        self.sock.setsockopt(
+            socket.IPPROTO_IPV6,
+            socket.IPV6_JOIN_GROUP,
+            socket.inet_pton(socket.AF_INET6, MDNS_GROUP6) + ifindex,
+        )
+        self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, ifindex)
+
+    def query(self, name, qtype=T_PTR, known=(), unicast=False, timeout=1):
+        '''Return the records received and the delay of the first response'''
+        qclass = C_IN | (C_UNICAST if unicast else 0)
+        data = pack_message(known, flags=0, questions=[(name, qtype, qclass)])
+        start = time.monotonic()
+        self.sock.sendto(data, (MDNS_GROUP6, MDNS_PORT, 0, self.ifindex))
+        records = []
+        delay = None
+        while True:
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                data, _ = self.sock.recvfrom(MAX_SIZE)
+            except socket.timeout:
+                break
+            msg = parse(data)
+            if not msg.flags & FLAG_QR:
+                continue
+            if delay is None:
+                delay = time.monotonic() - start
+            records += msg.answers
+        return records, delay
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,199 @@
+'''Fake KiNOS NCP answering the ksh commands used by KiBRA'''
+import ipaddress
+import threading
+import time
+import types
+
+import kibra
+
+SIM_PORT = '/dev/ttySIM0'
+
+# Settings of a cleared device
+DEFAULTS = {
+    'channel': '11',
+    'commcred': 'KIRALE',
+    'emac': '0011223344556677',
+    'mkey': '00112233445566778899aabbccddeeff',
+    'mlprefix': 'fd00:db8::',
+    'netname': 'KiNOS',
+    'panid': '0xface',
+    'role': 'leader',
+    'xpanid': '0x0123456789abcdef',
+}
+
+
+class FakeKiSerial:
+    '''
+    Same interface as kitools.kiserial.KiSerial. When a SyslogEmitter is given,
+    bringing the interface up sends the messages that KiNOS would send.
+    '''
+
+    def __init__(
+        self, port=SIM_PORT, debug=None, latency=0.0, syslog=None, rloc16=0x0400
+    ):
+        self.port = port
+        self.latency = latency
+        self.syslog = syslog
+        self.rloc16 = rloc16
+        self.mutex = threading.Lock()
+        self.active = True
+        self.commands = 0
+        self.snum = 'KTWM102-SIM%04X' % rloc16
+        self.heui64 = '%016x' % (0x1122334455660000 + rloc16)
+        self.ecm = True
+        self.thver = 3
+        self._clear()
+
+    def _clear(self):
+        self.settings = dict(DEFAULTS)
+        self.status = 'none'
+        self.services = []
+        self.prefixes = []
+        self.routes = []
+        self.bagent = 'off'
+        self.brouter = 'off'
+
+    def _addrs(self):
+        prefix = ipaddress.IPv6Address(self.settings['mlprefix']).packed[:8]
+        rloc = prefix + bytes.fromhex('000000fffe00') + self.rloc16.to_bytes(2, 'big')
+        iid = int(self.heui64, 16)
+        ll = bytes.fromhex('fe80000000000000') + (iid ^ 1 << 57).to_bytes(8, 'big')
+        mleid = prefix + (iid ^ 0xA5A5A5A5A5A5A5A5).to_bytes(8, 'big')
+        return [ipaddress.IPv6Address(addr).compressed for addr in (ll, rloc, mleid)]
+
+    def _aloc(self, aloc16):
+        prefix = ipaddress.IPv6Address(self.settings['mlprefix']).packed[:8]
+        aloc = prefix + bytes.fromhex('000000fffe00') + aloc16.to_bytes(2, 'big')
+        return ipaddress.IPv6Address(aloc).compressed
+
+    def _ifup(self):
+        self.status = 'joined'
+        if not self.syslog:
+            return
+        self.syslog.join_status(True)
+        mesh_prefix = '0x' + (
+            ipaddress.IPv6Address(self.settings['mlprefix']).packed[:8].hex()
+        )
+        self.syslog.active_dataset(
+            self.settings['channel'],
+            self.settings['panid'],
+            '0x02a0f7f8',
+            mesh_prefix,
+            self.settings['xpanid'],
+            self.settings['netname'],
+        )
+        for addr in self._addrs():
+            self.syslog.unicast_add(addr)
+        # This device becomes the Primary BBR once it has a BBR service
+        if self.services:
+            self.syslog.aloc_add(self._aloc(0xFC10))
+            self.syslog.aloc_add(self._aloc(0xFC38))
+
+    def _show(self, param):
+        if param == 'status':
+            return [self.status]
+        elif param == 'snum':
+            return [self.snum]
+        elif param == 'swver':
+            return [kibra.__kinosver__]
+        elif param == 'thver':
+            return ['Thread v%d' % self.thver]
+        elif param == 'heui64':
+            return [self.heui64]
+        elif param == 'hwconfig':
+            return [
+                'Platform: KTWM102',
+                'Mode: %d' % (4 if self.ecm else 0),
+                'Serial: on',
+                'ECM: %s' % ('on' if self.ecm else 'off'),
+            ]
+        elif param in self.settings:
+            return [self.settings[param]]
+        return ['Error']
+
+    def _config(self, args):
+        param = args[0]
+        value = ' '.join(args[1:]).strip('"')
+        if param == 'service':
+            if args[1] == 'add':
+                self.services.append(args[2:])
+        elif param in ('prefix', 'route'):
+            table = self.prefixes if param == 'prefix' else self.routes
+            entry = tuple(args[2:4])
+            if args[1] == 'add' and entry not in table:
+                table.append(entry)
+            elif args[1] == 'remove' and entry in table:
+                table.remove(entry)
+        elif param == 'hwmode':
+            self.ecm = value == '4'
+        elif param == 'thver':
+            self.thver = int(value)
+        elif param == 'bagent':
+            self.bagent = value
+        elif param == 'brouter':
+            self.brouter = value
+        elif param == 'outband':
+            pass
+        elif self.status == 'joined':
+            return ['Error']
+        else:
+            self.settings[param] = value
+        return []
+
+    def ksh_cmd(self, cmd, debug_level=None):
+        if not self.active:
+            raise IOError('Device %s is not connected' % self.port)
+        with self.mutex:
+            if self.latency:
+                time.sleep(self.latency)
+            self.commands += 1
+            args = cmd.split()
+            if not args:
+                return []
+            elif args[0] == 'show' and len(args) > 1:
+                return self._show(args[1])
+            elif args[0] == 'config' and len(args) > 1:
+                return self._config(args[1:])
+            elif args[0] == 'ifup':
+                self._ifup()
+            elif args[0] == 'ifdown':
+                self.status = 'none - saved configuration'
+            elif args[0] == 'clear':
+                self._clear()
+            return []
+
+    def wait_for(self, param, value, timeout=10):
+        deadline = time.time() + timeout
+        while value not in self.ksh_cmd('show %s' % param)[0]:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def is_active(self):
+        if not self.active:
+            raise IOError('Device %s is not connected' % self.port)
+        return True
+
+    def disconnect(self):
+        self.active = False
+
+
+def install(latency=0.0, syslog=None):
+    '''
+    Make kitools.kiserial find and open a fake device instead of real ones,
+    returns the device that KiBRA will use
+    '''
+    from kitools import kiserial
+
+    device = FakeKiSerial(latency=latency, syslog=syslog)
+
+    def find_devices(**kwargs):
+        return [types.SimpleNamespace(port=device.port)]
+
+    def open_device(port, debug=None):
+        return device
+
+    kiserial.find_devices = find_devices
+    kiserial.KiSerial = open_device
+    return device
@@ -0,0 +1,171 @@
+'''Scripted Thread devices and backbone BBRs generating CoAP load for KiBRA'''
+import asyncio
+import ipaddress
+import logging
+import random
+import struct
+import time
+
+from kibra.coapclient import CoapClient
+from kibra.thread import DEFS, TLV, URI
+from kibra.tlv import ThreadTLV
+
+# Message type: relative weight in the generated load
+DEF_MIX = {'n_dr': 4, 'n_mr': 2, 'bb_qry': 2, 'pro_bb_ntf': 1}
+
+
+def _tlv(type_, value):
+    return ThreadTLV(t=type_, l=len(value), v=value).array()
+
+
+def n_dr_payload(dua, eid, elapsed=None):
+    '''DUA.req: Target EID, ML-EID and Time Since Last Transaction TLVs'''
+    payload = _tlv(TLV.A_TARGET_EID, ipaddress.IPv6Address(dua).packed)
+    payload += _tlv(TLV.A_ML_EID, bytes.fromhex(eid))
+    if elapsed is not None:
+        payload += _tlv(TLV.A_TIME_SINCE_LAST_TRANSACTION, struct.pack('!I', elapsed))
+    return payload
+
+
+def n_mr_payload(addrs, timeout=None, comm_sid=None):
+    '''MLR.req: IPv6 Addresses and optional Timeout and Commissioner Session ID'''
+    value = b''.join(ipaddress.IPv6Address(addr).packed for addr in addrs)
+    payload = _tlv(TLV.A_IPV6_ADDRESSES, value)
+    if timeout is not None:
+        payload += _tlv(TLV.A_TIMEOUT, struct.pack('!I', timeout))
+    if comm_sid is not None:
+        payload += _tlv(TLV.A_COMMISSIONER_SESSION_ID, struct.pack('!H', comm_sid))
+    return payload
+
+
+def bb_qry_payload(dua, rloc16=None):
+    '''BB.qry, also valid as ADDR_QRY.qry'''
+    payload = _tlv(TLV.A_TARGET_EID, ipaddress.IPv6Address(dua).packed)
+    if rloc16 is not None:
+        payload += _tlv(TLV.A_RLOC16, struct.pack('!H', rloc16))
+    return payload
+
+
+def bb_ans_payload(dua, eid, elapsed, net_name, rloc16=None):
+    '''BB.ans, or PRO_BB.ntf without RLOC16'''
+    payload = _tlv(TLV.A_TARGET_EID, ipaddress.IPv6Address(dua).packed)
+    payload += _tlv(TLV.A_ML_EID, bytes.fromhex(eid))
+    if rloc16 is not None:
+        payload += _tlv(TLV.A_RLOC16, struct.pack('!H', rloc16))
+    payload += _tlv(TLV.A_TIME_SINCE_LAST_TRANSACTION, struct.pack('!I', elapsed))
+    payload += _tlv(TLV.A_NETWORK_NAME, net_name.encode())
+    return payload
+
+
+def addr_err_payload(dua, eid):
+    '''ADDR_ERR.ntf'''
+    payload = _tlv(TLV.A_TARGET_EID, ipaddress.IPv6Address(dua).packed)
+    payload += _tlv(TLV.A_ML_EID, bytes.fromhex(eid))
+    return payload
+
+
+class Peer:
+    '''Thread device with a DUA and its ML-EID'''
+
+    def __init__(self, index, dua_prefix, rloc16):
+        self.index = index
+        self.rloc16 = rloc16
+        self.eid = '%016x' % random.getrandbits(64)
+        prefix = ipaddress.IPv6Network(dua_prefix).network_address.packed[:8]
+        self.dua = ipaddress.IPv6Address(prefix + struct.pack('!Q', index + 1))
+        self.mcast = ipaddress.IPv6Address(
+            bytes.fromhex('ff05000000000000') + struct.pack('!Q', index + 1)
+        )
+        self.registered = time.time()
+
+
+class PeerPopulation:
+    '''
+    Send a mix of DUA.req and MLR.req as Thread devices towards the BBR mesh
+    address, and BB.qry and PRO_BB.ntf as other BBRs towards its backbone
+    address, at a given rate
+    '''
+
+    def __init__(
+        self,
+        count,
+        mesh_addr,
+        bb_addr,
+        dua_prefix='fd00:7d03::/64',
+        net_name='KiNOS',
+        mix=None,
+        mesh_port=DEFS.PORT_MM,
+        bb_port=DEFS.PORT_BB,
+    ):
+        self.peers = [Peer(i, dua_prefix, 0x0400 + i) for i in range(count)]
+        self.mesh = (mesh_addr, mesh_port)
+        self.backbone = (bb_addr, bb_port)
+        self.net_name = net_name
+        self.mix = mix or DEF_MIX
+        self.client = CoapClient()
+        # Message type: [sent, answered, latencies in ms]
+        self.stats = {name: [0, 0, []] for name in self.mix}
+
+    async def _send(self, name, peer):
+        if name == 'n_dr':
+            elapsed = int(time.time() - peer.registered)
+            addr, port, uri, con = self.mesh + (URI.N_DR, True)
+            payload = n_dr_payload(peer.dua.compressed, peer.eid, elapsed)
+        elif name == 'n_mr':
+            addr, port, uri, con = self.mesh + (URI.N_MR, True)
+            payload = n_mr_payload([peer.mcast.compressed])
+        elif name == 'bb_qry':
+            addr, port, uri, con = self.backbone + (URI.B_BQ, False)
+            payload = bb_qry_payload(peer.dua.compressed, peer.rloc16)
+        elif name == 'pro_bb_ntf':
+            elapsed = int(time.time() - peer.registered)
+            addr, port, uri, con = self.backbone + (URI.B_BA, False)
+            payload = bb_ans_payload(
+                peer.dua.compressed, peer.eid, elapsed, self.net_name
+            )
+        else:
+            raise ValueError('Unknown message %s' % name)
+
+        stats = self.stats[name]
+        stats[0] += 1
+        start = time.time()
+        if con:
+            resp = await self.client.con_request(addr, port, uri, bytes(payload))
+            if resp is not None:
+                stats[1] += 1
+                stats[2].append(1000 * (time.time() - start))
+        else:
+            await self.client.non_request(addr, port, uri, bytes(payload))
+
+    async def run(self, rate, duration):
+        '''Send rate messages per second during duration seconds'''
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        pending = set()
+        deadline = time.time() + duration
+        interval = 1 / rate
+        next_send = time.time()
+        while time.time() < deadline:
+            name = random.choices(names, weights)[0]
+            peer = random.choice(self.peers)
+            pending.add(asyncio.ensure_future(self._send(name, peer)))
+            pending = {task for task in pending if not task.done()}
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.time()))
+        if pending:
+            await asyncio.wait(pending)
+        self.client.stop()
+
+    def report(self):
+        '''Message type: sent, answered, p50 and p99 latency in ms'''
+        report = {}
+        for name, (sent, answered, latencies) in self.stats.items():
+            latencies = sorted(latencies)
+            report[name] = {
+                'sent': sent,
+                'answered': answered,
+                'p50_ms': latencies[len(latencies) // 2] if latencies else None,
+                'p99_ms': latencies[int(0.99 * len(latencies))] if latencies else None,
+            }
+        logging.info('Simulated peers report: %s', report)
+        return report
@@ -0,0 +1,70 @@
+'''KiNOS syslog messages, as sent by the NCP to the interior link-local address'''
+import socket
+import time
+
+from kibra.syslog import (
+    SYSLOG_MSG_ID_ALOC_ADD,
+    SYSLOG_MSG_ID_ALOC_DEL,
+    SYSLOG_MSG_ID_AOPD_SAVED,
+    SYSLOG_MSG_ID_CACHE_ADD,
+    SYSLOG_MSG_ID_CACHE_DEL,
+    SYSLOG_MSG_ID_JOIN_STATUS_ERR,
+    SYSLOG_MSG_ID_JOIN_STATUS_OK,
+    SYSLOG_MSG_ID_UNICAST_SYS_ADD,
+    SYSLOG_PORT,
+)
+
+SYSLOG_FORMAT = (
+    '<62>1 - - - - - %d [origin enterpriseId="49166"][meta sysUpTime="%d"] BOM%s'
+)
+
+
+def format_message(msgid, payload='', uptime=0):
+    '''Syslog message with the uptime given in seconds'''
+    return (SYSLOG_FORMAT % (msgid, int(100 * uptime), payload)).encode()
+
+
+class SyslogEmitter:
+    '''Send KiNOS syslog messages to a KiBRA Syslog_Parser'''
+
+    def __init__(self, addr='::1', port=SYSLOG_PORT, ifindex=0):
+        self.dst = (addr, port, 0, ifindex)
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.started = time.time()
+        self.sent = 0
+
+    def send(self, msgid, payload=''):
+        message = format_message(msgid, payload, time.time() - self.started)
+        self.sock.sendto(message, self.dst)
+        self.sent += 1
+
+    def cache_add(self, eid):
+        self.send(SYSLOG_MSG_ID_CACHE_ADD, eid)
+
+    def cache_del(self, eid):
+        self.send(SYSLOG_MSG_ID_CACHE_DEL, eid)
+
+    def aloc_add(self, addr):
+        self.send(SYSLOG_MSG_ID_ALOC_ADD, addr)
+
+    def aloc_del(self, addr):
+        self.send(SYSLOG_MSG_ID_ALOC_DEL, addr)
+
+    def unicast_add(self, addr):
+        self.send(SYSLOG_MSG_ID_UNICAST_SYS_ADD, addr)
+
+    def active_dataset(self, channel, panid, secpol, mesh_prefix, xpanid, netname):
+        '''mesh_prefix is the 8 bytes hex string, as 0xfd00000000000000'''
+        self.send(
+            SYSLOG_MSG_ID_AOPD_SAVED,
+            ' | '.join([str(channel), panid, secpol, mesh_prefix, xpanid, netname]),
+        )
+
+    def join_status(self, joined=True):
+        if joined:
+            self.send(SYSLOG_MSG_ID_JOIN_STATUS_OK)
+        else:
+            self.send(SYSLOG_MSG_ID_JOIN_STATUS_ERR)
+
+    def close(self):
+        self.sock.close()
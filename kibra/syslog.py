@@ -27,6 +27,10 @@ SYSLOG_MSG_ID_JOIN_STATUS_ERR = 9
 
 IPPROTO_IPV6 = 41
 
+SYSLOG_PATTERN = re.compile(
+    r'<62>1 - - - - - (\d+) \[origin enterpriseId="49166"\]\[meta sysUpTime="(\d+)"\]\s?(.*)'
+)
+
 
 def _parse_active_dataset(payload):
     channel, panid, sec_policy, mesh_prefix, xpanid, net_name = payload.split(' | ')
@@ -75,6 +79,18 @@ def _process_message(msgid, uptime, payload):
         logging.info('Device could not join to the Thread network')
 
 
+def handle_message(data):
+    '''Process a received KiNOS syslog datagram'''
+    try:
+        message = data.decode()
+    except:
+        return
+    match = SYSLOG_PATTERN.match(message)
+    if match:
+        msgid, uptime, payload = match.groups()
+        _process_message(int(msgid), int(uptime) / 100, payload.replace('BOM', ''))
+
+
 class Syslog_Parser:
     def __init__(self, ll_addr):
         self.run = False
@@ -89,25 +105,12 @@ class Syslog_Parser:
             logging.error('Could not launch Syslog_Parser. Error: %s' % exc)
             return
 
-        self.pattern = re.compile(
-            r'<62>1 - - - - - (\d+) \[origin enterpriseId="49166"\]\[meta sysUpTime="(\d+)"\]\s?(.*)'
-        )
-
         asyncio.get_event_loop().run_in_executor(None, self.run_daemon)
 
     def run_daemon(self):
         while self.run:
             request = self.sock.recvfrom(1280)
-            try:
-                message = request[0].decode()
-            except:
-                continue
-            match = self.pattern.match(message)
-            if match:
-                msgid, uptime, payload = match.groups()
-                _process_message(
-                    int(msgid), int(uptime) / 100, payload.replace('BOM', '')
-                )
+            handle_message(request[0])
 
     def stop(self):
         self.run = False
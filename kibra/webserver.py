@@ -1,212 +1,613 @@
 import asyncio
-import http.server
+import concurrent.futures
+import email.utils
+import gzip
+import hashlib
+import http
 import ipaddress
 import json
 import logging
 import os
 import socket
-import socketserver
 import struct
 import sys
 import time
-import urllib
-import xml.etree.ElementTree
+import urllib.parse
 
 import kibra
 import kibra.coapserver as coap_server
 import kibra.database as db
+import kibra.loopmon as loopmon
+import kibra.metrics as metrics
 import kibra.network as NETWORK
+from kibra.config import ConfigFile
+from kibra.dhcp import leases_dump
 from kibra.diags import DIAGS_DB
 from kibra.ksh import bbr_dataset_update, send_cmd
 from kibra.shell import bash
 
 BBR_HDP_ADDR = ('ff02::114', 12345)
 WEB_PORT = 80
+# Seconds an idle persistent connection is kept open
+KEEPALIVE_TIMEOUT = 15
+# Seconds between keep-alive comments in the nodes event stream
+SSE_KEEPALIVE = 15
+MAX_HEADERS = 64
+# Bytes read from the log file at once, and seconds between follow checks
+LOG_BLOCK = 65536
+LOG_POLL = 1
+# Threads for the handlers that may block
+WEB_WORKERS = 4
 PUBLIC_DIR = os.path.dirname(sys.argv[0]) + '/public'
-LEASES_PATH = '/var/lib/dibbler/server-AddrMgr.xml'
+# Seconds the browsers may use a cached asset before revalidating it
+ASSET_MAX_AGE = 86400
+# Router advertisements of the test harness
+RADVD_FILE = ConfigFile('radvd', '/etc/radvd.conf', ['service radvd restart'])
+# Extension: [MIME type, compressible]
+MIME_TYPES = {
+    '.css': ['text/css', True],
+    '.html': ['text/html', True],
+    '.ico': ['image/x-icon', True],
+    '.js': ['application/javascript', True],
+    '.json': ['application/json', True],
+    '.png': ['image/png', False],
+    '.svg': ['image/svg+xml', True],
+}
 
 ANNOUNCER = None
+ASSETS = {}
+# Tasks serving the open connections, cancelled when stopping
+CLIENTS = set()
 HTTPD = None
 LOOP = None
+WORKERS = None
 
 IPPROTO_IPV6 = 41
 
 
-def _get_leases():
-    leases = {}
-    leases['leases'] = []
+class HttpRequest:
+    '''Parsed HTTP request line and headers'''
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        url = urllib.parse.urlparse(target)
+        self.path = url.path
+        self.query = urllib.parse.parse_qs(url.query)
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class HttpResponse:
+    '''
+    HTTP response with a complete body, or with a coroutine function that
+    writes the body to the stream itself (the connection is then closed)
+    '''
+
+    def __init__(
+        self, status=http.HTTPStatus.OK, body=b'', mime_type='text/json', stream=None
+    ):
+        self.status = http.HTTPStatus(status)
+        self.body = body.encode() if isinstance(body, str) else body
+        self.headers = {'Access-Control-Allow-Origin': '*', 'Content-type': mime_type}
+        self.stream = stream
+
+
+class StaticAsset:
+    '''Public file kept in memory, with its gzip variant and validators'''
+
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as file_:
+            self.body = file_.read()
+        mime_type, compressible = MIME_TYPES.get(
+            os.path.splitext(file_path)[1], ['application/octet-stream', False]
+        )
+        self.mime_type = mime_type
+        self.gzip_body = None
+        if compressible:
+            gzip_body = gzip.compress(self.body, compresslevel=9)
+            if len(gzip_body) < len(self.body):
+                self.gzip_body = gzip_body
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:16]
+        self.mtime = int(os.path.getmtime(file_path))
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        # Pages are always revalidated so that changes are seen immediately
+        if mime_type == 'text/html':
+            self.cache_control = 'no-cache'
+        else:
+            self.cache_control = 'max-age=%u' % ASSET_MAX_AGE
+
+    def not_modified(self, headers):
+        etags = headers.get('if-none-match')
+        if etags is not None:
+            return self.etag in etags or etags.strip() == '*'
+        since = headers.get('if-modified-since')
+        if since:
+            try:
+                return (
+                    self.mtime <= email.utils.parsedate_to_datetime(since).timestamp()
+                )
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def response(self, request):
+        if self.not_modified(request.headers):
+            response = HttpResponse(http.HTTPStatus.NOT_MODIFIED)
+        else:
+            accepted = request.headers.get('accept-encoding', '')
+            if self.gzip_body and 'gzip' in accepted:
+                response = HttpResponse(body=self.gzip_body, mime_type=self.mime_type)
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = HttpResponse(body=self.body, mime_type=self.mime_type)
+        response.headers['Content-type'] = self.mime_type
+        if self.gzip_body:
+            response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['ETag'] = self.etag
+        response.headers['Last-Modified'] = self.last_modified
+        response.headers['Cache-Control'] = self.cache_control
+        return response
+
+
+def _load_assets():
+    '''Read all the public files, accessible as /<path> and /assets/<path>'''
+    ASSETS.clear()
+    for root, _, files in os.walk(PUBLIC_DIR):
+        for name in files:
+            file_path = os.path.join(root, name)
+            url_path = '/' + os.path.relpath(file_path, PUBLIC_DIR)
+            try:
+                ASSETS[url_path] = StaticAsset(file_path)
+            except OSError as exc:
+                logging.warning('Unable to load %s: %s', file_path, exc)
+    logging.info('Loaded %d web assets.', len(ASSETS))
+
+
+def _get(request):
+    '''Handle the requests that may block, run in the worker pool'''
+    path = request.path
+    req = request.query
+    mime_type = 'text/json'
+    data = 'OK'
+
+    if path == '/db/leases':
+        data = leases_dump()
+    elif kibra.__harness__ and path.startswith('/api'):
+        for key in req.keys():
+            if not key in db.modifiable_keys():
+                return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+        # Apply incoming changes
+        modif_keys = set()
+        for key, value in req.items():
+            if str(db.get(key)) != value[0]:
+                db.set(key, value[0])
+                modif_keys.add(key)
+        # Special actions
+        if not set(['mlr_timeout', 'rereg_delay']).isdisjoint(modif_keys):
+            asyncio.run_coroutine_threadsafe(bbr_dataset_update(), LOOP).result()
+    elif kibra.__harness__ and path.startswith('/ksh'):
+        cmd = req.get('c', None)
+        if cmd:
+            data = '\n'.join(send_cmd(cmd[0]))
+        else:
+            return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+    elif kibra.__harness__ and path.startswith('/ping'):
+        dst = req.get('dst', ['0100::'])[0]
+        size = req.get('sz', ['0'])[0]
+        hl = req.get('hl', ['255'])[0]
+        iface = db.get('exterior_ifname')
+        port = req.get('port', [''])[0]
+        tout = req.get('tout', ['0'])[0]
+        if port:
+            # UDP
+            cmd = 'nping -6 --udp'
+            cmd += ' --source-port %s --dest-port %s' % (port, port)
+            cmd += ' --no-capture --count 1'
+            cmd += ' --interface %s' % iface
+            cmd += ' --dest-ip %s' % dst
+            cmd += ' --source-mac %s' % db.get('exterior_mac')
+            # TODO: https://en.wikipedia.org/wiki/Multicast_address#Ethernet
+            cmd += ' --dest-mac ff:ff:ff:ff:ff:ff'
+            cmd += ' --hop-limit %s' % hl
+            # TODO: use DUA as source
+            cmd += ' --source-ip %s' % db.get('exterior_ipv6_ll')
+            cmd += ' --data-length %s' % size
+        else:
+            # ICMP
+            cmd = 'ping -6 -c1'
+            cmd += ' -W%s -s%s -t%s -I%s %s' % (tout, size, hl, iface, dst)
+        try:
+            data = bash(cmd)
+        except Exception as e:
+            logging.error(e)
+            data = 'ping error'
+    elif kibra.__harness__ and path.startswith('/radvd'):
+        off = req.get('off')
+        backhaul = req.get('bh')
+        domain = req.get('dm')
+        if off:
+            bash('service radvd stop')
+            # The same configuration has to start it again
+            RADVD_FILE.delete(apply=False)
+        elif backhaul and domain:
+            if not db.get('exterior_ifname'):
+                NETWORK.set_ext_iface()
+            lines = []
+            lines.append('interface %s {' % db.get('exterior_ifname'))
+            lines.append('  AdvSendAdvert on;')
+            lines.append('  prefix %s { AdvAutonomous on; };' % backhaul[0])
+            lines.append('  prefix %s { AdvAutonomous off; };' % domain[0])
+            lines.append('};')
+            lines.append('')
+            bash('echo 1 > /proc/sys/net/ipv6/conf/all/forwarding')
+            bash('ip -6 neighbor flush all')
+            RADVD_FILE.update('\n'.join(lines))
+        else:
+            return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+    elif kibra.__harness__ and path.startswith('/mdnsqry'):
+        bash('dig -p 5353 @ff02::fb _meshcop._udp.local ptr')
+    elif kibra.__harness__ and path.startswith('/duastatus'):
+        db.set('dua_next_status', req.get('sta')[0])
+        db.set('dua_next_status_eid', req.get('eid')[0])
+    elif kibra.__harness__ and path.startswith('/mlrstatus'):
+        db.set('mlr_next_status', req.get('sta')[0])
+    elif kibra.__harness__ and path.startswith('/sendudp'):
+        NETWORK.send_udp(req.get('dst')[0], req.get('prt')[0], req.get('pld')[0])
+    elif kibra.__harness__ and path.startswith('/ipneigh'):
+        bash(req.get('cmd'))
+    else:
+        return HttpResponse(http.HTTPStatus.NOT_FOUND)
+
+    return HttpResponse(body=data, mime_type=mime_type)
+
+
+def _log_tail(file_path, lines):
+    '''
+    Return the last lines of a file, reading it backwards by blocks, and the
+    file size at the moment of reading
+    '''
+    with open(file_path, 'rb') as file_:
+        size = file_.seek(0, os.SEEK_END)
+        pos = size
+        chunks = []
+        breaks = 0
+        # One more line break is needed to know the first line is complete
+        while pos > 0 and breaks <= lines:
+            step = min(LOG_BLOCK, pos)
+            pos -= step
+            file_.seek(pos)
+            chunks.append(file_.read(step))
+            breaks += chunks[-1].count(b'\n')
+    data = b''.join(reversed(chunks))
+    if not lines:
+        return b'', size
+    # Find the line break before the first requested line
+    pos = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(lines):
+        pos = data.rfind(b'\n', 0, pos)
+        if pos < 0:
+            break
+    return data[pos + 1 :], size
+
+
+def _count(value):
+    '''Non-negative integer of a query or header value, ValueError otherwise'''
+    value = int(value)
+    if value < 0:
+        raise ValueError('Negative count')
+    return value
+
+
+def _nodes_cursor(request, event_id=None):
+    '''
+    Generation and version of the topology a reader already has, from the
+    "generation:version" event id or the query, ValueError if malformed
+    '''
+    if event_id:
+        generation, _, version = event_id.rpartition(':')
+    else:
+        generation = request.query.get('generation', [None])[0]
+        version = request.query.get('since', [None])[0]
+    return generation or None, None if version is None else _count(version)
+
+
+def _read_chunk(file_path, offset, length):
+    with open(file_path, 'rb') as file_:
+        file_.seek(offset)
+        return file_.read(length)
+
+
+def _parse_range(value, size):
+    '''
+    Return the (first, last) bytes of a single range "bytes=" header, None if
+    it can not be satisfied
+    '''
+    unit, _, byte_range = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition('-')
     try:
-        addrs = xml.etree.ElementTree.parse(LEASES_PATH).getroot()
-    except:
-        return leases
-    for client in addrs.iter('AddrClient'):
-        for addr_ia in client.iter('AddrIA'):
-            if addr_ia.get('ifacename') == db.get('interior_ifname'):
-                for addr in addr_ia.iter('AddrAddr'):
-                    node = {}
-                    node['duid'] = addr_ia.find('duid').text
-                    node['expires'] = 1000 * (
-                        int(addr.get('timestamp')) + int(addr.get('valid'))
-                    )
-                    node['gua'] = addr.text
-                    if node['expires'] > time.time():
-                        leases['leases'].append(node)
-    return leases
-
-
-class V6Server(socketserver.TCPServer):
-    address_family = socket.AF_INET6
-
-
-class WebServer(http.server.SimpleHTTPRequestHandler):
+        if not first:
+            # Suffix range: last N bytes
+            first = max(0, size - int(last))
+            last = size - 1
+        else:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return None
+    return first, last
+
+
+async def _stream_file(writer, file_path, offset, length):
+    while length > 0:
+        chunk = await LOOP.run_in_executor(
+            WORKERS, _read_chunk, file_path, offset, min(LOG_BLOCK, length)
+        )
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+        offset += len(chunk)
+        length -= len(chunk)
+
+
+async def _follow_log(writer, file_path, offset, initial):
+    '''Send the lines appended to the log file as Server-Sent Events'''
+    pending = initial
+    idle = 0
+    inode = None
+    while True:
+        lines = pending.split(b'\n')
+        # Keep the incomplete last line for the next round
+        pending = lines.pop()
+        if lines:
+            event = ''.join(
+                'data: %s\n' % line.decode(errors='replace').strip('\r')
+                for line in lines
+            )
+            writer.write((event + '\n').encode())
+            await writer.drain()
+            idle = 0
+        elif idle >= SSE_KEEPALIVE:
+            writer.write(b': keep-alive\n\n')
+            await writer.drain()
+            idle = 0
+
+        await asyncio.sleep(LOG_POLL)
+        idle += LOG_POLL
+        try:
+            stat = os.stat(file_path)
+            if stat.st_size < offset or inode not in (None, stat.st_ino):
+                # The file was truncated or rotated
+                offset = 0
+                pending = b''
+            inode = stat.st_ino
+            if stat.st_size > offset:
+                chunk = await LOOP.run_in_executor(
+                    WORKERS,
+                    _read_chunk,
+                    file_path,
+                    offset,
+                    min(LOG_BLOCK, stat.st_size - offset),
+                )
+                offset += len(chunk)
+                pending += chunk
+        except OSError:
+            # Rotated and not created again yet, start over with the new file
+            offset = 0
+            pending = b''
+            inode = None
+
+
+async def _get_logs(request):
     '''
-    def do_POST(self):
-        # TODO: by the moment using GET only
-        pass
+    Serve the log file with constant memory:
+      /logs?tail=N     last N lines
+      /logs?follow=1   Server-Sent Events with the new lines (after tail, if any)
+      Range: bytes=    partial content
     '''
+    file_path = db.LOG_FILE
+    tail = request.query.get('tail')
+    try:
+        tail = _count(tail[0]) if tail else None
+    except ValueError:
+        return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+
+    if request.query.get('follow', ['0'])[0] not in ('0', ''):
+        initial, size = await LOOP.run_in_executor(
+            WORKERS, _log_tail, file_path, tail or 0
+        )
+        response = HttpResponse(mime_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.stream = lambda writer: _follow_log(writer, file_path, size, initial)
+        return response
+
+    if tail is not None:
+        data, _ = await LOOP.run_in_executor(WORKERS, _log_tail, file_path, tail)
+        return HttpResponse(body=data, mime_type='text/plain')
+
+    size = os.stat(file_path).st_size
+    response = HttpResponse(mime_type='text/plain')
+    response.headers['Accept-Ranges'] = 'bytes'
+    first, last = 0, size - 1
+    if 'range' in request.headers:
+        byte_range = _parse_range(request.headers['range'], size)
+        if byte_range is None:
+            response.status = http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+            response.headers['Content-Range'] = 'bytes */%u' % size
+            return response
+        first, last = byte_range
+        response.status = http.HTTPStatus.PARTIAL_CONTENT
+        response.headers['Content-Range'] = 'bytes %u-%u/%u' % (first, last, size)
+    length = last - first + 1
+    response.headers['Content-Length'] = length
+    response.stream = lambda writer: _stream_file(writer, file_path, first, length)
+    return response
+
+
+async def _stream_nodes(writer, generation, version):
+    '''Push the topology changes as Server-Sent Events'''
+    changed = asyncio.Event()
+    listener = lambda: LOOP.call_soon_threadsafe(changed.set)
+    DIAGS_DB.listeners.append(listener)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(changed.wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                writer.write(b': keep-alive\n\n')
+            else:
+                changed.clear()
+                delta = DIAGS_DB.delta(version, generation)
+                if (delta['generation'], delta['version']) == (generation, version):
+                    continue
+                generation, version = delta['generation'], delta['version']
+                data = json.dumps(delta, separators=(',', ':'))
+                event = 'id: %s:%u\nevent: nodes\ndata: %s\n\n' % (
+                    generation,
+                    version,
+                    data,
+                )
+                writer.write(event.encode())
+            await writer.drain()
+    finally:
+        DIAGS_DB.listeners.remove(listener)
 
-    def do_GET(self):
-        binary = False
-        if self.path == '/':
-            self.path = '/index.html'
-        file_path = '%s%s' % (PUBLIC_DIR, self.path.replace('/assets', ''))
-        mime_type = 'text/json'
 
+async def _dispatch(request):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponse(http.HTTPStatus.NOT_IMPLEMENTED)
+    if request.path == '/':
+        request.path = '/index.html'
+
+    # In-memory data is served directly from the event loop
+    if request.path == '/db/cfg':
+        return HttpResponse(body=db.dump())
+    elif request.path == '/db/nodes':
+        try:
+            generation, since = _nodes_cursor(request)
+        except ValueError:
+            return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+        return HttpResponse(body=DIAGS_DB.dump(since, generation))
+    elif request.path == '/db/loop':
+        return HttpResponse(body=json.dumps(loopmon.report()))
+    elif request.path == '/db/nodes/events':
+        # Browsers resume the stream with the last received event id
         try:
-            # Parse URL fields
-            req = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
-
-            # Different actions
-            data = 'OK'
-            if self.path == '/logs':
-                # TODO: fancy colourfull autorefresh logs page
-                with open(db.LOG_FILE, 'r') as file_:
-                    data = file_.read()
-                mime_type = 'text/plain'
-            elif self.path == '/db/cfg':
-                data = db.dump()
-            elif self.path == '/db/nodes':
-                data = json.dumps(DIAGS_DB, indent=2)
-            elif self.path == '/db/leases':
-                data = json.dumps(_get_leases(), indent=2)
-            elif os.path.isfile(file_path):
-                if self.path.endswith(".html"):
-                    mime_type = 'text/html'
-                if self.path.endswith(".png"):
-                    mime_type = 'image/png'
-                    binary = True
-                if self.path.endswith(".js"):
-                    mime_type = 'application/javascript'
-                if self.path.endswith(".css"):
-                    mime_type = 'text/css'
-                with open(file_path, 'rb' if binary else 'r') as file_:
-                    data = file_.read()
-            elif kibra.__harness__ and self.path.startswith('/api'):
-                for key in req.keys():
-                    if not key in db.modifiable_keys():
-                        self.send_response(http.HTTPStatus.BAD_REQUEST)
-                        return
-                # Apply incoming changes
-                modif_keys = set()
-                for key, value in req.items():
-                    if str(db.get(key)) != value[0]:
-                        db.set(key, value[0])
-                        modif_keys.add(key)
-                # Special actions
-                if not set(['mlr_timeout', 'rereg_delay']).isdisjoint(modif_keys):
-                    bbr_dataset_update()
-            elif kibra.__harness__ and self.path.startswith('/ksh'):
-                cmd = req.get('c', None)
-                if cmd:
-                    data = '\n'.join(send_cmd(cmd[0]))
-                else:
-                    return
-            elif kibra.__harness__ and self.path.startswith('/ping'):
-                dst = req.get('dst', ['0100::'])[0]
-                size = req.get('sz', ['0'])[0]
-                hl = req.get('hl', ['255'])[0]
-                iface = db.get('exterior_ifname')
-                port = req.get('port', [''])[0]
-                tout = req.get('tout', ['0'])[0]
-                if port:
-                    # UDP
-                    cmd = 'nping -6 --udp'
-                    cmd += ' --source-port %s --dest-port %s' % (port, port)
-                    cmd += ' --no-capture --count 1'
-                    cmd += ' --interface %s' % iface
-                    cmd += ' --dest-ip %s' % dst
-                    cmd += ' --source-mac %s' % db.get('exterior_mac')
-                    # TODO: https://en.wikipedia.org/wiki/Multicast_address#Ethernet
-                    cmd += ' --dest-mac ff:ff:ff:ff:ff:ff'
-                    cmd += ' --hop-limit %s' % hl
-                    # TODO: use DUA as source
-                    cmd += ' --source-ip %s' % db.get('exterior_ipv6_ll')
-                    cmd += ' --data-length %s' % size
-                else:
-                    # ICMP
-                    cmd = 'ping -6 -c1'
-                    cmd += ' -W%s -s%s -t%s -I%s %s' % (tout, size, hl, iface, dst)
+            generation, since = _nodes_cursor(
+                request, request.headers.get('last-event-id')
+            )
+        except ValueError:
+            return HttpResponse(http.HTTPStatus.BAD_REQUEST)
+        response = HttpResponse(mime_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.stream = lambda writer: _stream_nodes(writer, generation, since)
+        return response
+    elif request.path == '/logs':
+        return await _get_logs(request)
+    elif request.path == '/metrics':
+        return HttpResponse(
+            body=metrics.render(), mime_type='text/plain; version=0.0.4'
+        )
+
+    # Static files are already in memory
+    asset = ASSETS.get(request.path.replace('/assets', '', 1))
+    if asset:
+        return asset.response(request)
+
+    # Everything else might block (files, serial, shell commands)
+    return await LOOP.run_in_executor(WORKERS, _get, request)
+
+
+async def _read_request(reader):
+    '''Read the request line and headers, None if the connection is over'''
+    line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise ValueError('Bad request line')
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError('Too many headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    # Bodies are not used, but they must be consumed to keep the connection
+    length = int(headers.get('content-length', 0))
+    if length:
+        await reader.readexactly(length)
+    return HttpRequest(method, target, version, headers)
+
+
+def _accept(reader, writer):
+    task = LOOP.create_task(_handle_client(reader, writer))
+    CLIENTS.add(task)
+    task.add_done_callback(CLIENTS.discard)
+
+
+async def _handle_client(reader, writer):
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except ValueError:
+                request = None
+                response = HttpResponse(http.HTTPStatus.BAD_REQUEST)
+                keep_alive = False
+            else:
+                if request is None:
+                    break
                 try:
-                    data = bash(cmd)
-                except Exception as e:
-                    logging.error(e)
-                    data = 'ping error'
-            elif kibra.__harness__ and self.path.startswith('/radvd'):
-                off = req.get('off')
-                backhaul = req.get('bh')
-                domain = req.get('dm')
-                if off:
-                    bash('service radvd stop')
-                elif backhaul and domain:
-                    if not db.get('exterior_ifname'):
-                        NETWORK.set_ext_iface()
-                    with open('/etc/radvd.conf', 'w') as file_:
-                        file_.write('interface %s {\n' % db.get('exterior_ifname'))
-                        file_.write('  AdvSendAdvert on;\n')
-                        file_.write(
-                            '  prefix %s { AdvAutonomous on; };\n' % backhaul[0]
-                        )
-                        file_.write('  prefix %s { AdvAutonomous off; };\n' % domain[0])
-                        file_.write('};\n')
-                    bash('echo 1 > /proc/sys/net/ipv6/conf/all/forwarding')
-                    bash('ip -6 neighbor flush all')
-                    bash('service radvd restart')
-                else:
-                    return
-            elif kibra.__harness__ and self.path.startswith('/mdnsqry'):
-                bash('dig -p 5353 @ff02::fb _meshcop._udp.local ptr')
-            elif kibra.__harness__ and self.path.startswith('/duastatus'):
-                db.set('dua_next_status', req.get('sta')[0])
-                db.set('dua_next_status_eid', req.get('eid')[0])
-            elif kibra.__harness__ and self.path.startswith('/mlrstatus'):
-                db.set('mlr_next_status', req.get('sta')[0])
-            elif kibra.__harness__ and self.path.startswith('/sendudp'):
-                NETWORK.send_udp(
-                    req.get('dst')[0], req.get('prt')[0], req.get('pld')[0]
-                )
-            elif kibra.__harness__ and self.path.startswith('/ipneigh'):
-                bash(req.get('cmd'))
+                    response = await _dispatch(request)
+                except Exception as exc:
+                    logging.warning('Web request %s failed: %s', request.target, exc)
+                    response = HttpResponse(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+                keep_alive = request.keep_alive() and response.stream is None
+
+            # Status line and headers
+            head = ['HTTP/1.1 %d %s' % (response.status, response.status.phrase)]
+            if response.stream is None and response.status != 304:
+                response.headers['Content-Length'] = len(response.body)
+            response.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+            for name, value in response.headers.items():
+                head.append('%s: %s' % (name, value))
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+            # Body
+            if request is not None and request.method == 'HEAD':
+                pass
+            elif response.stream is not None:
+                await writer.drain()
+                await response.stream(writer)
             else:
-                self.send_response(http.HTTPStatus.NOT_FOUND)
-                return
-        except:
-            self.send_response(http.HTTPStatus.INTERNAL_SERVER_ERROR)
-            return
-
-        self.send_response(http.HTTPStatus.OK)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Content-type', mime_type)
-        self.end_headers()
-        if not binary:
-            data = data.encode()
-        self.wfile.write(data)
-
-    # Disable logging
-    def log_request(self, code):
-        pass
+                writer.write(response.body)
+            await writer.drain()
 
-    def log_message(self, fmt, *args):
+            if not keep_alive:
+                break
+    except (
+        asyncio.TimeoutError,
+        asyncio.IncompleteReadError,
+        ConnectionError,
+    ):
         pass
+    finally:
+        writer.close()
 
 
 class HDP_Announcer:
@@ -246,19 +647,21 @@ class HDP_Announcer:
 
 
 def start():
-    global HTTPD, ANNOUNCER, LOOP
+    global HTTPD, ANNOUNCER, LOOP, WORKERS
 
     LOOP = asyncio.get_event_loop()
+    WORKERS = concurrent.futures.ThreadPoolExecutor(max_workers=WEB_WORKERS)
 
     print('Loading web server...')
+    _load_assets()
     while not HTTPD:
         # The port may have not been closed from the previous session
-        # TODO: properly close server when stopping app
         try:
-            HTTPD = V6Server(('', WEB_PORT), WebServer)
+            HTTPD = LOOP.run_until_complete(
+                asyncio.start_server(_accept, port=WEB_PORT, family=socket.AF_INET6)
+            )
         except OSError:
             time.sleep(1)
-    LOOP.run_in_executor(None, HTTPD.serve_forever)
     print('Webserver is up')
 
     if kibra.__harness__:
@@ -275,10 +678,25 @@ def start():
         print('BBR announced via HDP')
 
 
+async def _close(server, workers):
+    '''Stop listening, end the open connections and streams, then the workers'''
+    server.close()
+    for task in CLIENTS:
+        task.cancel()
+    await asyncio.gather(*CLIENTS, return_exceptions=True)
+    await server.wait_closed()
+    await LOOP.run_in_executor(None, workers.shutdown)
+
+
 def stop():
-    global ANNOUNCER
+    global ANNOUNCER, HTTPD, WORKERS
 
     print('Stopping web server...')
     if kibra.__harness__:
         ANNOUNCER.stop()
-    HTTPD.server_close()
+    closing = _close(HTTPD, WORKERS)
+    HTTPD = WORKERS = None
+    if LOOP.is_running():
+        asyncio.ensure_future(closing)
+    else:
+        LOOP.run_until_complete(closing)
@@ -48,7 +48,7 @@ setup(
         'Operating System :: POSIX :: Linux'
     ],
     keywords='kirale kinos thread border router',
-    packages=['kibra', 'kibra.ncp_fw'],
+    packages=['kibra', 'kibra.ncp_fw', 'kibra.sim'],
     include_package_data=True,
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
@@ -59,5 +59,7 @@ setup(
         'kitools==1.3.5',
         'pyroute2==0.5.3',
     ],
+    # Avahi registrations through D-Bus, instead of service files
+    extras_require={'dbus': ['dbus-python']},
     entry_points={'console_scripts': ['kibra = kibra.__main__:main']},
 )